@@ -1,3 +1,15 @@
+import os
+import sys
+import io
+import time
+import hashlib
+import resource
+import shutil
+import tempfile
+import traceback
+import collections
+import contextlib
+
 
 def makencname(s):
     s = s.replace(" ","_")
@@ -10,3 +22,289 @@ def set_metadata(doc, **kwargs):
     for key, value in kwargs.items():
         doc.metadata[key] = value
 
+
+def cachedir(*subdirs):
+    """Returns the directory where foliatools keeps its caches (honours $XDG_CACHE_HOME), creating it if it does not exist yet"""
+    d = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'foliatools', *subdirs)
+    os.makedirs(d, exist_ok=True)
+    return d
+
+def hashfile(filename, blocksize=1024*1024):
+    """Computes the SHA-256 hash of the contents of a file, returns a hexadecimal digest"""
+    h = hashlib.sha256()
+    with open(filename,'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def resetpeakmemory():
+    """Resets the peak memory usage of the current process, so peakmemory() reports the peak since this moment. This is only possible on Linux, returns whether it succeeded"""
+    try:
+        with open('/proc/self/clear_refs','w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def peakmemory():
+    """Returns the peak memory usage (resident set size) of the current process in MB, since the process started or since the last resetpeakmemory()"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except OSError:
+        pass
+    rusage_denom = 1024.
+    if sys.platform == 'darwin':
+        # ... it seems that in OSX the output is different units ...
+        rusage_denom = rusage_denom * rusage_denom
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / rusage_denom
+
+def openmanifest(filename):
+    """Opens (or creates) a corpus manifest as built by foliaindex, returns an SQLite connection"""
+    import sqlite3 #imported here rather than at the top to keep the startup time of all tools down
+    db = sqlite3.connect(filename, timeout=60)
+    db.execute("CREATE TABLE IF NOT EXISTS documents (path TEXT NOT NULL PRIMARY KEY, mtime INTEGER NOT NULL, size INTEGER NOT NULL, hash TEXT NOT NULL, id TEXT, version TEXT, valid INTEGER)")
+    db.execute("CREATE TABLE IF NOT EXISTS annotations (path TEXT NOT NULL, type TEXT NOT NULL, annotationset TEXT)")
+    db.execute("CREATE TABLE IF NOT EXISTS elements (path TEXT NOT NULL, tag TEXT NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (path, tag))")
+    db.execute("CREATE INDEX IF NOT EXISTS annotations_path ON annotations (path)")
+    db.commit()
+    return db
+
+def manifestcondition(where):
+    """Translates selection constraints for a manifest into an SQL condition on the documents table, returns a (condition, parameters) tuple. Constraints are comma separated, all must hold:
+
+    * ``tag>count`` (or ``>=``, ``<``, ``<=``, ``==``, ``!=``) - The document has more than count elements of the tag, e.g. ``w>10000``
+    * ``tag`` - The document has at least one element of the tag
+    * ``annotation:type`` or ``annotation:type@set`` - The document declares the annotation type, e.g. ``annotation:entity``
+    * ``valid`` or ``invalid`` - Validation status
+    """
+    conditions = []
+    parameters = []
+    for constraint in where.split(','):
+        constraint = constraint.strip()
+        if not constraint:
+            continue
+        if constraint in ('valid', 'invalid'):
+            conditions.append("valid = ?")
+            parameters.append(int(constraint == 'valid'))
+        elif constraint.startswith('annotation:'):
+            annotationtype, _, annotationset = constraint[len('annotation:'):].partition('@')
+            if annotationset:
+                conditions.append("EXISTS (SELECT 1 FROM annotations WHERE annotations.path = documents.path AND type = ? AND annotationset = ?)")
+                parameters += [annotationtype, annotationset]
+            else:
+                conditions.append("EXISTS (SELECT 1 FROM annotations WHERE annotations.path = documents.path AND type = ?)")
+                parameters.append(annotationtype)
+        else:
+            for symbol, sqloperator in (('>=','>='), ('<=','<='), ('==','='), ('!=','!='), ('>','>'), ('<','<')):
+                if symbol in constraint:
+                    tag, value = constraint.split(symbol)
+                    break
+            else:
+                tag, sqloperator, value = constraint, '>', 0
+            try:
+                value = int(value)
+            except ValueError:
+                raise ValueError("Invalid manifest constraint: " + constraint)
+            conditions.append("COALESCE((SELECT count FROM elements WHERE elements.path = documents.path AND tag = ?), 0) " + sqloperator + " ?")
+            parameters += [tag.strip(), value]
+    return " AND ".join(conditions) if conditions else "1", parameters
+
+def manifestfiles(filename, where=None):
+    """Returns the paths of the documents in a corpus manifest (as built by foliaindex) in sorted order, optionally only those matching the constraints (see manifestcondition())"""
+    if not os.path.isfile(filename):
+        raise FileNotFoundError("Manifest not found: " + filename)
+    db = openmanifest(filename)
+    condition, parameters = manifestcondition(where or "")
+    files = [ row[0] for row in db.execute("SELECT path FROM documents WHERE " + condition + " ORDER BY path", parameters) ]
+    db.close()
+    return files
+
+def findfiles(paths, extension='xml', recurse=False):
+    """Discovers the files to process for the specified paths: files are taken as they are, directories are scanned for files with the extension (in sorted order), descending into subdirectories if recurse is set. Raises FileNotFoundError for paths that do not exist"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += scandir(path, extension, recurse)
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            raise FileNotFoundError("File or directory not found: " + path)
+    return files
+
+def scandir(d, extension='xml', recurse=False):
+    """Returns all files in directory d with the extension, sorted by name, descending into subdirectories if recurse is set"""
+    files = []
+    with os.scandir(d) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    for entry in entries:
+        if entry.is_dir():
+            if recurse:
+                files += scandir(entry.path, extension, recurse)
+        elif entry.name.endswith('.' + extension):
+            files.append(entry.path)
+    return files
+
+
+_corpusworker = {}
+
+def spoolfile(suffix=''):
+    """Creates a new, empty temporary file and returns its path. In a worker of processcorpus() with spooling enabled, the file is created in the spool directory, which is cleaned up afterwards. For functions that hand large results back to the main process as files rather than in memory"""
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=_corpusworker.get('spooldir'))
+    os.close(fd)
+    return path
+
+def _callcorpusfunction(function, filename, args):
+    """Calls the function for a file, returns a (result, exception) tuple. A function that calls sys.exit() returns the SystemExit as its exception, so it does not take a worker process down with it"""
+    try:
+        return function(filename, *args), None
+    except (Exception, SystemExit) as e:
+        return None, e
+
+def _initcorpusworker(function, args, settings, values, initializer, initargs, spooldir=None, finalizer=None, barrier=None):
+    _corpusworker['function'] = function
+    _corpusworker['finalizer'] = finalizer
+    _corpusworker['barrier'] = barrier
+    _corpusworker['spooldir'] = spooldir
+    _corpusworker['ignoreerrors'] = values.get('ignoreerrors', False)
+    _corpusworker['args'] = args
+    if settings is not None:
+        for key, value in values.items():
+            setattr(settings, key, value)
+    if initializer is not None:
+        initializer(*initargs)
+    if barrier is not None:
+        #no file is processed before all workers are started, so all of them are there to take a finalization task later
+        barrier.wait()
+
+def _runcorpusworker(filename):
+    if _corpusworker['spooldir']:
+        stdout = io.open(spoolfile('.out'),'w',encoding='utf-8')
+    else:
+        stdout = io.StringIO()
+    stderr = io.StringIO()
+    begintime = time.time()
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        result, error = _callcorpusfunction(_corpusworker['function'], filename, _corpusworker['args'])
+        if error is not None and not _corpusworker['ignoreerrors'] and not isinstance(error, SystemExit):
+            traceback.print_exception(type(error), error, error.__traceback__)
+    if error is not None:
+        import pickle #already loaded by multiprocessing
+        try:
+            pickle.dumps(error)
+        except Exception:
+            #some exceptions (such as lxml's XMLSyntaxError) can not be sent back to the main process
+            error = Exception(error.__class__.__name__ + ": " + str(error))
+    if _corpusworker['spooldir']:
+        stdout.close()
+        out = stdout.name #the main process reads the output from the spool file
+    else:
+        out = stdout.getvalue()
+    return filename, result, error, out, stderr.getvalue(), time.time() - begintime
+
+def _finalizecorpusworker(_):
+    """Calls the finalizer in a worker process and returns its result. The worker then waits until all workers have called theirs, so it can not take a second finalization task"""
+    result = _corpusworker['finalizer']()
+    _corpusworker['barrier'].wait()
+    return result
+
+def boundedmap(executor, function, iterable, window, ordered=True):
+    """Submits function(item) for all items to the executor, with at most window tasks in flight, and yields the results in the order of the items if ordered is set, or as soon as they are done otherwise. Results that complete out of order wait in a reorder buffer of at most window entries, so memory stays bounded regardless of the number of tasks. If a worker process dies, this raises BrokenProcessPool rather than waiting forever"""
+    import concurrent.futures
+    items = iter(iterable)
+    pending = collections.deque()
+    try:
+        while True:
+            for item in items:
+                pending.append(executor.submit(function, item))
+                if len(pending) >= window:
+                    break
+            if not pending:
+                break
+            if ordered:
+                future = pending.popleft()
+            else:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                future = next(future for future in pending if future in done)
+                pending.remove(future)
+            yield future.result()
+    finally:
+        #when stopped early (an error), do not start the tasks that are still waiting
+        for future in pending:
+            future.cancel()
+
+def processcorpus(function, files, settings=None, args=(), ordered=True, outputfile=None, initializer=None, initargs=(), window=None, spool=False, finalizer=None):
+    """Shared corpus driver: calls function(filename, *args) for each of the files and yields (filename, result) tuples.
+
+    If settings.jobs > 1, files are processed in a pool of worker processes; the attributes of the settings class are copied to the workers first and the initializer (if any) is called once per worker. Everything the function prints is captured in the workers and replayed in the main process, in the order of the input files if ordered is set (results are yielded in the same order), or as soon as a file is done otherwise. At most window files (default: four per job, never fewer than one per job) are in progress or waiting to be output at any time, so memory stays flat. A worker process that dies (for instance killed for running out of memory) raises BrokenProcessPool. With a single job, files are processed in the main process itself.
+
+    If spool is set, the workers write what they print to temporary files in a spool directory instead of passing it back in memory, and the main process copies those into the output in order; this keeps large outputs out of memory and out of the pipes between the processes. Functions can create their own files in the spool directory with spoolfile(). The spool directory is removed when done.
+
+    If a finalizer is passed, it is called (without arguments) once in every worker process, after all files are done, and its results are yielded as (None, result) tuples after those of the files. This lets functions accumulate their results per process rather than return them per file. With a single job, it is called once in the main process.
+
+    Anything the function prints to stdout goes to the outputfile (an open file) if one is passed. An exception raised for a file is reported and, if settings.ignoreerrors is set, the file is skipped (yielding None as result), otherwise the exception is raised. A function that calls sys.exit() always ends the run, with its exit status, also in a worker process. If settings.progress is set, progress and the time spent on each file are reported on stderr."""
+    jobs = min(getattr(settings, 'jobs', 1), len(files)) #no more workers than files
+    ignoreerrors = getattr(settings, 'ignoreerrors', False)
+    progress = getattr(settings, 'progress', False)
+    errors = 0
+    begintime = time.time()
+
+    def report(i, filename, error, duration):
+        if error is not None and not isinstance(error, SystemExit):
+            print("ERROR: An exception was raised whilst processing " + filename + ": " + str(error), file=sys.stderr)
+        if progress:
+            print("[" + str(i+1) + "/" + str(len(files)) + "] " + filename + " (" + str(round(duration,3)) + "s)" + (" FAILED" if error is not None else ""), file=sys.stderr)
+
+    if jobs <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for i, filename in enumerate(files):
+            filebegintime = time.time()
+            with contextlib.redirect_stdout(outputfile) if outputfile else contextlib.nullcontext():
+                result, error = _callcorpusfunction(function, filename, args)
+            report(i, filename, error, time.time() - filebegintime)
+            if error is not None:
+                errors += 1
+                if not ignoreerrors or isinstance(error, SystemExit):
+                    raise error
+            yield filename, result
+        if finalizer is not None:
+            yield None, finalizer()
+    else:
+        import concurrent.futures #only needed when running in parallel
+        values = { key: value for key, value in vars(settings).items() if not key.startswith('_') } if settings is not None else {}
+        spooldir = tempfile.mkdtemp(prefix="foliatools") if spool else None
+        if finalizer is not None:
+            import multiprocessing
+            barrier = multiprocessing.Barrier(jobs)
+        else:
+            barrier = None
+        try:
+            with concurrent.futures.ProcessPoolExecutor(jobs, initializer=_initcorpusworker, initargs=(function, args, settings, values, initializer, initargs, spooldir, finalizer, barrier)) as executor, \
+                    contextlib.closing(boundedmap(executor, _runcorpusworker, files, max(window or 4 * jobs, jobs), ordered)) as results:
+                for i, (filename, result, error, out, err, duration) in enumerate(results):
+                    if spooldir:
+                        with io.open(out,'r',encoding='utf-8') as f:
+                            shutil.copyfileobj(f, outputfile or sys.stdout)
+                        os.unlink(out)
+                    elif out:
+                        (outputfile or sys.stdout).write(out)
+                    if err: sys.stderr.write(err)
+                    report(i, filename, error, duration)
+                    if error is not None:
+                        errors += 1
+                        if not ignoreerrors or isinstance(error, SystemExit):
+                            raise error
+                    yield filename, result
+                if finalizer is not None:
+                    #one finalization task per worker: a worker that took one waits for the others (see _finalizecorpusworker), so every worker takes exactly one
+                    for result in executor.map(_finalizecorpusworker, range(jobs)):
+                        yield None, result
+        finally:
+            if spooldir:
+                shutil.rmtree(spooldir, ignore_errors=True)
+
+    if progress:
+        print("Processed " + str(len(files)) + " file(s) in " + str(round(time.time() - begintime,3)) + "s using " + str(max(jobs,1)) + " process(es), " + str(errors) + " error(s)", file=sys.stderr)
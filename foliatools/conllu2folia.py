@@ -19,7 +19,6 @@ from __future__ import print_function, unicode_literals, division, absolute_impo
 import sys
 import os
 import argparse
-import conllu
 import traceback
 import folia.main as folia
 from foliatools import VERSION as TOOLVERSION
@@ -44,6 +43,7 @@ def main():
         convert(file, **args.__dict__)
 
 def convert(file, **args):
+    import conllu #only needed when converting, not for --help
     if args.get('id'):
         doc_id = makencname(args['id'])
     else:
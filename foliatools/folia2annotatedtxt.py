@@ -14,8 +14,10 @@ import getopt
 import io
 import sys
 import os
-import glob
 import folia.main as folia
+from foliatools.common import findfiles, processcorpus
+
+COLUMNS = ('id', 'text', 'n', 'N', 'pos', 'poshead', 'lemma', 'sense', 'phon', 'senid', 'parid')
 
 def usage():
     print("folia2annotatedtxt", file=sys.stderr)
@@ -51,21 +53,26 @@ def usage():
     print("  -O                           Output each file to similarly named .txt file", file=sys.stderr)
     print("  -P                           Like -O, but outputs to current working directory", file=sys.stderr)
     print("  -q                           Ignore errors", file=sys.stderr)
+    print("  -j [n]                       Number of parallel processes to use (default: 1)", file=sys.stderr)
+    print("  --progress                   Report progress and the processing time per file", file=sys.stderr)
 
 class settings:
     output_header = True
     outputfile = None
     ignoreerrors = False
     autooutput = False
+    autooutput_cwd = False
     extension = 'xml'
     recurse = False
     encoding = 'utf-8'
     sentenceperline = False
     columnconf = []
+    jobs = 1
+    progress = False
 
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "o:OPhHSc:x:E:rq", ["help", "csv"])
+        opts, args = getopt.getopt(sys.argv[1:], "o:OPhHSc:x:E:rqj:", ["help", "csv", "progress"])
     except getopt.GetoptError as err:
         print(str(err), file=sys.stderr)
         usage()
@@ -99,6 +106,10 @@ def main():
             settings.ignoreerrors = True
         elif o == '-S':
             settings.sentenceperline = True
+        elif o == '-j':
+            settings.jobs = int(a)
+        elif o == '--progress':
+            settings.progress = True
         else:
             raise Exception("No such option: " + o)
 
@@ -107,17 +118,20 @@ def main():
         usage()
         sys.exit(2)
 
+    for c in settings.columnconf:
+        if c and c not in COLUMNS:
+            print("ERROR: Unsupported configuration: " + c, file=sys.stderr)
+            sys.exit(2)
 
     if args:
+        try:
+            files = findfiles(args, settings.extension, settings.recurse)
+        except FileNotFoundError as e:
+            print("ERROR: " + str(e), file=sys.stderr)
+            sys.exit(3)
         if outputfile: outputfile = io.open(outputfile,'w',encoding=settings.encoding)
-        for x in args:
-            if os.path.isdir(x):
-                processdir(x,outputfile)
-            elif os.path.isfile(x):
-                process(x, outputfile)
-            else:
-                print("ERROR: File or directory not found: " + x, file=sys.stderr)
-                sys.exit(3)
+        for _ in processcorpus(process, files, settings, ordered=not settings.autooutput, outputfile=outputfile):
+            pass
         if outputfile: outputfile.close()
     else:
         print("ERROR: Nothing to do, specify one or more files or directories", file=sys.stderr)
@@ -132,14 +146,6 @@ def resize(s, i, spacing):
     #print '[' + s + ']', len(s), spacing[i]
     return s
 
-def processdir(d, outputfile = None):
-    print("Searching in  " + d, file=sys.stderr)
-    for f in glob.glob(os.path.join(d ,'*')):
-        if f[-len(settings.extension) - 1:] == '.' + settings.extension:
-            process(f, outputfile)
-        elif settings.recurse and os.path.isdir(f):
-            processdir(f, outputfile)
-
 def process(filename, outputfile=None):
     try:
         print("Processing " + filename, file=sys.stderr)
@@ -152,7 +158,7 @@ def process(filename, outputfile=None):
             if filename[-len(settings.extension) - 1:].lower() == '.' +settings.extension:
                 outfilename = filename[:-len(settings.extension) - 1] + ext
             else:
-                outfilename += ext
+                outfilename = filename + ext
             if settings.autooutput_cwd:
                 outfilename = os.path.basename(outfilename)
 
@@ -3,7 +3,7 @@
 
 """
 This convertor reads a FoLiA XML document and produces a
-simple columned output format (supports CSV,TSV) in which each token appears on one
+simple columned output format (supports CSV, TSV, Apache Arrow and Parquet) in which each token appears on one
 line. Note that only simple token annotations are supported and a lot
 of FoLiA data can not be intuitively expressed in a simple columned format!
 """
@@ -14,8 +14,8 @@ import getopt
 import io
 import sys
 import os
-import glob
 import folia.main as folia
+from foliatools.common import findfiles, processcorpus, spoolfile
 
 def usage():
     print("folia2columns", file=sys.stderr)
@@ -35,7 +35,7 @@ def usage():
     print("                               poshead - output PoS annotation head feature", file=sys.stderr)
     print("                               lemma   - output lemma annotation class", file=sys.stderr)
     print("                               sense   - output sense annotation class", file=sys.stderr)
-    print("                               phon    - output phonetic annotation class", file=sys.stderr)
+    print("                               phon    - output phonetic content", file=sys.stderr)
     print("                               senid   - output sentence ID", file=sys.stderr)
     print("                               parid   - output paragraph ID", file=sys.stderr)
     print("                               N     - word/token number (absolute)", file=sys.stderr)
@@ -46,8 +46,11 @@ def usage():
     print("                               paragraph - output paragraphs", file=sys.stderr)
     print("Options:", file=sys.stderr)
     print("  --csv                        Output in CSV format", file=sys.stderr)
+    print("  --arrow                      Output in Apache Arrow IPC format, with typed columns and nulls for missing annotations (requires pyarrow and -o or -O)", file=sys.stderr)
+    print("  --parquet                    Output in Parquet format, with typed columns and nulls for missing annotations (requires pyarrow and -o or -O)", file=sys.stderr)
+    print("  --rowgroup [rows]            Number of rows per batch (row group) in Arrow or Parquet output (default: 65536)", file=sys.stderr)
     print("  -o [filename]                Output to a single output file instead of stdout", file=sys.stderr)
-    print("  -O                           Output each file to similarly named file (.columns or .csv)", file=sys.stderr)
+    print("  -O                           Output each file to similarly named file (.columns, .csv, .arrow or .parquet)", file=sys.stderr)
     print("  -e [encoding]                Output encoding (default: utf-8)", file=sys.stderr)
     print("  -H                           Suppress header output", file=sys.stderr)
     print("  -S                           Suppress sentence spacing  (no whitespace between sentences)", file=sys.stderr)
@@ -59,25 +62,33 @@ def usage():
     print("  -O                           Output each file to similarly named .txt file", file=sys.stderr)
     print("  -P                           Like -O, but outputs to current working directory", file=sys.stderr)
     print("  -q                           Ignore errors", file=sys.stderr)
+    print("  -j [n], --jobs [n]           Number of parallel processes to use (default: 1). With -o, each process writes its output", file=sys.stderr)
+    print("                               to temporary files that are concatenated in input order (with the header written once)", file=sys.stderr)
+    print("  --progress                   Report progress and the processing time per file", file=sys.stderr)
 
 class settings:
     output_header = True
     csv = False
+    columnar = None #arrow or parquet
+    rowgroupsize = 65536
     outputfile = None
     sentencespacing = True
     ignoreerrors = False
     nicespacing = 0
     autooutput = False
+    autooutput_cwd = False
     extension = 'xml'
     recurse = False
     encoding = 'utf-8'
     columnconf = []
     unit = "word"
     tok = False
+    jobs = 1
+    progress = False
 
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "o:OPhHSc:x:E:rqu:t", ["help", "csv"])
+        opts, args = getopt.getopt(sys.argv[1:], "o:OPhHSc:x:E:rqu:tj:", ["help", "csv", "arrow", "parquet", "rowgroup=", "jobs=", "progress"])
     except getopt.GetoptError as err:
         print(str(err), file=sys.stderr)
         usage()
@@ -122,8 +133,18 @@ def main():
             settings.recurse = True
         elif o == '-q':
             settings.ignoreerrors = True
+        elif o == '-j' or o == '--jobs':
+            settings.jobs = int(a)
+        elif o == '--progress':
+            settings.progress = True
         elif o == '--csv':
             settings.csv = True
+        elif o == '--arrow':
+            settings.columnar = 'arrow'
+        elif o == '--parquet':
+            settings.columnar = 'parquet'
+        elif o == '--rowgroup':
+            settings.rowgroupsize = int(a)
         else:
             raise Exception("No such option: " + o)
 
@@ -132,17 +153,44 @@ def main():
         usage()
         sys.exit(2)
 
+    c = unsupportedcolumn(settings.columnconf, settings.unit)
+    if c is not None:
+        print("ERROR: Unsupported configuration: " + c, file=sys.stderr)
+        sys.exit(2)
+
+    if settings.columnar:
+        try:
+            import pyarrow
+        except ImportError:
+            print("ERROR: Arrow and Parquet output require pyarrow (pip install pyarrow)", file=sys.stderr)
+            sys.exit(2)
+        if not outputfile and not settings.autooutput:
+            print("ERROR: Arrow and Parquet output can not be written to stdout, use -o or -O", file=sys.stderr)
+            sys.exit(2)
 
     if args:
-        if outputfile: outputfile = io.open(outputfile,'w',encoding=settings.encoding)
-        for x in args:
-            if os.path.isdir(x):
-                processdir(x,outputfile)
-            elif os.path.isfile(x):
-                process(x, outputfile)
+        try:
+            files = findfiles(args, settings.extension, settings.recurse)
+        except FileNotFoundError as e:
+            print("ERROR: " + str(e), file=sys.stderr)
+            sys.exit(3)
+        writer = None
+        if outputfile:
+            settings.outputfile = outputfile
+            if settings.columnar and not settings.autooutput:
+                writer = ColumnWriter(outputfile, settings.columnconf, settings.columnar, settings.rowgroupsize)
+                outputfile = None
             else:
-                print("ERROR: File or directory not found: " + x, file=sys.stderr)
-                sys.exit(3)
+                outputfile = io.open(outputfile,'w',encoding=settings.encoding)
+                if settings.output_header and not settings.autooutput:
+                    outputfile.write(header(getspacing()) + '\n')
+        for _, result in processcorpus(process, files, settings, ordered=not settings.autooutput, outputfile=outputfile, spool=bool(settings.outputfile) and not settings.autooutput):
+            if writer and isinstance(result, str):
+                writer.extendfile(result)
+                os.unlink(result)
+            elif writer and result:
+                writer.extend(result)
+        if writer: writer.close()
         if outputfile: outputfile.close()
     else:
         print ("ERROR: Nothing to do, specify one or more files or directories", file=sys.stderr)
@@ -157,64 +205,267 @@ def resize(s, i, spacing):
     #print '[' + s + ']', len(s), spacing[i]
     return s
 
-def processdir(d, outputfile = None, i = 0):
-    print("Searching in  " + d, file=sys.stderr)
-    for f in glob.glob(os.path.join(d, '*')):
-        if f[-len(settings.extension) - 1:] == '.' + settings.extension:
-            process(f, outputfile, i)
-            i = i + 1
-        elif settings.recurse and os.path.isdir(f):
-            i = processdir(f, outputfile, i)
+def getspacing():
+    """Returns the width of each column if nice spacing is enabled (None otherwise)"""
+    if settings.nicespacing:
+        spacing = []
+        for c in settings.columnconf:
+            if c == 'n':
+                spacing.append(3)
+            elif c == 'N':
+                spacing.append(7)
+            elif c == 'poshead':
+                spacing.append(5)
+            else:
+                spacing.append(settings.nicespacing)
+        return spacing
+    return None
+
+def header(spacing=None):
+    """Returns the header line"""
+    if settings.csv:
+        columns = [ '"' + x.upper()  + '"' for x in settings.columnconf ]
+    else:
+        columns = [ x.upper()  for x in settings.columnconf ]
+
+    if settings.nicespacing and not settings.csv:
+        columns = [ resize(x, i, spacing) for i, x in enumerate(settings.columnconf) ]
 
-def process(filename, outputfile=None, filesProcessed=0):
+    if settings.csv:
+        return ','.join(columns)
+    else:
+        return '\t'.join(columns)
+
+class ColumnWriter:
+    """Writes the columns to an Apache Arrow IPC file or a Parquet file, in batches (row groups) of typed columns. Values that are None are written as nulls. Requires pyarrow"""
+
+    def __init__(self, filename, columns, fileformat='arrow', rowgroupsize=65536):
+        import pyarrow
+        import pyarrow.ipc
+        if fileformat == 'parquet':
+            import pyarrow.parquet
+        self.pyarrow = pyarrow
+        self.columns = columns
+        self.schema = pyarrow.schema([ (c, pyarrow.int64() if c in ('N','n') else pyarrow.string()) for c in columns ])
+        self.rowgroupsize = rowgroupsize
+        if fileformat == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema)
+        else:
+            self.writer = pyarrow.ipc.new_file(filename, self.schema)
+        self.parquet = fileformat == 'parquet'
+        self.pending = [] #record batches not written yet
+        self.rows = 0
+
+    def append(self, batch):
+        """Adds a record batch, writes full batches (row groups) whenever enough rows have accumulated"""
+        if batch.num_rows:
+            self.pending.append(batch)
+            self.rows += batch.num_rows
+        if self.rows >= self.rowgroupsize:
+            self.flush()
+
+    def extend(self, buffers):
+        """Adds rows, passed as one list of values per column"""
+        self.append(self.pyarrow.record_batch([ self.pyarrow.array(buffer, type=field.type) for buffer, field in zip(buffers, self.schema) ], schema=self.schema))
+
+    def extendfile(self, filename):
+        """Adds all rows from an Arrow IPC file as written by another ColumnWriter with the same columns"""
+        with self.pyarrow.ipc.open_file(filename) as reader:
+            for i in range(0, reader.num_record_batches):
+                self.append(reader.get_batch(i))
+
+    def flush(self, final=False):
+        """Writes the pending rows in batches of the row group size, the remainder is kept pending unless this is the final flush"""
+        table = self.pyarrow.Table.from_batches(self.pending, schema=self.schema)
+        begin = 0
+        while self.rows - begin >= self.rowgroupsize or (final and begin < self.rows):
+            length = min(self.rowgroupsize, self.rows - begin)
+            batch = table.slice(begin, length).combine_chunks().to_batches()[0]
+            if self.parquet:
+                self.writer.write_table(self.pyarrow.Table.from_batches([batch]))
+            else:
+                self.writer.write_batch(batch)
+            begin += length
+        self.pending = table.slice(begin).to_batches() if begin < self.rows else []
+        self.rows -= begin
+
+    def close(self):
+        self.flush(final=True)
+        self.writer.close()
+
+
+#columns holding the class (or a feature) of an inline annotation on the words
+ANNOTATIONCOLUMNS = {
+    'pos': folia.PosAnnotation,
+    'poshead': folia.PosAnnotation,
+    'lemma': folia.LemmaAnnotation,
+    'sense': folia.SenseAnnotation,
+}
+
+#all supported columns, senid only for word units and parid not for paragraph units
+COLUMNS = ('id', 'text', 'n', 'N', 'pos', 'poshead', 'lemma', 'sense', 'phon', 'senid', 'parid')
+
+def unsupportedcolumn(columns, unit):
+    """Returns the first column that is not supported for the unit, None if all are"""
+    for c in columns:
+        if c and (c not in COLUMNS or (c == 'senid' and unit != 'word') or (c == 'parid' and unit == 'paragraph')):
+            return c
+    return None
+
+#elements that never contain any paragraphs, sentences or words
+LEAVES = (folia.Word, folia.TextContent, folia.PhonContent, folia.AbstractInlineAnnotation)
+
+def walk(element, Class, ignore, paragraph=None, sentence=None):
+    """Yields (unit, paragraph, sentence) tuples for all elements of the given class under element, in document order. The paragraph and sentence each unit is in are tracked on the way down instead of looked up for each unit. Descends like element.select(Class, ignore=ignore) does, ignore is either a tuple of classes or True to skip non-authoritative elements"""
+    for e in element.data:
+        if not isinstance(e, folia.AbstractElement):
+            continue
+        if ignore is True:
+            if not getattr(e, 'auth', True): continue
+        elif isinstance(e, ignore):
+            continue
+        if isinstance(e, Class):
+            yield e, paragraph, sentence
+        if isinstance(e, LEAVES):
+            continue
+        for x in walk(e, Class, ignore, e if isinstance(e, folia.Paragraph) else paragraph, e if isinstance(e, folia.Sentence) else sentence):
+            yield x
+
+def getunits(doc):
+    """Yields (unit, paragraph, sentence) tuples for all units of the configured type in the document"""
+    if settings.unit == "sentence":
+        Class, ignore = folia.Sentence, (folia.Quote,) #like doc.sentences()
+    elif settings.unit == "paragraph":
+        Class, ignore = folia.Paragraph, True #like doc.paragraphs()
+    else:
+        Class, ignore = folia.Word, folia.default_ignore_structure #like doc.words()
+    for body in doc.data:
+        for x in walk(body, Class, ignore):
+            yield x
+
+def inlineannotations(word, classes):
+    """Returns a dictionary mapping each of the annotation classes to the first such annotation on the word (as word.annotation() would), found in a single pass over the word's descendants"""
+    found = {}
+    stack = [ iter(word.data) ]
+    while stack:
+        e = next(stack[-1], stack)
+        if e is stack: #exhausted
+            stack.pop()
+            continue
+        if not isinstance(e, folia.AbstractElement) or isinstance(e, folia.default_ignore_annotations):
+            continue
+        for Class in classes:
+            if Class not in found and isinstance(e, Class):
+                found[Class] = e
+        if len(found) == len(classes):
+            break
+        if e.data and not isinstance(e, folia.TextContent):
+            stack.append(iter(e.data))
+    return found
+
+def annotationvalue(c, annotation):
+    """Returns the value for column c from the annotation, None if there is none"""
+    if annotation is None:
+        return None
+    if c == 'poshead':
+        try:
+            return annotation.feat('head')
+        except folia.NoSuchAnnotation:
+            return None
+    return annotation.cls
+
+def phon(word):
+    """Returns the phonetic content of the word, None if there is none"""
+    try:
+        return word.phon()
+    except folia.NoSuchPhon:
+        return None
+
+def getvalues(w, i, wordnum, paragraph, sentence, classes):
+    """Returns the values of the configured columns for unit w (the i-th unit in the document, the wordnum-th word in its sentence), None for missing annotations. Classes are the annotation classes needed for the configured columns"""
+    if settings.unit != "word" and (classes or settings.tok or 'phon' in settings.columnconf):
+        words = list(w.words())
+    if classes:
+        if settings.unit == "word":
+            annotations = inlineannotations(w, classes)
+        else:
+            annotations = [ inlineannotations(word, classes) for word in words ]
+    values = []
+    for c in settings.columnconf:
+        if c == 'id':
+            values.append(w.id)
+        elif c == 'text':
+            if settings.unit != "word" and settings.tok:
+                values.append(' '.join(word.text() for word in words) or None)
+            else:
+                values.append(w.text())
+        elif c == 'n':
+            values.append(wordnum)
+        elif c == 'N':
+            values.append(i+1)
+        elif c in ANNOTATIONCOLUMNS:
+            if settings.unit == "word":
+                values.append(annotationvalue(c, annotations.get(ANNOTATIONCOLUMNS[c])))
+            else:
+                classespar = [ annotationvalue(c, wordannotations.get(ANNOTATIONCOLUMNS[c])) for wordannotations in annotations ]
+                values.append(' '.join(x for x in classespar if x is not None) or None)
+        elif c == 'phon':
+            if settings.unit == "word":
+                values.append(phon(w))
+            else:
+                values.append(' '.join(x for x in (phon(word) for word in words) if x is not None) or None)
+        elif c == 'senid' and settings.unit == "word":
+            values.append(sentence.id if sentence is not None else None)
+        elif c == 'parid' and (settings.unit == "word" or settings.unit == "sentence"):
+            values.append(paragraph.id if paragraph is not None else None)
+        elif c:
+            print("ERROR: Unsupported configuration: " + c, file=sys.stderr)
+            sys.exit(1)
+    return values
+
+def formatline(values, spacing=None):
+    """Formats the values of one row as a line of text (TSV or CSV)"""
+    columns = [ '-' if x is None else str(x) for x in values ]
+
+    if settings.nicespacing and not settings.csv:
+        columns = [ resize(x,j, spacing) for j,x  in enumerate(columns) ]
+
+    if settings.csv:
+        return ",".join([ '"' + x  + '"' for x in columns ])
+    else:
+        return "\t".join(columns)
+
+def process(filename, outputfile=None):
+    """Converts a single document. If columnar output to a single file is requested, that file is written by main() and this returns the columns (a list of values per column), or, when running in parallel, the path of a temporary Arrow file holding them"""
     try:
         print("Processing " + filename, file=sys.stderr)
         doc = folia.Document(file=filename)
         prevsen = None
 
         if settings.autooutput:
-            if settings.csv:
+            if settings.columnar:
+                ext = '.' + settings.columnar
+            elif settings.csv:
                 ext = '.csv'
             else:
                 ext = '.columns'
             if filename[-len(settings.extension) - 1:].lower() == '.' +settings.extension:
                 outfilename = filename[:-len(settings.extension) - 1] + ext
             else:
-                outfilename += ext
+                outfilename = filename + ext
             if settings.autooutput_cwd:
                 outfilename = os.path.basename(outfilename)
 
             print(" Saving as " + outfilename, file=sys.stderr)
-            outputfile = io.open(outfilename,'w',encoding=settings.encoding)
-
-
-        if settings.nicespacing:
-            spacing = []
-            for c in settings.columnconf:
-                if c == 'n':
-                    spacing.append(3)
-                elif c == 'N':
-                    spacing.append(7)
-                elif c == 'poshead':
-                    spacing.append(5)
-                else:
-                    spacing.append(settings.nicespacing)
+            if not settings.columnar:
+                outputfile = io.open(outfilename,'w',encoding=settings.encoding)
 
-        if settings.output_header and not(outputfile and filesProcessed > 0): #avoid continuously reprinting header when printing multiple files to single file
-
-            if settings.csv:
-                columns = [ '"' + x.upper()  + '"' for x in settings.columnconf ]
-            else:
-                columns = [ x.upper()  for x in settings.columnconf ]
-
-            if settings.nicespacing and not settings.csv:
-                columns = [ resize(x, i, spacing) for i, x in enumerate(settings.columnconf) ]
-
-            if settings.csv:
-                line = ','.join(columns)
-            else:
-                line = '\t'.join(columns)
+        spacing = getspacing()
 
+        if settings.columnar:
+            buffers = [ [] for _ in settings.columnconf ]
+        elif settings.output_header and (settings.autooutput or not settings.outputfile): #with a single output file, the header is written only once, by main()
+            line = header(spacing)
             if outputfile:
                 outputfile.write(line)
                 outputfile.write('\n')
@@ -225,153 +476,28 @@ def process(filename, outputfile=None, filesProcessed=0):
                     print(line)
 
         wordnum = 0
+        classes = tuple(set(ANNOTATIONCOLUMNS[c] for c in settings.columnconf if c in ANNOTATIONCOLUMNS))
 
-        def getunitfromdoc():
+        for i, (w, paragraph, sentence) in enumerate(getunits(doc)):
             if settings.unit == "word":
-                return doc.words()
-            elif settings.unit == "sentence":
-                return doc.sentences()
-            elif settings.unit == "paragraph":
-                return doc.paragraphs()
-            else:
-                return doc.words()
-
-        for i, w in enumerate(getunitfromdoc()):
-            if settings.unit == "word":
-                if w.sentence() != prevsen and i > 0:
-                    if settings.sentencespacing:
+                if sentence is not prevsen and i > 0:
+                    if settings.sentencespacing and not settings.columnar:
                         if outputfile:
                             outputfile.write('\n')
                         else:
                             print()
                     wordnum = 0
-                prevsen = w.sentence()
+                prevsen = sentence
                 wordnum += 1
-            columns = []
-            for c in settings.columnconf:
-                if c == 'id':
-                    columns.append(w.id)
-                elif c == 'text':
-                    if settings.unit == "word":
-                        columns.append(w.text())
-                    else:
-                        if settings.tok:
-                            wordspar = []
-                            for j, word in enumerate(w.words()):
-                                wordspar.append(word.text())
-                            if wordspar:
-                                columns.append(' '.join(wordspar))
-                        else:
-                            columns.append(w.text())
-                elif c == 'n':
-                    columns.append(str(wordnum))
-                elif c == 'N':
-                    columns.append(str(i+1))
-                elif c == 'pos':
-                    if settings.unit == "paragraph" or settings.unit == "sentence":
-                        pospar = []
-                        for j, word in enumerate(w.words()):
-                            try:
-                                pospar.append(word.annotation(folia.LemmaAnnotation).cls)
-                            except:
-                                pass
-                        if pospar:
-                            columns.append(' '.join(pospar))
-                        else:
-                            columns.append('-')
-                    else:
-                        try:
-                            columns.append(w.annotation(folia.PosAnnotation).cls)
-                        except:
-                            columns.append('-')
-                elif c == 'poshead':
-                    if settings.unit == "paragraph" or settings.unit == "sentence":
-                        posheadpar = []
-                        for j, word in enumerate(w.words()):
-                            try:
-                                posheadpar.append(word.annotation(folia.LemmaAnnotation).cls)
-                            except:
-                                pass
-                        if posheadpar:
-                            columns.append(' '.join(posheadpar))
-                        else:
-                            columns.append('-')
-                    else:
-                        try:
-                            columns.append(w.annotation(folia.PosAnnotation).feat('head'))
-                        except:
-                            columns.append('-')
-                elif c == 'lemma':
-                    if settings.unit == "paragraph" or settings.unit == "sentence":
-                        lemmapar = []
-                        for j, word in enumerate(w.words()):
-                            try:
-                                lemmapar.append(word.annotation(folia.LemmaAnnotation).cls)
-                            except:
-                                pass
-                        if lemmapar:
-                            columns.append(' '.join(lemmapar))
-                        else:
-                            columns.append('-')
-                        
-                    else:
-                        try:
-                            columns.append(w.annotation(folia.LemmaAnnotation).cls)
-                        except:
-                            columns.append('-')
-                elif c == 'sense':
-                    if settings.unit == "paragraph" or settings.unit == "sentence":
-                        sensepar = []
-                        for j, word in enumerate(w.words()):
-                            try:
-                                sensepar.append(word.annotation(folia.LemmaAnnotation).cls)
-                            except:
-                                pass
-                        if sensepar:
-                            columns.append(' '.join(sensepar))
-                        else:
-                            columns.append('-')
-                    else:
-                        try:
-                            columns.append(w.annotation(folia.SenseAnnotation).cls)
-                        except:
-                            columns.append('-')
-                elif c == 'phon':
-                    if settings.unit == "paragraph" or settings.unit == "sentence":
-                        phonpar = []
-                        for j, word in enumerate(w.words()):
-                            try:
-                                phonpar.append(word.annotation(folia.LemmaAnnotation).cls)
-                            except:
-                                pass
-                        if phonpar:
-                            columns.append(' '.join(phonpar))
-                        else:
-                            columns.append('-')
-                    else:
-                        try:
-                            columns.append(w.annotation(folia.PhonAnnotation).cls)
-                        except:
-                            columns.append('-')
-                elif c == 'senid' and settings.unit == "word":
-                    columns.append(w.sentence().id)
-                elif c == 'parid' and (settings.unit == "word" or settings.unit == "sentence"):
-                    try:
-                        columns.append(w.paragraph().id)
-                    except:
-                        columns.append('-')
-                elif c:
-                    print("ERROR: Unsupported configuration: " + c, file=sys.stderr)
-                    sys.exit(1)
-
-            if settings.nicespacing and not settings.csv:
-                columns = [ resize(x,j, spacing) for j,x  in enumerate(columns) ]
-
-            if settings.csv:
-                line = ",".join([ '"' + x  + '"' for x in columns ])
-            else:
-                line = "\t".join(columns)
 
+            values = getvalues(w, i, wordnum, paragraph, sentence, classes)
+
+            if settings.columnar:
+                for buffer, value in zip(buffers, values):
+                    buffer.append(value)
+                continue
+
+            line = formatline(values, spacing)
             if outputfile:
                 outputfile.write(line)
                 outputfile.write('\n')
@@ -381,7 +507,20 @@ def process(filename, outputfile=None, filesProcessed=0):
                 else:
                     print(line)
 
-        if settings.autooutput:
+        if settings.columnar:
+            if settings.autooutput:
+                writer = ColumnWriter(outfilename, settings.columnconf, settings.columnar, settings.rowgroupsize)
+            elif settings.jobs > 1:
+                #hand the columns back to the main process as a temporary Arrow file
+                outfilename = spoolfile('.arrow')
+                writer = ColumnWriter(outfilename, settings.columnconf, 'arrow', settings.rowgroupsize)
+            else:
+                return buffers
+            writer.extend(buffers)
+            writer.close()
+            if not settings.autooutput:
+                return outfilename
+        elif settings.autooutput:
             outputfile.close()
         elif outputfile:
             outputfile.flush()
@@ -2,14 +2,18 @@
 
 """FoLiA to STAM conversion"""
 
+from __future__ import annotations #the type annotations refer to stam, which is only imported when something is converted
+
 import sys
 import os
 import argparse
 import glob
 from foliatools import VERSION as TOOLVERSION
-from typing import Generator
+from typing import Generator, TYPE_CHECKING
 import folia.main as folia
-import stam
+
+if TYPE_CHECKING:
+    import stam
 
 #Namespace for STAM annotationset and for RDF, not the same as XML namepace because that one is very old and hard to resolve
 FOLIA_NAMESPACE = "https://w3id.org/folia/v2/"
@@ -26,6 +30,7 @@ def processdir(d, annotationstore: stam.AnnotationStore, **kwargs):
 
 def convert(f, annotationstore: stam.AnnotationStore,  **kwargs):
     """Convert a FoLiA document to STAM"""
+    import stam
     doc = folia.Document(file=f)
     if not doc.declared(folia.AnnotationType.TOKEN):
         raise Exception("Only tokenized documents can be handled at the moment")
@@ -68,6 +73,7 @@ def convert(f, annotationstore: stam.AnnotationStore,  **kwargs):
 
 def convert_tokens(doc: folia.Document, annotationstore: stam.AnnotationStore, **kwargs) -> stam.TextResource:
     """Convert FoLiA tokens (w) and text content to STAM. Returns a STAM resource"""
+    import stam
     tokens = []
 
     text = ""
@@ -268,6 +274,7 @@ def convert_tokens(doc: folia.Document, annotationstore: stam.AnnotationStore, *
 
 def convert_inline_annotation(word: folia.Word, word_stam: stam.Annotation, annotationstore: stam.AnnotationStore, **kwargs):
     """Convert FoLiA inline annotations to STAM."""
+    import stam
 
 
     #create an AnnotationSelector to the token
@@ -298,6 +305,7 @@ def convert_structure_annotation(doc: folia.Document, annotationstore: stam.Anno
     """Convert FoLiA structure annotations (sentences, paragraphs, etc) to STAM
     In this conversion the structure annotations directly reference the underlying text, rather than other underlying structural elements like FoLiA does.
     """
+    import stam
 
     #Create spans and text relations for all structure elements
     for structure in doc.select(folia.AbstractStructureElement):
@@ -326,6 +334,7 @@ def convert_span_annotation(doc: folia.Document, annotationstore: stam.Annotatio
     In this conversion the span annotations may either directly reference the underlying text, 
     or point to the tokens, depending on the setting for span-annotations-mode.
     """
+    import stam
 
     for span in doc.select(folia.AbstractSpanAnnotation):
         #if not isinstance(span, (folia.AbstractSpanRole, folia.SyntacticUnit)) and  not any((isinstance(x, folia.AbstractSpanRole) for x in span.ACCEPTED_DATA)):
@@ -547,6 +556,7 @@ def main():
     args.__dict__['span_annotations_mode'] = args.__dict__['span_annotations_mode'].lower()
     assert args.__dict__['span_annotations_mode'] in ("annotationselector","textselector")
 
+    import stam #optional dependency, not needed for --help
     annotationstore = stam.AnnotationStore(id=args.id)
     filename = os.path.join(args.outputdir, args.id + ".store.stam.json")
     annotationstore.set_filename(filename)
@@ -13,8 +13,10 @@ import getopt
 import io
 import sys
 import os
-import glob
+import unicodedata
+import lxml.etree
 import folia.main as folia
+from foliatools.common import manifestfiles, findfiles, processcorpus
 
 def usage():
     print("folia2txt",file=sys.stderr)
@@ -39,12 +41,21 @@ def usage():
     print("  -p                           One paragraph per line",file=sys.stderr)
     print("  -o [filename]                Output to a single file (instead of default stdout)",file=sys.stderr)
     print("  -e [encoding]                Output encoding (default: utf-8)",file=sys.stderr)
+    print("  --stream                     Extract the text whilst reading the document, without loading it in memory as a whole,",file=sys.stderr)
+    print("                               for huge documents. Follows the text semantics of the full mode for all common cases",file=sys.stderr)
     print("Parameters for processing directories:",file=sys.stderr)
     print("  -r                           Process recursively",file=sys.stderr)
     print("  -E [extension]               Set extension (default: xml)",file=sys.stderr)
     print("  -O                           Output each file to similarly named .txt file",file=sys.stderr)
     print("  -P                           Like -O, but outputs to current working directory",file=sys.stderr)
     print("  -q                           Ignore errors",file=sys.stderr)
+    print("  -j [n], --jobs [n]           Number of parallel processes to use (default: 1). With -O or -P, each process writes",file=sys.stderr)
+    print("                               its output files independently, otherwise the output is reassembled in input order",file=sys.stderr)
+    print("  --progress                   Report progress and the processing time per file",file=sys.stderr)
+    print("Parameters for selecting documents from a corpus manifest (see foliaindex):",file=sys.stderr)
+    print("  --manifest [file]            Process the documents in the manifest (in addition to any specified files)",file=sys.stderr)
+    print("  --where [constraints]        Only process the documents in the manifest that match the constraints,",file=sys.stderr)
+    print("                               e.g. annotation:entity,w>10000 (see foliaindex --help)",file=sys.stderr)
 
 def out(s, outputfile):
     if sys.version < '3':
@@ -58,24 +69,301 @@ def out(s, outputfile):
         else:
             print(s)
 
+NSPREFIX = '{' + folia.NSFOLIA + '}'
+NSLEN = len(NSPREFIX)
+XMLSPACE = '{http://www.w3.org/XML/1998/namespace}space'
+
+class TextFrame:
+    """State of an element that is currently open in the streaming text extractor (see streamtext())"""
+
+    __slots__ = ('Class','parent','textual','auth','unit','buffer','delimiter','nonempty','success','owntext','last','lastsignificant','preserve','corrections')
+
+    def __init__(self, Class, parent, textual, auth, preserve):
+        self.Class = Class
+        self.parent = parent
+        self.textual = textual #does this element contribute to the text of its parent?
+        self.auth = auth #is this element authoritative (i.e. not in an original, suggestion or alternative)?
+        self.unit = False #is this one of the units we output?
+        self.buffer = None #buffered text (for output units and the children of corrections)
+        self.delimiter = "" #delimiter of the last child that had text, output before the text of the next child
+        self.nonempty = False #has this element produced any text?
+        self.success = False #did this element produce text in the sense of folia's text() (i.e. no NoSuchText)?
+        self.owntext = None #the text content explicitly associated with the element, used when the children have no text
+        self.last = None #(Class, delimiter, space) of the last child element
+        self.lastsignificant = None #same, but disregarding annotation layers and inline annotations
+        self.preserve = preserve #xml:space="preserve"
+        self.corrections = None #(Class, text) for the new, current and original children of a correction
+
+
+def textcontainer(node, preserve):
+    """Returns the text of a <t> element (or of text markup within it), a port of folia's text() for text containers that works on the lxml node"""
+    s = ""
+    pendingspace = False
+    items = [node.text] if node.text else []
+    for child in node:
+        items.append(child)
+        if child.tail:
+            items.append(child.tail)
+    for e in items:
+        if isinstance(e, str):
+            if pendingspace:
+                s += " "
+                pendingspace = False
+            l = len(s)
+            for j, line in enumerate(e.split("\n")):
+                if preserve:
+                    s2 = unicodedata.normalize('NFC', line.strip("\r"))
+                else:
+                    s2 = unicodedata.normalize('NFC', folia.norm_spaces(line.strip(" \r")))
+                if j > 0 and s2 and len(s) != l:
+                    s += " "
+                elif s2 and line and (line[0] != "\n" and folia.is_space(line[0])) and not preserve:
+                    s += "\0"
+                s += s2
+            if e and folia.is_space(e[-1]) and s and not folia.is_space(s[-1]) and not preserve:
+                pendingspace = True
+        elif isinstance(e.tag, str) and e.tag.startswith(NSPREFIX) and e.tag[NSLEN:] in folia.XML2CLASS:
+            Class = folia.XML2CLASS[e.tag[NSLEN:]]
+            if not Class.PRINTABLE:
+                continue
+            if pendingspace:
+                if not Class.IMPLICITSPACE:
+                    s += " "
+                pendingspace = False
+            if Class is folia.Linebreak:
+                s += "\n"
+            elif Class is folia.TextMarkupHSpace:
+                s += " "
+            elif Class is folia.TextMarkupWhitespace:
+                s += "\n\n"
+            elif Class is not folia.Hyphbreak:
+                space = e.get(XMLSPACE)
+                s += textcontainer(e, preserve if space is None else space == 'preserve')
+    if preserve:
+        return s
+    else:
+        return folia.postprocess_spaces(s)
+
+
+def textdelimiter(frame, node, retaintokenisation):
+    """Returns the text delimiter for an element that has just been closed, a port of folia's gettextdelimiter()"""
+    Class = frame.Class
+    if Class is folia.Correction:
+        if frame.corrections:
+            for ChildClass, _, delimiter, _ in frame.corrections:
+                if ChildClass in (folia.New, folia.Current):
+                    return delimiter
+        return ""
+    elif Class is folia.TextContent:
+        return ""
+    elif Class is folia.Sentence:
+        if frame.lastsignificant:
+            ChildClass, delimiter, space = frame.lastsignificant
+            if ChildClass in (folia.Linebreak, folia.Whitespace):
+                return ""
+            elif issubclass(ChildClass, folia.Word) and not space:
+                return ""
+            elif issubclass(ChildClass, folia.AbstractStructureElement):
+                return delimiter
+        return Class.TEXTDELIMITER
+    elif Class is folia.Quote:
+        if frame.last:
+            ChildClass, delimiter, space = frame.last
+            return "" if ChildClass is folia.Sentence else delimiter
+        return Class.TEXTDELIMITER
+    elif Class.TEXTDELIMITER is None:
+        return frame.last[1] if frame.last else ""
+    elif folia.Attrib.SPACE in Class.OPTIONAL_ATTRIBS:
+        if node.get('space') != 'no' or retaintokenisation:
+            return Class.TEXTDELIMITER
+        return ""
+    else:
+        return Class.TEXTDELIMITER
+
+
+def streamtext(filename, unit=None, cls='current', retaintokenisation=False, correctionhandling=folia.CorrectionHandling.CURRENT):
+    """Extracts the text from a FoLiA document whilst reading it, without loading the whole document in memory.
+
+    If unit is set to a structure class (e.g. folia.Word, folia.Sentence, folia.Paragraph), this yields the text of each such element (like ``element.text()``, elements without text are skipped).
+    Otherwise it yields the text of the whole document in consecutive pieces (which, joined, correspond to ``doc.text()``).
+
+    Every element is freed as soon as it has been processed. The text semantics of the FoLiA library (text classes, detokenisation, correction handling, text delimiters) are followed, with the following known exceptions:
+    span annotations and tables without any text are not considered;
+    and nested units (e.g. a sentence in a quote in a sentence) are output before rather than after the unit that contains them.
+    """
+    output = []
+
+    def write(frame, text):
+        """Adds text to an element"""
+        if frame.buffer is not None:
+            frame.buffer.append(text)
+        elif frame.parent is None:
+            if unit is None:
+                output.append(text)
+        else:
+            receive(frame.parent, text, not frame.nonempty)
+        frame.nonempty = True
+
+    def receive(frame, text, first, strip=False):
+        """Receives text from a child element, the delimiter of the previous child is inserted before the first text of a child"""
+        if first:
+            text = (frame.delimiter.strip(' ') if strip else frame.delimiter) + text
+        if text:
+            write(frame, text)
+
+    root = TextFrame(None, None, True, True, False)
+    bodies = 0
+    stack = [root]
+    skip = 0 #depth inside elements we do not descend into (text content, foreign elements)
+    for event, node in lxml.etree.iterparse(filename, events=('start','end'), huge_tree=True):
+        if skip:
+            if event == 'start':
+                skip += 1
+                continue
+            else:
+                skip -= 1
+                if skip:
+                    continue
+        if event == 'start':
+            parent = stack[-1]
+            if len(stack) == 1:
+                #the FoLiA root element is represented by the root frame
+                stack.append(root)
+                continue
+            elif not node.tag.startswith(NSPREFIX) or node.tag[NSLEN:] not in folia.XML2CLASS:
+                #metadata, foreign elements
+                skip = 1
+                stack.append(None)
+                continue
+            Class = folia.XML2CLASS[node.tag[NSLEN:]]
+            if parent is root:
+                textual = Class in (folia.Text, folia.Speech)
+                if textual and bodies and root.nonempty:
+                    write(root, "\n\n\n")
+                bodies += textual
+            elif not parent.textual:
+                textual = False
+            elif parent.Class is folia.Correction:
+                textual = Class in (folia.New, folia.Current, folia.Original)
+            else:
+                textual = Class is folia.Correction or (issubclass(Class, folia.AbstractStructureElement) and Class.PRINTABLE and not Class.HIDDEN)
+            space = node.get(XMLSPACE)
+            frame = TextFrame(Class, parent, textual, parent.auth and Class not in folia.default_ignore, parent.preserve if space is None else space == 'preserve')
+            if textual:
+                if Class is unit and frame.auth:
+                    frame.unit = True
+                    frame.buffer = []
+                elif Class is folia.Correction:
+                    frame.corrections = []
+                elif parent.Class is folia.Correction:
+                    frame.buffer = []
+            elif Class is folia.TextContent:
+                skip = 1
+            stack.append(frame)
+        else:
+            frame = stack.pop()
+            if frame is None:
+                node.clear()
+                continue
+            elif frame is root:
+                continue
+            parent = frame.parent
+            if frame.Class is folia.TextContent:
+                if parent.textual and parent.owntext is None and node.get('class','current') == cls:
+                    parent.owntext = textcontainer(node, frame.preserve)
+            elif frame.textual:
+                if frame.Class is folia.Correction:
+                    text = None
+                    #(the text class 'original' implies the original text of corrections, for backward compatibility)
+                    handling = folia.CorrectionHandling.ORIGINAL if cls == 'original' else correctionhandling
+                    if handling in (folia.CorrectionHandling.CURRENT, folia.CorrectionHandling.EITHER):
+                        for ChildClass, childtext, _, owntext in frame.corrections:
+                            if ChildClass in (folia.New, folia.Current):
+                                text = childtext
+                                break
+                    if text is None and handling in (folia.CorrectionHandling.ORIGINAL, folia.CorrectionHandling.EITHER):
+                        for ChildClass, childtext, _, owntext in frame.corrections:
+                            if ChildClass is folia.Original:
+                                text = childtext
+                                break
+                    if text:
+                        write(frame, text)
+                    if text is not None and owntext is not None and parent.owntext is None:
+                        #the explicit text content of the corrected element is inherited by the parent
+                        parent.owntext = owntext
+                elif frame.Class is folia.Linebreak or frame.Class is folia.Whitespace:
+                    receive(parent, "\n" if frame.Class is folia.Linebreak else "\n\n", True, True)
+                    frame.nonempty = True
+                elif not frame.nonempty and frame.owntext:
+                    write(frame, frame.owntext)
+                if frame.nonempty:
+                    frame.success = True
+                elif frame.Class is folia.Cell:
+                    #empty cells still output the delimiter
+                    receive(parent, "", True)
+                    frame.success = True
+                if frame.buffer is not None:
+                    text = "".join(frame.buffer)
+                    frame.buffer = None
+                    if frame.unit:
+                        if text:
+                            output.append(text)
+                        if text and parent is not root:
+                            receive(parent, text, True)
+                    elif parent.Class is folia.Correction:
+                        parent.corrections.append( (frame.Class, text, textdelimiter(frame, node, retaintokenisation), frame.owntext) )
+            delimiter = textdelimiter(frame, node, retaintokenisation)
+            if frame.success and parent.textual and parent is not root and parent.Class is not folia.Correction:
+                parent.delimiter = delimiter
+            record = (frame.Class, delimiter, node.get('space') != 'no')
+            parent.last = record
+            if not issubclass(frame.Class, (folia.AbstractAnnotationLayer, folia.AbstractInlineAnnotation)):
+                parent.lastsignificant = record
+            #free the subtree
+            node.clear()
+            while node.getprevious() is not None:
+                del node.getparent()[0]
+        if output:
+            yield from output
+            output.clear()
+
 
 def process(filename, outputfile = None):
     print("Converting " + filename,file=sys.stderr)
     try:
-        doc = folia.Document(file=filename)
+        if not settings.stream:
+            doc = folia.Document(file=filename)
 
         if settings.autooutput:
             if filename[-len(settings.extension) - 1:].lower() == '.' +settings.extension:
                 outfilename = filename[:-len(settings.extension) - 1] + '.txt'
             else:
-                outfilename += '.txt'
+                outfilename = filename + '.txt'
             if settings.autooutput_cwd:
                 outfilename = os.path.basename(outfilename)
 
             print(" Saving as " + outfilename,file=sys.stderr)
             outputfile = io.open(outfilename,'w',encoding=settings.encoding)
 
-        if settings.wordperline:
+        if settings.stream:
+            if settings.wordperline:
+                unit = folia.Word
+            elif settings.sentenceperline:
+                unit = folia.Sentence
+            elif settings.paragraphperline:
+                unit = folia.Paragraph
+            else:
+                unit = None
+            if unit:
+                for text in streamtext(filename, unit, settings.textclass, settings.retaintokenisation, settings.correctionhandling):
+                    out(text, outputfile)
+            else:
+                #the text of the document as a whole, written as it comes in
+                f = outputfile if outputfile else sys.stdout
+                for text in streamtext(filename, None, settings.textclass, settings.retaintokenisation, settings.correctionhandling):
+                    f.write(text)
+                f.write("\n")
+        elif settings.wordperline:
             for word in doc.words():
                 out(word.text(settings.textclass, settings.retaintokenisation, correctionhandling=settings.correctionhandling), outputfile)
         elif settings.sentenceperline:
@@ -100,15 +388,6 @@ def process(filename, outputfile = None):
 
 
 
-def processdir(d, outputfile = None):
-    print("Searching in  " + d, file=sys.stderr)
-    for f in glob.glob(os.path.join(d, '*')):
-        if f[-len(settings.extension) - 1:] == '.' + settings.extension:
-            process(f, outputfile)
-        elif settings.recurse and os.path.isdir(f):
-            processdir(f, outputfile)
-
-
 class settings:
     wordperline = False
     sentenceperline = False
@@ -122,11 +401,16 @@ class settings:
     encoding = 'utf-8'
     textclass = "current"
     correctionhandling = folia.CorrectionHandling.CURRENT
+    manifest = None
+    where = None
+    jobs = 1
+    progress = False
+    stream = False
 
 
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "o:OPE:htspwrqc:", ["help","original"])
+        opts, args = getopt.getopt(sys.argv[1:], "o:OPE:htspwrqc:j:", ["help","original","manifest=","where=","jobs=","progress","stream"])
     except getopt.GetoptError as err:
         print(str(err), file=sys.stderr)
         usage()
@@ -165,6 +449,16 @@ def main():
             settings.recurse = True
         elif o == '-q':
             settings.ignoreerrors = True
+        elif o == '-j' or o == '--jobs':
+            settings.jobs = int(a)
+        elif o == '--progress':
+            settings.progress = True
+        elif o == '--manifest':
+            settings.manifest = a
+        elif o == '--where':
+            settings.where = a
+        elif o == '--stream':
+            settings.stream = True
         elif o == '--original':
             settings.correctionhandling = folia.CorrectionHandling.ORIGINAL
         else:
@@ -173,15 +467,21 @@ def main():
 
     if outputfile: outputfile = io.open(outputfile,'w',encoding=settings.encoding)
 
+    if settings.manifest:
+        try:
+            args += manifestfiles(settings.manifest, settings.where)
+        except (FileNotFoundError, ValueError) as e:
+            print("ERROR: " + str(e),file=sys.stderr)
+            sys.exit(2)
+
     if args:
-        for x in args:
-            if os.path.isdir(x):
-                processdir(x,outputfile)
-            elif os.path.isfile(x):
-                process(x, outputfile)
-            else:
-                print("ERROR: File or directory not found: " + x, file=sys.stderr)
-                sys.exit(3)
+        try:
+            files = findfiles(args, settings.extension, settings.recurse)
+        except FileNotFoundError as e:
+            print("ERROR: " + str(e), file=sys.stderr)
+            sys.exit(3)
+        for _ in processcorpus(process, files, settings, ordered=not settings.autooutput, outputfile=outputfile):
+            pass
     else:
         print("ERROR: Nothing to do, specify one or more files or directories", file=sys.stderr)
 
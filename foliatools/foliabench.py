@@ -11,7 +11,19 @@ import os
 import argparse
 import time
 import gc
-import resource
+import json
+import math
+import platform
+import pkgutil
+import signal
+import random
+import shutil
+import statistics
+import tempfile
+import tracemalloc
+from collections import Counter
+import lxml.etree
+import foliatools
 from foliatools import VERSION as TOOLVERSION
 import folia.main as folia
 
@@ -19,82 +31,414 @@ ansicolors = {"red":31,"green":32,"yellow":33,"blue":34,"magenta":35, "bold":1 }
 def colorf(color, x):
     return "\x1B[" + str(ansicolors[str(color)]) + "m" + x + "\x1B[0m"
 
-
-def getmem():
-    rusage_denom = 1024.
-    if sys.platform == 'darwin':
-        # ... it seems that in OSX the output is different units ...
-        rusage_denom = rusage_denom * rusage_denom
-    mem = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / rusage_denom
-    return mem
-
-def begin():
-    gc.collect()
-    return time.time(), getmem()
-
-def end(data):
-    begintime, beginmem = data
-    d = (time.time() - begintime)
-    d = d * 1000
-    memd = getmem() - beginmem
-    gc.collect()
-    return d, memd
+TESTS = ('parse','serialise','text','select','xpath','query','validation','save')
 
 
 def run_test(test_id, file):
+    """Prepares a test on a file. Returns a (title, function) tuple, the function performs the actual work that is
+    measured and can be called repeatedly; all preparatory work is done before it is returned and is not measured."""
     if test_id == 'parse':
         title = "Parse XML from file into full memory representation"
-        begintime, beginmem = begin()
-        doc = folia.Document(file=file)
-        return begintime, beginmem, title , doc
+        def f():
+            return folia.Document(file=file)
     elif test_id == 'serialise':
         title = "Serialise to XML"
         doc = folia.Document(file=file)
-        begintime, beginmem = begin()
-        out = doc.xmlstring()
-        return begintime, beginmem, title , out
+        def f():
+            return doc.xmlstring()
     elif test_id == 'text':
         title = "Serialise to text"
         doc = folia.Document(file=file)
-        begintime, beginmem = begin()
-        out = doc.text()
-        return begintime, beginmem, title , out
+        def f():
+            return doc.text()
     elif test_id == 'select':
         title = "Select all words"
         doc = folia.Document(file=file)
-        begintime, beginmem = begin()
-        for word in doc.select(folia.Word):
-            pass
-        return begintime, beginmem, title, None
-    raise KeyError("No such test: " + test_id)
+        def f():
+            for word in doc.select(folia.Word):
+                pass
+    elif test_id == 'xpath':
+        title = "Select all words using XPath on the lxml tree"
+        tree = lxml.etree.parse(file)
+        def f():
+            return tree.xpath('//folia:w', namespaces={'folia': folia.NSFOLIA})
+    elif test_id == 'query':
+        title = "Select all words using FQL"
+        import folia.fql as fql #only needed for this test
+        doc = folia.Document(file=file)
+        query = fql.Query('SELECT w')
+        def f():
+            return query(doc)
+    elif test_id == 'validation':
+        title = "Validate against the RelaxNG schema"
+        schema = lxml.etree.RelaxNG(folia.relaxng())
+        def f():
+            folia.validate(file, schema)
+    elif test_id == 'save':
+        title = "Save to file"
+        doc = folia.Document(file=file)
+        fd, tmpfile = tempfile.mkstemp(suffix=".folia.xml")
+        os.close(fd)
+        def f():
+            try:
+                doc.save(tmpfile)
+            finally:
+                os.unlink(tmpfile)
+    else:
+        raise KeyError("No such test: " + test_id)
+    return title, f
 
-def test(test_id,file, args):
+SYNTHETIC_LAYERS = ('pos','lemma','entities','syntax','corrections')
+SYNTHETIC_SET = "https://github.com/proycon/foliatools/synthetic/"
+
+def generate(filename, tokens, sentencelength=15, paragraphlength=10, layers=SYNTHETIC_LAYERS, seed=42):
+    """Generates a synthetic FoLiA document with the specified number of tokens, for benchmarking purposes. The document
+    is written out directly rather than constructed in memory, so very large documents can be generated quickly. A fixed
+    seed makes the output reproducible. Sentences have a random length averaging sentencelength tokens, paragraphs a
+    random length averaging paragraphlength sentences. Layers selects which annotations to add, choose from: pos, lemma
+    (inline annotation layers), entities, syntax (span annotation layers) and corrections."""
+    rand = random.Random(seed)
+    syllables = ('ba','de','ko','ri','mu','sa','te','lo','vi','ne','ga','po','zu','fe','ha','ji')
+    postags = ('N','V','ADJ','ADV','DET','PREP','PRON','CONJ')
+    vocabulary = [ (''.join(rand.choice(syllables) for _ in range(rand.randint(1,4))), rand.choice(postags)) for _ in range(5000) ]
+    docid = "synthetic"
+    with open(filename,'w',encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        f.write('<FoLiA xmlns="http://ilk.uvt.nl/folia" xml:id="' + docid + '" version="' + folia.FOLIAVERSION + '" generator="foliatools-v' + TOOLVERSION + '">\n')
+        f.write('  <metadata type="native">\n    <annotations>\n')
+        f.write('      <text-annotation set="' + folia.DEFAULT_TEXT_SET + '"/>\n')
+        f.write('      <paragraph-annotation/>\n      <sentence-annotation/>\n      <token-annotation/>\n')
+        for layer, annotationtype in (('pos','pos'),('lemma','lemma'),('entities','entity'),('syntax','syntax'),('corrections','correction')):
+            if layer in layers:
+                f.write('      <' + annotationtype + '-annotation set="' + SYNTHETIC_SET + layer + '"/>\n')
+        f.write('    </annotations>\n  </metadata>\n')
+        f.write('  <text xml:id="' + docid + '.text">\n')
+        count = 0
+        p = 0
+        while count < tokens:
+            p += 1
+            pid = docid + '.p.' + str(p)
+            f.write('    <p xml:id="' + pid + '">\n')
+            for s in range(1, rand.randint(1, paragraphlength * 2) + 1):
+                if count >= tokens: break
+                sid = pid + '.s.' + str(s)
+                f.write('      <s xml:id="' + sid + '">\n')
+                wordids = []
+                for w in range(1, min(rand.randint(1, sentencelength * 2), tokens - count) + 1):
+                    wid = sid + '.w.' + str(w)
+                    wordids.append(wid)
+                    text, pos = rand.choice(vocabulary)
+                    f.write('        <w xml:id="' + wid + '">\n')
+                    if 'corrections' in layers and rand.random() < 0.02:
+                        f.write('          <correction xml:id="' + wid + '.correction" class="spelling">\n')
+                        f.write('            <new><t>' + text + '</t></new>\n')
+                        f.write('            <original><t>' + text[::-1] + '</t></original>\n')
+                        f.write('          </correction>\n')
+                    else:
+                        f.write('          <t>' + text + '</t>\n')
+                    if 'pos' in layers:
+                        f.write('          <pos class="' + pos + '"/>\n')
+                    if 'lemma' in layers:
+                        f.write('          <lemma class="' + text + '"/>\n')
+                    f.write('        </w>\n')
+                    count += 1
+                if 'entities' in layers and len(wordids) >= 2 and rand.random() < 0.5:
+                    begin = rand.randint(0, len(wordids) - 2)
+                    f.write('        <entities>\n          <entity xml:id="' + sid + '.entity.1" class="' + rand.choice(('per','loc','org')) + '">')
+                    f.write(''.join('<wref id="' + wid + '"/>' for wid in wordids[begin:begin+2]))
+                    f.write('</entity>\n        </entities>\n')
+                if 'syntax' in layers:
+                    #a flat tree: the sentence constituent consisting of chunks of at most three words
+                    f.write('        <syntax>\n          <su xml:id="' + sid + '.su.1" class="s">\n')
+                    for i in range(0, len(wordids), 3):
+                        f.write('            <su xml:id="' + sid + '.su.1.' + str(i//3 + 1) + '" class="' + rand.choice(('np','vp','pp')) + '">')
+                        f.write(''.join('<wref id="' + wid + '"/>' for wid in wordids[i:i+3]))
+                        f.write('</su>\n')
+                    f.write('          </su>\n        </syntax>\n')
+                f.write('      </s>\n')
+            f.write('    </p>\n')
+        f.write('  </text>\n</FoLiA>\n')
+    return filename
+
+def scaling(results, threshold):
+    """Estimates how the median time of each test scales with the number of tokens in the generated documents, by fitting a power law (least squares on a log-log scale). Exponents above the threshold are flagged as superlinear. Returns the number of flagged tests"""
+    flagged = 0
+    for test_id in sorted(set(result['test'] for result in results if result.get('tokens'))):
+        points = sorted((result['tokens'], result['median']) for result in results if result['test'] == test_id and result.get('tokens') and result['median'] > 0)
+        if len(points) < 2:
+            continue
+        xs = [ math.log(tokens) for tokens, _ in points ]
+        ys = [ math.log(t) for _, t in points ]
+        meanx = statistics.mean(xs)
+        meany = statistics.mean(ys)
+        exponent = sum((x - meanx) * (y - meany) for x, y in zip(xs, ys)) / sum((x - meanx) ** 2 for x in xs)
+        line = "[" + test_id + "] scales as O(n^" + str(round(exponent,2)) + ") from " + str(points[0][0]) + " to " + str(points[-1][0]) + " tokens (" + ", ".join(str(round(t / tokens * 1000, 4)) + "ms/1k tokens" for tokens, t in points) + ")"
+        if exponent > threshold:
+            flagged += 1
+            print(colorf('red', "SUPERLINEAR: ") + line)
+        else:
+            print("OK: " + line)
+    return flagged
+
+def percentile(values, p):
+    """Computes the p-th percentile of the values (nearest rank method)"""
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100.0 * len(values)) - 1)]
+
+def measure(f, iterations, warmup):
+    """Performs a number of warm-up runs and then times the specified number of iterations of f, returns a list of times in milliseconds"""
+    for _ in range(0, warmup):
+        f()
     times = []
-    mems = []
-    title = ""
-    for i in range(0,args.iterations):
-        begintime, beginmem, title, doc = run_test(test_id,file)
-        t, mem  = end((begintime, beginmem))
-        times.append(t)
-        mems.append(mem)
-    t = sum(times) / float(len(times))
-    mem = sum(mems) / float(len(mems))
-    print(file +  " - [" + test_id+ "] " + title + ": " + colorf('yellow',str(round(t,3))+ 'ms') + " -- Memory: " + colorf('green',str(round(mem,2))+ ' MB') + "\n")
+    for _ in range(0, iterations):
+        gc.collect()
+        begintime = time.perf_counter()
+        f()
+        times.append((time.perf_counter() - begintime) * 1000)
+    return times
+
+def measurememory(f):
+    """Runs f once with tracemalloc enabled, returns the memory still allocated after the run and the peak allocation during the run (both in MB, relative to the start)"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        begin, _ = tracemalloc.get_traced_memory()
+        result = f() #keep a reference so retained allocations are measured
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return (current - begin) / (1024*1024), (peak - begin) / (1024*1024)
+
+class SamplingProfiler:
+    """A minimal statistical profiler that samples the call stack at a fixed interval of CPU time (using a profiling timer signal, so this is Unix only) and records collapsed stacks, the format read by flamegraph tools"""
+
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.stacks = Counter()
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(code.co_name + "@" + os.path.basename(code.co_filename) + ":" + str(code.co_firstlineno))
+            frame = frame.f_back
+        self.stacks[";".join(reversed(stack))] += 1
+
+    def __enter__(self):
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def save(self, filename):
+        with open(filename,'w',encoding='utf-8') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(stack + " " + str(count) + "\n")
+
+def profile(test_id, file, f, args):
+    """Runs f once under cProfile and for the configured number of iterations under the sampling profiler. Writes the cProfile statistics (.pstats) and the collapsed stacks (.collapsed, for flamegraph tools) to the profile directory and prints a table of the top hotspots (by own time)"""
+    import cProfile, pstats #only needed with --profile
+    os.makedirs(args.profile, exist_ok=True)
+    prefix = os.path.join(args.profile, os.path.basename(file) + "." + test_id)
+    profiler = cProfile.Profile()
+    profiler.runcall(f)
+    profiler.dump_stats(prefix + ".pstats")
+    with SamplingProfiler(args.profileinterval) as sampler:
+        for _ in range(0, max(1, args.iterations)):
+            f()
+    sampler.save(prefix + ".collapsed")
+    print(colorf('bold', "Top " + str(args.profiletop) + " hotspots for [" + test_id + "] on " + file + ":"))
+    pstats.Stats(profiler, stream=sys.stdout).strip_dirs().sort_stats('tottime').print_stats(args.profiletop)
+    print("Profile written to " + prefix + ".pstats, collapsed stacks (" + str(sum(sampler.stacks.values())) + " samples) to " + prefix + ".collapsed", file=sys.stderr)
+
+
+def startuptools():
+    """Returns the names of all tool modules in foliatools"""
+    return [ name for _, name, ispkg in pkgutil.iter_modules(foliatools.__path__) if not ispkg and name != 'common' ]
+
+def importtime(code):
+    """Runs the code in a fresh interpreter with python -X importtime. Returns the wall-clock time of the entire run (in milliseconds) and a dictionary mapping each imported module to its own and its cumulative import time (both in milliseconds)"""
+    import subprocess #only needed for the startup benchmark
+    begintime = time.perf_counter()
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    walltime = (time.perf_counter() - begintime) * 1000
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.strip().split("\n")[-1])
+    imports = {}
+    for line in process.stderr.split("\n"):
+        if line.startswith("import time:"):
+            fields = line[len("import time:"):].split("|")
+            try:
+                imports[fields[2].strip()] = (int(fields[0]) / 1000, int(fields[1]) / 1000)
+            except (IndexError, ValueError):
+                continue #header
+    return walltime, imports
+
+def startup(tool, args):
+    """Measures the startup time of a tool by importing its module in a fresh interpreter, for the configured number of iterations. Reports the wall-clock time, the import time of the module and the packages that take the most time to import"""
+    if tool == 'python':
+        module, code = None, "pass" #the bare interpreter, for reference
+    else:
+        module = tool if '.' in tool else 'foliatools.' + tool
+        code = "import " + module
+    try:
+        for _ in range(0, args.warmup):
+            importtime(code)
+        runs = [ importtime(code) for _ in range(0, args.iterations) ]
+    except RuntimeError as e:
+        print("ERROR: Unable to import " + module + ": " + str(e), file=sys.stderr)
+        return None
+    times = [ walltime for walltime, _ in runs ]
+    packages = Counter()
+    for _, imports in runs:
+        for name, (selftime, _) in imports.items():
+            packages[name.split('.')[0]] += selftime / len(runs)
+    result = {
+        "file": tool,
+        "tokens": None,
+        "test": "startup",
+        "title": "Startup time",
+        "iterations": len(times),
+        "times": times,
+        "mean": statistics.mean(times),
+        "median": statistics.median(times),
+        "p95": percentile(times, 95),
+        "stdev": statistics.stdev(times) if len(times) > 1 else 0.0,
+        "min": min(times),
+        "max": max(times),
+        "importtime": statistics.median(imports.get(module, (0.0, 0.0))[1] for _, imports in runs),
+        "imports": packages.most_common(args.startuptop),
+    }
+    print(tool + " - [startup] " + result['title'] + ": " + colorf('yellow',"median " + str(round(result['median'],3))+ 'ms') + ", p95 " + str(round(result['p95'],3)) + "ms, stdev " + str(round(result['stdev'],3)) + "ms (" + str(len(times)) + " iterations)" + (" -- Import of " + module + ": " + colorf('green', str(round(result['importtime'],3)) + "ms") if module else ""))
+    print("    heaviest imports: " + ", ".join(package + " " + str(round(duration,1)) + "ms" for package, duration in result['imports']) + "\n")
+    return result
+
+def test(test_id,file, args, tokens=None):
+    title, f = run_test(test_id, file)
+    times = measure(f, args.iterations, args.warmup)
+    memdelta, mempeak = measurememory(f)
+    if args.profile:
+        profile(test_id, file, f, args)
+    result = {
+        "file": file,
+        "tokens": tokens,
+        "test": test_id,
+        "title": title,
+        "iterations": len(times),
+        "times": times,
+        "mean": statistics.mean(times),
+        "median": statistics.median(times),
+        "p95": percentile(times, 95),
+        "stdev": statistics.stdev(times) if len(times) > 1 else 0.0,
+        "min": min(times),
+        "max": max(times),
+        "memdelta": memdelta,
+        "mempeak": mempeak,
+    }
+    print(file +  " - [" + test_id+ "] " + title + ": " + colorf('yellow',"median " + str(round(result['median'],3))+ 'ms') + ", p95 " + str(round(result['p95'],3)) + "ms, stdev " + str(round(result['stdev'],3)) + "ms (" + str(len(times)) + " iterations) -- Memory: " + colorf('green',str(round(memdelta,2))+ ' MB') + " retained, " + str(round(mempeak,2)) + " MB peak\n")
+    return result
+
+def compare(results, baseline, threshold):
+    """Compares results against a baseline (as loaded from a previously written JSON file), flags any test whose median time increased by more than the threshold (percentage). Returns the number of regressions"""
+    baselineresults = { (os.path.basename(r['file']), r['test']): r for r in baseline['results'] }
+    regressions = 0
+    for result in results:
+        key = (os.path.basename(result['file']), result['test'])
+        if key not in baselineresults:
+            print(result['file'] + " - [" + result['test'] + "] not in baseline, skipping comparison", file=sys.stderr)
+            continue
+        reference = baselineresults[key]['median']
+        change = ((result['median'] - reference) / reference * 100) if reference else 0.0
+        line = result['file'] + " - [" + result['test'] + "] median " + str(round(result['median'],3)) + "ms vs baseline " + str(round(reference,3)) + "ms (" + ("+" if change >= 0 else "") + str(round(change,1)) + "%)"
+        if change > threshold:
+            regressions += 1
+            print(colorf('red', "REGRESSION: ") + line)
+        elif change < -threshold:
+            print(colorf('green', "IMPROVEMENT: ") + line)
+        else:
+            print("OK: " + line)
+    return regressions
 
 
 def main():
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-v','-V','--version',help="Show version information", action='version', version="FoLiA-tools v" + TOOLVERSION + ", using FoLiA v" + folia.FOLIAVERSION + " with library FoLiApy v" + folia.LIBVERSION, default=False)
-    parser.add_argument('-i','--iterations', type=int,help="Number of iterations to run and average over", action='store',default=1,required=False)
-    parser.add_argument('-t','--tests', type=str,help="Comma separated list of test IDs", action='store',default="parse,serialise,text,words",required=False)
-    parser.add_argument('files', nargs='*', help='Files (and/or directories) to validate')
+    parser.add_argument('-i','--iterations', type=int,help="Number of iterations to run and compute statistics over", action='store',default=5,required=False)
+    parser.add_argument('-w','--warmup', type=int,help="Number of warm-up runs prior to the measured iterations", action='store',default=1,required=False)
+    parser.add_argument('-t','--tests', type=str,help="Comma separated list of test IDs, choose from: " + ", ".join(TESTS), action='store',default=",".join(TESTS),required=False)
+    parser.add_argument('-o','--output', type=str,help="Write the results to this JSON file", action='store',required=False)
+    parser.add_argument('--compare', type=str,help="Compare the results against a baseline JSON file (as written earlier using -o) and report regressions, the exit code will be 1 if there are any", action='store',required=False)
+    parser.add_argument('--threshold', type=float,help="Threshold (percentage increase of the median time) above which a difference to the baseline is considered a regression", action='store',default=10.0,required=False)
+    parser.add_argument('-g','--generate', type=str,help="Generate synthetic documents of the specified sizes (comma separated list of token counts, e.g. 1000,10000,100000) and benchmark on those, reporting how each test scales with the document size", action='store',required=False)
+    parser.add_argument('--layers', type=str,help="Comma separated list of annotation layers to include in generated documents, choose from: " + ", ".join(SYNTHETIC_LAYERS), action='store',default=",".join(SYNTHETIC_LAYERS),required=False)
+    parser.add_argument('--sentencelength', type=int,help="Average sentence length (in tokens) in generated documents", action='store',default=15,required=False)
+    parser.add_argument('--paragraphlength', type=int,help="Average paragraph length (in sentences) in generated documents", action='store',default=10,required=False)
+    parser.add_argument('--seed', type=int,help="Random seed for generated documents", action='store',default=42,required=False)
+    parser.add_argument('--generatedir', type=str,help="Directory to write generated documents to, they will be kept after benchmarking (by default a temporary directory is used and removed afterwards)", action='store',required=False)
+    parser.add_argument('--scalingthreshold', type=float,help="Exponent above which the scaling of a test with the document size is flagged as superlinear", action='store',default=1.2,required=False)
+    parser.add_argument('-p','--profile', type=str,help="Profile each test and write the results to this directory: cProfile statistics (.pstats) and collapsed stacks from a sampling profiler (.collapsed, can be fed to flamegraph tools). A table of the top hotspots is printed as well", action='store',required=False)
+    parser.add_argument('--profiletop', type=int,help="Number of hotspots to show per test when profiling", action='store',default=20,required=False)
+    parser.add_argument('--profileinterval', type=float,help="Sampling interval (in seconds of CPU time) of the sampling profiler", action='store',default=0.001,required=False)
+    parser.add_argument('-s','--startup', type=str,help="Measure the startup time of the specified tools (comma separated list of module names, e.g. folia2txt,foliavalidator, or 'all'), i.e. the time it takes to launch them in a fresh interpreter, in the style of python -X importtime. Reports the heaviest imports of each tool. The bare interpreter is measured too, for reference", action='store',required=False)
+    parser.add_argument('--startuptop', type=int,help="Number of heaviest imports (aggregated by top-level package) to show per tool when measuring startup time", action='store',default=10,required=False)
+    parser.add_argument('files', nargs='*', help='Files to benchmark on')
     args = parser.parse_args()
 
+    results = []
     for file in args.files:
         for test_id in args.tests.split(","):
-            test(test_id, file, args)
+            results.append(test(test_id, file, args))
+
+    if args.startup:
+        if sys.flags.dont_write_bytecode:
+            print("WARNING: Writing bytecode is disabled (PYTHONDONTWRITEBYTECODE), startup times will include compilation", file=sys.stderr)
+        for tool in ['python'] + (startuptools() if args.startup == 'all' else args.startup.split(",")):
+            result = startup(tool, args)
+            if result is not None:
+                results.append(result)
+
+    if args.generate:
+        if args.generatedir:
+            generatedir = args.generatedir
+            os.makedirs(generatedir, exist_ok=True)
+        else:
+            generatedir = tempfile.mkdtemp(prefix="foliabench")
+        try:
+            generated = []
+            for tokens in sorted(int(x) for x in args.generate.split(",")):
+                filename = os.path.join(generatedir, "synthetic." + str(tokens) + ".folia.xml")
+                print("Generating " + filename, file=sys.stderr)
+                generate(filename, tokens, args.sentencelength, args.paragraphlength, args.layers.split(","), args.seed)
+                for test_id in args.tests.split(","):
+                    generated.append(test(test_id, filename, args, tokens))
+            scaling(generated, args.scalingthreshold)
+            results += generated
+        finally:
+            if not args.generatedir:
+                shutil.rmtree(generatedir)
+
+    if args.output:
+        with open(args.output,'w',encoding='utf-8') as f:
+            json.dump({
+                "foliatools": TOOLVERSION,
+                "foliapy": folia.LIBVERSION,
+                "folia": folia.FOLIAVERSION,
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "results": results,
+            }, f, indent=4)
+        print("Results written to " + args.output, file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare,'r',encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
 
 
 if __name__ == '__main__':
     main()
-
@@ -9,9 +9,12 @@ import getopt
 import io
 import sys
 import os
-import glob
+import json
+import operator
 from collections import Counter
+import lxml.etree
 import folia.main as folia
+from foliatools.common import cachedir, hashfile, manifestfiles, findfiles, processcorpus
 
 def usage():
     print("foliacount",file=sys.stderr)
@@ -30,6 +33,19 @@ def usage():
     print("  -t [types]                   Output only these elements (comma separated list)", file=sys.stderr)
     print("  -P                           Like -O, but outputs to current working directory",file=sys.stderr)
     print("  -q                           Ignore errors",file=sys.stderr)
+    print("  -j [n]                       Number of parallel processes to use (default: 1)",file=sys.stderr)
+    print("  --progress                   Report progress and the processing time per file",file=sys.stderr)
+    print("  --fast                       Count directly from the XML rather than loading the documents. Produces the same",file=sys.stderr)
+    print("                               counts for valid documents, but documents are not checked in any way",file=sys.stderr)
+    print("Parameters for selecting documents from a corpus manifest (see foliaindex):",file=sys.stderr)
+    print("  --manifest [file]            Process the documents in the manifest (in addition to any specified files)",file=sys.stderr)
+    print("  --where [constraints]        Only process the documents in the manifest that match the constraints,",file=sys.stderr)
+    print("                               e.g. annotation:entity,w>10000 (see foliaindex --help)",file=sys.stderr)
+    print("Parameters for caching:",file=sys.stderr)
+    print("  Element counts per document are cached on disk, so repeated runs (e.g. with different constraints)",file=sys.stderr)
+    print("  do not need to parse unchanged documents again.",file=sys.stderr)
+    print("  --nocache                    Do not use the statistics cache",file=sys.stderr)
+    print("  --cachefile [file]           Location of the statistics cache (default: ~/.cache/foliatools/statistics.sqlite)",file=sys.stderr)
 
 def out(s, outputfile):
     if sys.version < '3':
@@ -44,57 +60,202 @@ def out(s, outputfile):
             print(s)
 
 
-def process(filename, outputfile = None):
-    print("Processing " + filename,file=sys.stderr)
+def countelements(filename):
+    """Counts all elements in a document, returns a Counter"""
+    doc = folia.Document(file=filename)
     count = Counter()
-    try:
-        doc = folia.Document(file=filename)
-        count['documents'] += 1
+    count['documents'] += 1
+    for e in doc.select(folia.AbstractElement):
+        if e.XMLTAG:
+            count[e.XMLTAG] += 1
+    return count
 
-        for e in doc.select(folia.AbstractElement):
-            if e.XMLTAG and (not settings.types or e.XMLTAG in settings.types):
-                count[e.XMLTAG] += 1
 
-        for constraintag, constrainf in settings.constraints:
-            if not constrainf(count[constraintag]):
-                print("Skipping due to unmet constraints (" + constraintag+"): " + filename,file=sys.stderr)
-                return Counter({'skipped_documents':1})
+#non-authoritative elements, these and their contents are not counted
+NONAUTHTAGS = ('original', 'suggestion', 'alt', 'altlayers')
 
-        print("Counted " + filename,file=sys.stderr)
-
-    except Exception as e:
-        if settings.ignoreerrors:
-            print("ERROR: An exception was raised whilst processing " + filename + ":", e, file=sys.stderr)
-        else:
-            raise
+def countelementsfast(filename, expandrefs=True):
+    """Counts all elements in a document like countelements(), but straight from a stream of XML events, without building the document. Memory usage does not depend on the size of the document, except for the counts of referable structure elements that are kept to resolve references.
 
+    Like countelements(), elements referenced from span annotations (wref) are counted again for every reference. If expandrefs is not set, references are not followed, so the counts reflect the structure of the document (every word is counted once)"""
+    nsprefix = '{' + folia.NSFOLIA + '}'
+    bodytags = (nsprefix + 'text', nsprefix + 'speech')
+    count = Counter()
+    count['documents'] += 1
+    classes = {} #local tag => (xmltag, referable)
+    subtrees = {} #ID => counts of the subtree of a structure element, as wref elements expand to the referenced element
+    shapes = {} #interned subtree counts, most subtrees are identical
+    forwardrefs = Counter()
+    stack = [] #counts of all open elements in the body
+    skip = 0
+    for event, node in lxml.etree.iterparse(filename, events=('start','end'), huge_tree=True):
+        if skip:
+            skip += 1 if event == 'start' else -1
+        elif event == 'start':
+            if not stack:
+                if node.tag in bodytags:
+                    stack.append(Counter())
+            elif not node.tag.startswith(nsprefix) or node.tag[len(nsprefix):] in NONAUTHTAGS:
+                skip = 1 #foreign or non-authoritative content
+            else:
+                stack.append(Counter())
+        elif stack:
+            subtree = stack.pop()
+            if not stack:
+                count.update(subtree) #end of the body
+            else:
+                tag = node.tag[len(nsprefix):]
+                if tag == 'wref':
+                    if not expandrefs:
+                        pass
+                    elif node.get('id') in subtrees:
+                        stack[-1].update(subtrees[node.get('id')])
+                    else:
+                        forwardrefs[node.get('id')] += 1
+                else:
+                    if tag not in classes:
+                        Class = folia.XML2CLASS.get(folia.OLDTAGS.get(tag, tag))
+                        if Class is None:
+                            classes[tag] = (tag, False)
+                        else:
+                            classes[tag] = (Class.XMLTAG, issubclass(Class, folia.AbstractStructureElement))
+                    xmltag, referable = classes[tag]
+                    if referable and expandrefs and node.get('{http://www.w3.org/XML/1998/namespace}id'):
+                        subtree[xmltag] += 1
+                        shape = tuple(sorted(subtree.items()))
+                        subtrees[node.get('{http://www.w3.org/XML/1998/namespace}id')] = shapes.setdefault(shape, subtree)
+                        stack[-1].update(subtree)
+                    elif subtree:
+                        subtree[xmltag] += 1
+                        stack[-1].update(subtree)
+                    else:
+                        stack[-1][xmltag] += 1
+        if event == 'end' and node.getparent() is not None:
+            node.clear()
+            while node.getprevious() is not None:
+                del node.getparent()[0]
+    for id, n in forwardrefs.items():
+        if id in subtrees:
+            for xmltag, freq in subtrees[id].items():
+                count[xmltag] += freq * n
     return count
 
 
+class StatisticsCache:
+    """Persistent on-disk cache of element counts per document (SQLite). Counts are keyed by the hash of the file contents, the version of the FoLiA library and the counting mode: counts from fast mode are kept apart, as the document was not checked for them. Fast mode does use counts from the full mode, which are the same for valid documents. The hash of a file is in turn remembered for its path, modification time and size, so unchanged files need not even be hashed again."""
 
+    def __init__(self, filename=None, fast=False):
+        if not filename:
+            filename = os.path.join(cachedir(), 'statistics.sqlite')
+        self.filename = filename
+        import sqlite3 #only needed with the cache enabled
+        self.db = sqlite3.connect(filename, timeout=60)
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT NOT NULL PRIMARY KEY, mtime INTEGER NOT NULL, size INTEGER NOT NULL, hash TEXT NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS counts (hash TEXT NOT NULL, libversion TEXT NOT NULL, counts TEXT NOT NULL, PRIMARY KEY (hash, libversion))")
+        self.db.commit()
+        self.libversion = folia.LIBVERSION + "/" + folia.FOLIAVERSION
+        #the keys to look up, in order of preference, and the key to store counts under
+        self.lookupversions = (self.libversion, self.libversion + "/fast") if fast else (self.libversion,)
+        self.storeversion = self.lookupversions[-1]
 
-def processdir(d, outputfile = None):
-    print("Searching in  " + d, file=sys.stderr)
-    count = Counter()
-    for f in glob.glob(os.path.join(d, '*')):
-        if f[-len(settings.extension) - 1:] == '.' + settings.extension:
-            count.update(process(f, outputfile))
-        elif settings.recurse and os.path.isdir(f):
-            count.update(processdir(f, outputfile))
+    def filehash(self, filename):
+        """Returns the hash of the contents of the file, computing it only if the file changed since it was last seen"""
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        row = self.db.execute("SELECT hash FROM files WHERE path = ? AND mtime = ? AND size = ?", (path, st.st_mtime_ns, st.st_size)).fetchone()
+        if row:
+            return row[0]
+        filehash = hashfile(path)
+        self.db.execute("INSERT OR REPLACE INTO files (path, mtime, size, hash) VALUES (?, ?, ?, ?)", (path, st.st_mtime_ns, st.st_size, filehash))
+        self.db.commit()
+        return filehash
+
+    def get(self, filehash):
+        """Returns the cached counts (a Counter) for a file hash, or None if there are none"""
+        for libversion in self.lookupversions:
+            row = self.db.execute("SELECT counts FROM counts WHERE hash = ? AND libversion = ?", (filehash, libversion)).fetchone()
+            if row:
+                return Counter(json.loads(row[0]))
+        return None
+
+    def set(self, filehash, count):
+        self.db.execute("INSERT OR REPLACE INTO counts (hash, libversion, counts) VALUES (?, ?, ?)", (filehash, self.storeversion, json.dumps(count)))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def select(filename, count):
+    """Applies the type filter and the constraints to the element counts of a document"""
+    if settings.types:
+        count = Counter({ xmltag: freq for xmltag, freq in count.items() if xmltag == 'documents' or xmltag in settings.types })
+
+    for constraintag, constrainf, value in settings.constraints:
+        if not constrainf(count[constraintag], value):
+            print("Skipping due to unmet constraints (" + constraintag+"): " + filename,file=sys.stderr)
+            return Counter({'skipped_documents':1})
+
+    print("Counted " + filename,file=sys.stderr)
     return count
 
 
+def countworker(filename):
+    """Counts the elements of a document, in the way selected by the settings, returns a Counter"""
+    print("Processing " + filename,file=sys.stderr)
+    if settings.fast:
+        return countelementsfast(filename)
+    else:
+        return countelements(filename)
+
+
+def processfiles(files, cache = None):
+    """Counts the elements of all files; cached counts are looked up first, the remaining files are parsed through the corpus driver (in parallel if multiple jobs are set)"""
+    counts = {}
+    hashes = {}
+    pending = []
+    for filename in files:
+        if cache is not None:
+            hashes[filename] = cache.filehash(filename)
+            counts[filename] = cache.get(hashes[filename])
+            if counts[filename] is not None:
+                print("Processing " + filename + " (cached)",file=sys.stderr)
+                continue
+        pending.append(filename)
+
+    for filename, count in processcorpus(countworker, pending, settings):
+        counts[filename] = count
+        if cache is not None and count is not None:
+            cache.set(hashes[filename], count)
+
+    total = Counter()
+    for filename in files:
+        if counts[filename] is not None:
+            total.update(select(filename, counts[filename]))
+    return total
+
+
+#constraint operators, two-character ones must be tested first
+CONSTRAINTOPERATORS = (('>=', operator.ge), ('<=', operator.le), ('==', operator.eq), ('!=', operator.ne), ('>', operator.gt), ('<', operator.lt))
+
 class settings:
     extension = 'xml'
     recurse = False
     ignoreerrors = False
     types = None
     constraints = []
+    jobs = 1
+    progress = False
+    cache = True
+    cachefile = None
+    fast = False
+    manifest = None
+    where = None
 
 
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "o:OPE:ht:spwrqC:", ["help"])
+        opts, args = getopt.getopt(sys.argv[1:], "o:OPE:ht:spwrqC:j:", ["help","progress","fast","nocache","cachefile=","manifest=","where="])
     except getopt.GetoptError as err:
         print(str(err), file=sys.stderr)
         usage()
@@ -116,33 +277,27 @@ def main():
             settings.types = a.split(',')
         elif o == '-C':
             for rawconstraint in a.split(','):
-                if '>' in rawconstraint:
-                    tag, value = rawconstraint.split('>')
-                    value = int(value)
-                    settings.constraints.append( (tag, lambda x: x > value) )
-                elif '<' in rawconstraint:
-                    tag, value = rawconstraint.split('<')
-                    value = int(value)
-                    settings.constraints.append( (tag, lambda x: x < value) )
-                elif rawconstraint.find('>=') != -1:
-                    tag, value = rawconstraint.split('>=')
-                    value = int(value)
-                    settings.constraints.append( (tag, lambda x: x >= value) )
-                elif rawconstraint.find('<=') != -1:
-                    tag, value = rawconstraint.split('<=')
-                    value = int(value)
-                    settings.constraints.append( (tag, lambda x: x <= value) )
-                elif rawconstraint.find('==') != -1:
-                    tag, value = rawconstraint.split('==')
-                    value = int(value)
-                    settings.constraints.append( (tag, lambda x: x == value) )
-                elif rawconstraint.find('!=') != -1:
-                    tag, value = rawconstraint.split('!=')
-                    value = int(value)
-                    settings.constraints.append( (tag, lambda x: x != value) )
+                for symbol, constrainf in CONSTRAINTOPERATORS:
+                    if symbol in rawconstraint:
+                        tag, value = rawconstraint.split(symbol)
+                        settings.constraints.append( (tag, constrainf, int(value)) )
+                        break
                 else:
-                    tag = a
-                    settings.constraints.append( (tag, lambda x: x > 0) )
+                    settings.constraints.append( (rawconstraint, operator.gt, 0) )
+        elif o == '-j':
+            settings.jobs = int(a)
+        elif o == '--progress':
+            settings.progress = True
+        elif o == '--manifest':
+            settings.manifest = a
+        elif o == '--where':
+            settings.where = a
+        elif o == '--fast':
+            settings.fast = True
+        elif o == '--nocache':
+            settings.cache = False
+        elif o == '--cachefile':
+            settings.cachefile = a
         elif o == '-q':
             settings.ignoreerrors = True
         else:
@@ -151,15 +306,23 @@ def main():
 
     if outputfile: outputfile = io.open(outputfile,'w',encoding=settings.encoding)
 
+    if settings.manifest:
+        try:
+            args += manifestfiles(settings.manifest, settings.where)
+        except (FileNotFoundError, ValueError) as e:
+            print("ERROR: " + str(e),file=sys.stderr)
+            sys.exit(2)
+
     if args:
-        for x in args:
-            if os.path.isdir(x):
-                count = processdir(x,outputfile)
-            elif os.path.isfile(x):
-                count = process(x, outputfile)
-            else:
-                print("ERROR: File or directory not found: " + x, file=sys.stderr)
-                sys.exit(3)
+        cache = StatisticsCache(settings.cachefile, settings.fast) if settings.cache else None
+        try:
+            files = findfiles(args, settings.extension, settings.recurse)
+        except FileNotFoundError as e:
+            print("ERROR: " + str(e), file=sys.stderr)
+            sys.exit(3)
+        count = processfiles(files, cache)
+        if cache is not None:
+            cache.close()
 
         for xmltag, freq in sorted(count.items(), key=lambda x: x[1]*-1):
             print(xmltag+"\t" + str(freq))
@@ -9,10 +9,19 @@ import getopt
 import io
 import sys
 import os
-import glob
+import itertools
+import collections
+import unicodedata
+import hashlib
+import heapq
+import math
+import mmap
+import operator
+from array import array
+import lxml.etree
 import folia.main as folia
 from pynlpl.statistics import FrequencyList
-from pynlpl.textprocessors import Windower
+from foliatools.common import manifestfiles, findfiles, processcorpus
 
 def usage():
     print("foliafreqlist",file=sys.stderr)
@@ -30,67 +39,408 @@ def usage():
     print("  -s                           Add begin/end of sentence markers (with -n > 1)",file=sys.stderr)
     print("  -o [filename]                Output to a single file (instead of default stdout)",file=sys.stderr)
     print("  -e [encoding]                Output encoding (default: utf-8)",file=sys.stderr)
+    print("  -m [count]                   Minimum count, less frequent entries are not output",file=sys.stderr)
+    print("  -k [k]                       Output only the top-k most frequent entries",file=sys.stderr)
+    print("                               -m and -k only filter the output, the complete frequency list is still held in",file=sys.stderr)
+    print("                               memory. For large (n-gram) counts in bounded memory, use --approximate",file=sys.stderr)
+    print("  -b                           Output in a compact binary format (sorted by type, no cutoffs applied) that can",file=sys.stderr)
+    print("                               be merged efficiently using --merge. With -O, .freqbin files are written",file=sys.stderr)
+    print("  --merge                      Merge binary frequency lists (the arguments are .freqbin files rather than FoLiA",file=sys.stderr)
+    print("                               documents), outputs a ranked frequency list, or a binary one if -b is set",file=sys.stderr)
+    print("Parameters for approximate counting (bounded memory, for large n-gram counts):",file=sys.stderr)
+    print("  --approximate                Approximate counts using a count-min sketch, only the most frequent entries",file=sys.stderr)
+    print("                               are retained (10 times the top-k, see -k, or 10000) and output with their",file=sys.stderr)
+    print("                               estimated counts",file=sys.stderr)
+    print("  --error [e]                  Error bound: estimates exceed the true count by at most e * total count",file=sys.stderr)
+    print("                               (default: 0.00001)",file=sys.stderr)
+    print("  --confidence [p]             Probability with which the error bound holds (default: 0.999)",file=sys.stderr)
+    print("  --memory [MB]                Memory budget for the sketch and candidates, may loosen the error bound",file=sys.stderr)
+    print("Parameters for selecting documents from a corpus manifest (see foliaindex):",file=sys.stderr)
+    print("  --manifest [file]            Process the documents in the manifest (in addition to any specified files)",file=sys.stderr)
+    print("  --where [constraints]        Only process the documents in the manifest that match the constraints,",file=sys.stderr)
+    print("                               e.g. annotation:entity,w>10000 (see foliaindex --help)",file=sys.stderr)
     print("Parameters for processing directories:",file=sys.stderr)
     print("  -r                           Process recursively",file=sys.stderr)
     print("  -E [extension]               Set extension (default: xml)",file=sys.stderr)
     print("  -O                           Output each file to similarly named .freqlist file",file=sys.stderr)
     print("  -q                           Ignore errors",file=sys.stderr)
+    print("  -j [n]                       Number of parallel processes to use (default: 1)",file=sys.stderr)
+    print("  --progress                   Report progress and the processing time per file",file=sys.stderr)
+    print("  --fullparse                  Always fully parse documents. By default, the words are read in a streaming",file=sys.stderr)
+    print("                               fashion and the full parser is only used for documents that need it (e.g.",file=sys.stderr)
+    print("                               documents with corrections or untokenised documents)",file=sys.stderr)
 
 
 
+class FallbackRequired(Exception):
+    """Raised when a document can not be handled by the streaming fast path and requires a full parse"""
+    pass
 
 
-def process(filename):
-    try:
-        print("Processing " + filename,file=sys.stderr)
-        doc = folia.Document(file=filename)
+class ApproximateFrequencyList:
+    """Memory-bounded approximate frequency list. Counts are kept in a count-min sketch of fixed size, in which
+    estimates never fall below the true count and exceed it by at most error * total with the given confidence.
+    Alongside the sketch, a bounded set of candidate heavy hitters is maintained from which the top entries can be
+    output. Hashing is deterministic so lists computed in different processes with the same parameters can be merged.
+    Implements the parts of pynlpl's FrequencyList interface used by this tool."""
 
-        freqlist = FrequencyList()
+    CANDIDATEBYTES = 256 #rough memory estimate per candidate entry (string plus dictionary overhead)
 
-        if settings.n == 1:
-            for word in doc.words():
-                text = word.toktext()
-                if settings.casesensitive: text = text.lower()
-                freqlist.count(text)
-        elif settings.sentencemarkers:
-            for sentence in doc.sentences():
-                for ngram in Windower(sentence.words(), settings.n):
-                    text = ' '.join([x for x in ngram.toktext() ])
-                    if settings.casesensitive: text = text.lower()
-                    freqlist.count(text)
+    def __init__(self, error=0.00001, confidence=0.999, capacity=10000, memory=0):
+        self.depth = max(1, int(math.ceil(math.log(1 / (1 - confidence)))))
+        self.width = max(1, int(math.ceil(math.e / error)))
+        if memory:
+            budget = memory * 1024 * 1024 - 2 * capacity * self.CANDIDATEBYTES
+            maxwidth = int(budget // (self.depth * 8))
+            if maxwidth < 1:
+                raise ValueError("Memory budget too small for " + str(capacity) + " candidates")
+            self.width = min(self.width, maxwidth)
+        self.capacity = capacity
+        self.table = array('Q', bytes(8 * self.width * self.depth))
+        self.total = 0
+        self.candidates = {}
+        self.threshold = 0
+
+    def error(self):
+        """Returns the maximum amount by which an estimate exceeds the true count (with the configured confidence)"""
+        return math.e / self.width * self.total
+
+    def _indices(self, type):
+        digest = hashlib.blake2b(type.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [ i * self.width + (h1 + i * h2) % self.width for i in range(self.depth) ]
+
+    def estimate(self, type):
+        return min(self.table[i] for i in self._indices(type))
+
+    def count(self, type, amount=1):
+        table = self.table
+        estimate = None
+        for i in self._indices(type):
+            table[i] += amount
+            if estimate is None or table[i] < estimate:
+                estimate = table[i]
+        self.total += amount
+        if estimate > self.threshold or type in self.candidates or len(self.candidates) < self.capacity:
+            self.candidates[type] = estimate
+            if len(self.candidates) >= 2 * self.capacity:
+                self._prune()
+
+    def _prune(self):
+        """Reduces the candidates to the most frequent ones, with up-to-date estimates"""
+        ranked = sorted(((type, self.estimate(type)) for type in self.candidates), key=lambda x: (-x[1], x[0]))[:self.capacity]
+        self.candidates = dict(ranked)
+        self.threshold = ranked[-1][1] if len(ranked) >= self.capacity else 0
+
+    def update(self, other):
+        """Merges another approximate frequency list (with the same parameters) into this one"""
+        if (self.width, self.depth) != (other.width, other.depth):
+            raise ValueError("Can not merge approximate frequency lists with different parameters")
+        self.table = array('Q', map(operator.add, self.table, other.table))
+        self.total += other.total
+        for type in other.candidates:
+            self.candidates[type] = 0
+        self._prune()
+
+    def items(self):
+        """Returns (type, estimated count) pairs for the candidates, from frequent to rare"""
+        self._prune()
+        return list(self.candidates.items())
+
+    def __iter__(self):
+        return iter(self.items())
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def output(self, delimiter='\t', addnormalised=False):
+        for type, count in self:
+            if addnormalised:
+                yield type + delimiter + str(count) + delimiter + str(count/self.total)
+            else:
+                yield type + delimiter + str(count)
+
+    def save(self, filename, addnormalised=False):
+        with io.open(filename,'w',encoding='utf-8') as f:
+            for line in self.output("\t", addnormalised):
+                f.write(line + '\n')
+
+
+BINARYMAGIC = b'FOLIAFQL\x01'
+
+def encodevarint(n):
+    """Encodes a non-negative integer as a variable-length sequence of bytes (LEB128)"""
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return out
+
+
+def decodevarint(data, pos):
+    """Decodes a variable-length integer at the specified position, returns the integer and the position after it"""
+    n = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def writebinary(f, entries):
+    """Writes (type, count) pairs, with types as UTF-8 encoded bytes in sorted order, to a binary file. Each entry is
+    stored as the length of the prefix it shares with the previous type, the remaining bytes of the type and the count,
+    all lengths and counts are varint-encoded."""
+    f.write(BINARYMAGIC)
+    previous = b''
+    for type, count in entries:
+        prefix = 0
+        for a, b in zip(previous, type):
+            if a != b: break
+            prefix += 1
+        f.write(encodevarint(prefix) + encodevarint(len(type) - prefix) + type[prefix:] + encodevarint(count))
+        previous = type
+
+
+def savebinary(freqlist, filename):
+    """Saves a frequency list in binary format"""
+    with open(filename,'wb') as f:
+        writebinary(f, sorted((type.encode('utf-8'), count) for type, count in freqlist.items()))
+
+
+def readbinary(filename):
+    """Reads a binary frequency list, yields (type, count) pairs with types as UTF-8 encoded bytes in sorted order"""
+    with open(filename,'rb') as f:
+        if os.fstat(f.fileno()).st_size < len(BINARYMAGIC):
+            raise ValueError(filename + " is not a binary frequency list")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(BINARYMAGIC)] != BINARYMAGIC:
+                raise ValueError(filename + " is not a binary frequency list")
+            pos = len(BINARYMAGIC)
+            end = len(data)
+            previous = b''
+            while pos < end:
+                prefix, pos = decodevarint(data, pos)
+                length, pos = decodevarint(data, pos)
+                type = previous[:prefix] + data[pos:pos+length]
+                count, pos = decodevarint(data, pos + length)
+                yield type, count
+                previous = type
+
+
+def mergebinary(filenames):
+    """k-way merge of binary frequency lists, yields (type, count) pairs in sorted order, with the counts summed"""
+    current = None
+    total = 0
+    for type, count in heapq.merge(*(readbinary(filename) for filename in filenames), key=lambda x: x[0]):
+        if type == current:
+            total += count
         else:
-            for word in Windower(sentence.words(), settings.n, None, None):
-                text = ' '.join([x for x in ngram.toktext() ])
-                if settings.casesensitive: text = text.lower()
+            if current is not None:
+                yield current, total
+            current = type
+            total = count
+    if current is not None:
+        yield current, total
+
+
+def newfreqlist():
+    """Returns a new empty (exact or approximate) frequency list, according to the settings"""
+    if settings.approximate:
+        return ApproximateFrequencyList(settings.error, settings.confidence, settings.topk * 10 if settings.topk else settings.candidates, settings.memory)
+    else:
+        return FrequencyList()
+
+
+def streamwords(filename):
+    """Reads the words of a document in a streaming fashion, without building the full document in memory; elements
+    are discarded as soon as they have been processed. Yields (sentence, text) tuples, where sentence is the number of
+    the sentence the word is in (or None) and text is the tokenised text (of the current class) of the word, sentences
+    are announced by a (sentence, None) tuple. Raises FallbackRequired as soon as something is encountered that can only
+    be handled properly by the full parser, such as corrections or text markup."""
+    nsprefix = '{' + folia.NSFOLIA + '}'
+    fallbacktags = { nsprefix + tag: tag for tag in ('correction','alt','altlayers') }
+    sentence = None
+    sentences = 0
+    words = 0
+    for event, node in lxml.etree.iterparse(filename, events=('start','end'), huge_tree=True):
+        if event == 'start':
+            if node.tag == nsprefix + 's':
+                if sentence is not None:
+                    raise FallbackRequired("nested sentences")
+                sentences += 1
+                sentence = sentences
+                yield sentence, None
+            elif node.tag in fallbacktags:
+                raise FallbackRequired("document contains <" + fallbacktags[node.tag] + ">")
+        elif node.tag == nsprefix + 'w':
+            text = None
+            for child in node:
+                if child.tag == nsprefix + 't' and child.attrib.get('class','current') == 'current':
+                    if len(child) or child.attrib.get('{http://www.w3.org/XML/1998/namespace}space') == 'preserve':
+                        raise FallbackRequired("text markup")
+                    text = unicodedata.normalize('NFC', folia.norm_spaces(child.text or ""))
+            if not text:
+                raise FallbackRequired("word without text")
+            words += 1
+            yield sentence, text
+            node.clear()
+            while node.getprevious() is not None:
+                del node.getparent()[0]
+        elif node.tag in (nsprefix + 's', nsprefix + 'p', nsprefix + 'div'):
+            if node.tag == nsprefix + 's':
+                sentence = None
+            node.clear()
+            while node.getprevious() is not None:
+                del node.getparent()[0]
+    if not words:
+        raise FallbackRequired("document is not tokenised")
+
+
+def parsewords(filename):
+    """Reads the words of a document using the full parser, yields (sentence, text) tuples like streamwords()"""
+    doc = folia.Document(file=filename)
+    if settings.sentencemarkers and settings.n > 1:
+        for i, sentence in enumerate(doc.sentences()):
+            yield i, None
+            for word in sentence.words():
+                yield i, word.toktext()
+    else:
+        for word in doc.words():
+            yield None, word.toktext()
+
+
+def ngrams(tokens, n, beginmarker="<begin>", endmarker="<end>"):
+    """Yields all n-grams (tuples) over the tokens, padded with begin and end markers. Equivalent to pynlpl's Windower, which is not used as importing it loads pynlpl's deprecated FoLiA library as well"""
+    tokens = (beginmarker,) * (n - 1) + tuple(tokens) + (endmarker,) * (n - 1)
+    for i in range(0, len(tokens) - n + 1):
+        yield tokens[i:i+n]
+
+
+def count(freqlist, words):
+    """Counts the tokens or n-grams in a sequence of (sentence, text) tuples"""
+    if settings.n == 1:
+        for _, text in words:
+            if text is None: continue
+            if not settings.casesensitive: text = text.lower()
+            freqlist.count(text)
+    elif settings.sentencemarkers:
+        for sentence, sentencewords in itertools.groupby(words, key=lambda x: x[0]):
+            if sentence is None: continue #words outside of sentences
+            for ngram in ngrams([ text for _, text in sentencewords if text is not None ], settings.n):
+                text = ' '.join(ngram)
+                if not settings.casesensitive: text = text.lower()
+                freqlist.count(text)
+    else:
+        window = collections.deque(maxlen=settings.n)
+        for _, text in words:
+            if text is None: continue
+            window.append(text)
+            if len(window) == settings.n:
+                text = ' '.join(window)
+                if not settings.casesensitive: text = text.lower()
                 freqlist.count(text)
 
+
+_accumulator = {}
+
+def initaccumulator():
+    """Starts the approximate frequency list of a worker process, process() counts all documents the worker handles into it"""
+    _accumulator['freqlist'] = newfreqlist()
+
+def finalizeaccumulator():
+    """Returns the approximate frequency list of a worker process, once all documents are done"""
+    return _accumulator.pop('freqlist', None)
+
+
+def process(filename):
+    """Counts a document, returns its (exact) frequency list. In approximate mode, the counts are added to the approximate frequency list of the process instead (see processfiles()) and None is returned"""
+    freqlist = FrequencyList()
+    try:
+        print("Processing " + filename,file=sys.stderr)
+        counted = False
+        if settings.stream:
+            try:
+                count(freqlist, streamwords(filename))
+                counted = True
+            except FallbackRequired as e:
+                print(" Falling back to full parse (" + str(e) + ")",file=sys.stderr)
+                freqlist = FrequencyList()
+        if not counted:
+            count(freqlist, parsewords(filename))
+
         if settings.autooutput:
+            outext = '.freqbin' if settings.binary else '.freqlist'
             if filename[-len(settings.extension) - 1:].lower() == '.' +settings.extension:
-                outfilename = filename[:-len(settings.extension) - 1] + '.freqlist'
+                outfilename = filename[:-len(settings.extension) - 1] + outext
+            else:
+                outfilename = filename + outext
+            if settings.binary:
+                savebinary(freqlist, outfilename)
             else:
-                outfilename += '.freqlist'
-            freqlist.save(outfilename,True)
+                freqlist.save(outfilename,True)
     except Exception as e:
         if settings.ignoreerrors:
             print("ERROR: An exception was raised whilst processing " + filename, e,file=sys.stderr)
         else:
             raise
+        return None
 
+    if settings.approximate and 'freqlist' in _accumulator:
+        #counted per document first, so the sketch is updated once per type rather than once per token
+        merge(_accumulator['freqlist'], freqlist)
+        return None
     return freqlist
 
 
 
-def processdir(d, freqlist = None):
-    if not freqlist: freqlist = FrequencyList()
-    print("Searching in  " + d,file=sys.stderr)
-    for f in glob.glob(os.path.join(d ,'*')):
-        if f[-len(settings.extension) - 1:] == '.' + settings.extension:
-            freqlist += process(f)
-        elif settings.recurse and os.path.isdir(f):
-            processdir(f, freqlist)
+def merge(freqlist, other):
+    """Merges another frequency list into the first one (in-place, unlike the + operator)"""
+    if isinstance(freqlist, ApproximateFrequencyList) and isinstance(other, ApproximateFrequencyList):
+        freqlist.update(other)
+        return freqlist
+    for type, count in other.items():
+        freqlist.count(type, count)
     return freqlist
 
 
+def processfiles(files, freqlist = None):
+    """Map-reduce: computes partial frequency lists for the files through the corpus driver (in parallel if multiple jobs are set) and merges them in input order (so ties are ranked deterministically).
+
+    In approximate mode there is one approximate frequency list per process rather than per document, as every sketch is large: serially, documents are counted straight into the final list; in parallel, every worker process counts into its own list, and these are merged when all documents are done"""
+    if freqlist is None: freqlist = newfreqlist()
+    kwargs = {}
+    if settings.approximate and settings.jobs > 1:
+        kwargs = { 'initializer': initaccumulator, 'finalizer': finalizeaccumulator }
+    elif settings.approximate:
+        _accumulator['freqlist'] = freqlist
+    try:
+        for filename, partial in processcorpus(process, files, settings, **kwargs):
+            if partial is not None:
+                merge(freqlist, partial)
+    finally:
+        _accumulator.clear()
+    return freqlist
+
+
+def output(freqlist, outputfile = None):
+    """Outputs the frequency list, applying the minimum count and top-k cutoffs. These only filter the output: the frequency list itself is complete, so they do not bound memory (--approximate does)"""
+    for i, line in enumerate(freqlist.output("\t", True)):
+        if settings.topk and i >= settings.topk:
+            break
+        if settings.mincount > 1 and int(line.split("\t")[1]) < settings.mincount:
+            break #the output is sorted, so all remaining entries fall below the threshold as well
+        if outputfile:
+            outputfile.write(line + "\n")
+        else:
+            print(line)
+
+
 class settings:
     casesensitive = True
     autooutput = False
@@ -100,11 +450,25 @@ class settings:
     sentencemarkers = False
     ignoreerrors = False
     n = 1
+    jobs = 1
+    progress = False
+    mincount = 1
+    topk = 0
+    stream = True
+    approximate = False
+    error = 0.00001
+    confidence = 0.999
+    memory = 0
+    candidates = 10000
+    binary = False
+    merge = False
+    manifest = None
+    where = None
 
 
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "o:OE:htspwrq", ["help"])
+        opts, args = getopt.getopt(sys.argv[1:], "o:OE:e:hin:tspwrqj:m:k:b", ["help","progress","merge","manifest=","where=","fullparse","approximate","error=","confidence=","memory="])
     except getopt.GetoptError as err:
         print(str(err),file=sys.stderr)
         usage()
@@ -119,6 +483,36 @@ def main():
             sys.exit(0)
         elif o == '-e':
             settings.encoding = a
+        elif o == '-i':
+            settings.casesensitive = False
+        elif o == '-n':
+            settings.n = int(a)
+        elif o == '-j':
+            settings.jobs = int(a)
+        elif o == '--progress':
+            settings.progress = True
+        elif o == '-m':
+            settings.mincount = int(a)
+        elif o == '-k':
+            settings.topk = int(a)
+        elif o == '-b':
+            settings.binary = True
+        elif o == '--manifest':
+            settings.manifest = a
+        elif o == '--where':
+            settings.where = a
+        elif o == '--merge':
+            settings.merge = True
+        elif o == '--fullparse':
+            settings.stream = False
+        elif o == '--approximate':
+            settings.approximate = True
+        elif o == '--error':
+            settings.error = float(a)
+        elif o == '--confidence':
+            settings.confidence = float(a)
+        elif o == '--memory':
+            settings.memory = float(a)
         elif o == '-E':
             settings.extension = a
         elif o == '-o':
@@ -135,23 +529,58 @@ def main():
             raise Exception("No such option: " + o)
 
 
-    if outputfile: outputfile = io.open(outputfile,'w',encoding=settings.encoding)
+    if settings.manifest:
+        try:
+            args += manifestfiles(settings.manifest, settings.where)
+        except (FileNotFoundError, ValueError) as e:
+            print("ERROR: " + str(e),file=sys.stderr)
+            sys.exit(2)
 
-    if len(sys.argv) >= 2:
-        freqlist = FrequencyList()
-        for x in sys.argv[1:]:
-            if os.path.isdir(x):
-                processdir(x,freqlist)
-            elif os.path.isfile(x):
-                freqlist += process(x)
-            else:
-                print("ERROR: File or directory not found: " + x,file=sys.stderr)
+    if settings.binary and settings.approximate:
+        print("ERROR: Binary output is not supported for approximate counts",file=sys.stderr)
+        sys.exit(2)
+
+    if settings.binary:
+        outputfile = open(outputfile,'wb') if outputfile else sys.stdout.buffer
+    elif outputfile:
+        outputfile = io.open(outputfile,'w',encoding=settings.encoding)
+
+    if args and settings.merge:
+        for x in args:
+            if not os.path.isfile(x):
+                print("ERROR: File not found: " + x,file=sys.stderr)
                 sys.exit(3)
-        if outputfile:
-            freqlist.save(outputfile, True)
+        try:
+            if settings.binary:
+                writebinary(outputfile, mergebinary(args))
+            else:
+                freqlist = FrequencyList()
+                for type, count in mergebinary(args):
+                    freqlist.count(type.decode('utf-8'), count)
+                output(freqlist, outputfile)
+        except ValueError as e:
+            print("ERROR: " + str(e),file=sys.stderr)
+            sys.exit(3)
+        if outputfile: outputfile.close()
+    elif args:
+        try:
+            freqlist = newfreqlist()
+        except ValueError as e:
+            print("ERROR: " + str(e),file=sys.stderr)
+            sys.exit(2)
+        try:
+            files = findfiles(args, settings.extension, settings.recurse)
+        except FileNotFoundError as e:
+            print("ERROR: " + str(e),file=sys.stderr)
+            sys.exit(3)
+        processfiles(files, freqlist)
+        if settings.binary:
+            writebinary(outputfile, sorted((type.encode('utf-8'), count) for type, count in freqlist.items()))
         else:
-            for line in freqlist.output("\t", True):
-                print(line)
+            output(freqlist, outputfile)
+        if outputfile: outputfile.close()
+        if settings.approximate:
+            print("Approximate counts exceed the true counts by at most " + str(int(math.ceil(freqlist.error()))) + " (with probability " + str(settings.confidence) + ")",file=sys.stderr)
     else:
         print("ERROR: No files specified",file=sys.stderr)
         sys.exit(2)
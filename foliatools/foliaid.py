@@ -10,11 +10,10 @@ from __future__ import print_function, unicode_literals, division, absolute_impo
 import getopt
 import io
 import sys
-import os
-import glob
 from collections import Counter
 import folia.main as folia
 from foliatools import VERSION as TOOLVERSION
+from foliatools.common import findfiles, processcorpus
 
 def usage():
     print("foliaid",file=sys.stderr)
@@ -33,6 +32,8 @@ def usage():
     print("  -t [types]                   Output only these elements (comma separated list)", file=sys.stderr)
     print("  -P                           Like -O, but outputs to current working directory",file=sys.stderr)
     print("  -q                           Ignore errors",file=sys.stderr)
+    print("  -j [n]                       Number of parallel processes to use (default: 1)",file=sys.stderr)
+    print("  --progress                   Report progress and the processing time per file",file=sys.stderr)
 
 def out(s, outputfile):
     if sys.version < '3':
@@ -54,14 +55,13 @@ def process(filename, outputfile = None):
         processor = folia.Processor.create(name="foliaid",version=TOOLVERSION)
         assignids(doc, settings.types, True)
         doc.provenance.append(processor)
+        doc.save()
     except Exception as e:
         if settings.ignoreerrors:
             print("ERROR: An exception was raised whilst processing " + filename + ":", e, file=sys.stderr)
         else:
             raise
 
-    doc.save()
-
 def assignids(doc, types=None, verbose=False):
     for e in doc.data:
         if e.id is None:
@@ -85,25 +85,18 @@ def assignids(doc, types=None, verbose=False):
 
 
 
-def processdir(d, outputfile = None):
-    print("Processing directory  " + d, file=sys.stderr)
-    for f in glob.glob(os.path.join(d, '*')):
-        if f[-len(settings.extension) - 1:] == '.' + settings.extension:
-            process(f, outputfile)
-        elif settings.recurse and os.path.isdir(f):
-            rocessdir(f, outputfile)
-
-
 class settings:
     extension = 'xml'
     recurse = False
     ignoreerrors = False
     types = None
+    jobs = 1
+    progress = False
 
 
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "o:OPE:ht:spwrq", ["help"])
+        opts, args = getopt.getopt(sys.argv[1:], "o:OPE:ht:spwrqj:", ["help","progress"])
     except getopt.GetoptError as err:
         print(str(err), file=sys.stderr)
         usage()
@@ -125,6 +118,10 @@ def main():
             settings.types = a.split(',')
         elif o == '-q':
             settings.ignoreerrors = True
+        elif o == '-j':
+            settings.jobs = int(a)
+        elif o == '--progress':
+            settings.progress = True
         else:
             raise Exception("No such option: " + o)
 
@@ -132,14 +129,14 @@ def main():
     if outputfile: outputfile = io.open(outputfile,'w',encoding=settings.encoding)
 
     if args:
-        for x in args:
-            if os.path.isdir(x):
-                processdir(x,outputfile)
-            elif os.path.isfile(x):
-                process(x, outputfile)
-            else:
-                print("ERROR: File or directory not found: " + x, file=sys.stderr)
-                sys.exit(3)
+        try:
+            files = findfiles(args, settings.extension, settings.recurse)
+        except FileNotFoundError as e:
+            print("ERROR: " + str(e), file=sys.stderr)
+            sys.exit(3)
+        #documents are edited in place, so the order in which they are done does not matter
+        for _ in processcorpus(process, files, settings, ordered=False):
+            pass
 
     else:
         print("ERROR: Nothing to do, specify one or more files or directories", file=sys.stderr)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""
+Builds a manifest of a corpus of FoLiA documents: an SQLite database holding the path, size, hash, FoLiA version, declared annotation types, element counts and validation status of every document. Other tools (foliacount, foliafreqlist, folia2txt, foliavalidator) can select and order their input documents from the manifest through their --manifest and --where options, without parsing anything. Running foliaindex again on the same corpus only indexes new or modified documents.
+"""
+
+import sys
+import os
+import argparse
+import lxml.etree
+from foliatools import VERSION as TOOLVERSION
+from foliatools.common import hashfile, openmanifest, manifestfiles, findfiles, processcorpus
+from foliatools.foliacount import countelementsfast
+from foliatools.foliavalidator import capturedvalidate
+import folia.main as folia
+
+
+def readheader(filename):
+    """Reads the ID, the FoLiA version and the annotation declarations from the header of a document, stops reading as soon as the body starts. Returns an (id, version, declarations) tuple where declarations is a list of (type, set) tuples"""
+    nsprefix = '{' + folia.NSFOLIA + '}'
+    docid = version = None
+    declarations = []
+    for event, node in lxml.etree.iterparse(filename, events=('start','end'), huge_tree=True):
+        if event == 'start':
+            if node.tag == nsprefix + 'FoLiA':
+                docid = node.get('{http://www.w3.org/XML/1998/namespace}id')
+                version = node.get('version')
+            elif node.tag in (nsprefix + 'text', nsprefix + 'speech'):
+                break
+        elif node.tag == nsprefix + 'annotations':
+            for declaration in node:
+                if isinstance(declaration.tag, str) and declaration.tag.startswith(nsprefix) and declaration.tag.endswith('-annotation'):
+                    declarations.append( (declaration.tag[len(nsprefix):-len('-annotation')], declaration.get('set')) )
+    return docid, version, declarations
+
+
+_worker = {}
+
+def initworker(validation):
+    _worker['schema'] = lxml.etree.RelaxNG(folia.relaxng()) if validation else None
+    _worker['validation'] = validation
+
+def indexworker(filename):
+    """Indexes a single document, returns a record (dictionary) for the manifest"""
+    st = os.stat(filename)
+    record = { 'path': filename, 'mtime': st.st_mtime_ns, 'size': st.st_size, 'hash': hashfile(filename), 'id': None, 'version': None, 'valid': None, 'annotations': [], 'counts': {}, 'error': None }
+    try:
+        record['id'], record['version'], record['annotations'] = readheader(filename)
+        record['counts'] = countelementsfast(filename, expandrefs=False) #words referenced by span annotations are not counted again
+    except Exception as e:
+        record['error'] = e.__class__.__name__ + ": " + str(e)
+        record['valid'] = False
+        return record
+    if _worker['validation']:
+        r, out, err = capturedvalidate(filename, _worker['schema'])
+        record['valid'] = bool(r)
+    return record
+
+
+def store(db, record):
+    path = record['path']
+    db.execute("INSERT OR REPLACE INTO documents (path, mtime, size, hash, id, version, valid) VALUES (?, ?, ?, ?, ?, ?, ?)", (path, record['mtime'], record['size'], record['hash'], record['id'], record['version'], None if record['valid'] is None else int(record['valid'])))
+    db.execute("DELETE FROM annotations WHERE path = ?", (path,))
+    db.executemany("INSERT INTO annotations (path, type, annotationset) VALUES (?, ?, ?)", [ (path, annotationtype, annotationset) for annotationtype, annotationset in record['annotations'] ])
+    db.execute("DELETE FROM elements WHERE path = ?", (path,))
+    db.executemany("INSERT INTO elements (path, tag, count) VALUES (?, ?, ?)", [ (path, tag, count) for tag, count in record['counts'].items() ])
+
+
+#version of what is stored in the manifest, documents indexed by an earlier version are indexed again
+MANIFESTVERSION = 1
+
+def index(manifest, filenames, jobs=1, validation=True, prune=False):
+    """Adds the documents to the manifest, documents that are already in it and have not been modified since are skipped. Returns the number of (re)indexed documents"""
+    db = openmanifest(manifest)
+    if db.execute("PRAGMA user_version").fetchone()[0] < MANIFESTVERSION:
+        #earlier versions counted the words referenced by span annotations again for every reference
+        db.execute("UPDATE documents SET mtime = -1")
+        db.execute("PRAGMA user_version = " + str(MANIFESTVERSION))
+    filenames = [ os.path.abspath(filename) for filename in filenames ]
+    if prune:
+        known = set(filenames)
+        for (path,) in db.execute("SELECT path FROM documents").fetchall():
+            if path not in known:
+                print("Removing " + path,file=sys.stderr)
+                for table in ('documents','annotations','elements'):
+                    db.execute("DELETE FROM " + table + " WHERE path = ?", (path,))
+    pending = []
+    for filename in filenames:
+        st = os.stat(filename)
+        row = db.execute("SELECT mtime, size FROM documents WHERE path = ?", (filename,)).fetchone()
+        if row and row[0] == st.st_mtime_ns and row[1] == st.st_size:
+            continue
+        pending.append(filename)
+    print("Indexing " + str(len(pending)) + " of " + str(len(filenames)) + " document(s) using " + str(jobs) + " process(es)",file=sys.stderr)
+    for i, (_, record) in enumerate(processcorpus(indexworker, pending, argparse.Namespace(jobs=jobs), initializer=initworker, initargs=(validation,))):
+        if record['error']:
+            print("ERROR: Unable to index " + record['path'] + ": " + record['error'],file=sys.stderr)
+        else:
+            print("Indexed " + record['path'],file=sys.stderr)
+        store(db, record)
+        if i % 100 == 99:
+            db.commit()
+    db.commit()
+    db.close()
+    return len(pending)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-v','-V','--version',help="Show version information", action='version', version="FoLiA-tools v" + TOOLVERSION + ", using FoLiA v" + folia.FOLIAVERSION + " with library FoLiApy v" + folia.LIBVERSION, default=False)
+    parser.add_argument('-m','--manifest', type=str,help="The manifest (SQLite database) to build or query", action='store',default="manifest.sqlite")
+    parser.add_argument('-r','--recurse',help="Process recursively", action='store_true', default=False)
+    parser.add_argument('-E','--extension', type=str,help="Extension", action='store',default="xml")
+    parser.add_argument('-j','--jobs', type=int,help="Number of parallel processes to use", action='store',default=1)
+    parser.add_argument('--novalidate','--no-validate',help="Do not validate the documents, their validation status will be unknown", action='store_true', default=False)
+    parser.add_argument('--prune',help="Remove documents from the manifest that are not among the specified files (or no longer exist)", action='store_true', default=False)
+    parser.add_argument('-l','--list',help="Do not index anything but list the documents in the manifest (use with --where)", action='store_true', default=False)
+    parser.add_argument('-w','--where', type=str,help="Only list documents matching these constraints (comma separated, all must hold). Constraints take the form tag>count (or >=, <, <=, ==, !=; e.g. w>10000), tag (at least one element), annotation:type or annotation:type@set (e.g. annotation:entity), valid or invalid", action='store',default=None)
+    parser.add_argument('files', nargs='*', help='Files (and/or directories) to index')
+    args = parser.parse_args()
+
+    if args.list:
+        try:
+            for filename in manifestfiles(args.manifest, args.where):
+                print(filename)
+        except (FileNotFoundError, ValueError) as e:
+            print("ERROR: " + str(e),file=sys.stderr)
+            sys.exit(2)
+    elif args.files:
+        try:
+            filenames = findfiles(args.files, args.extension, args.recurse)
+        except FileNotFoundError as e:
+            print("ERROR: " + str(e),file=sys.stderr)
+            sys.exit(3)
+        index(args.manifest, filenames, args.jobs, not args.novalidate, args.prune)
+    else:
+        print("ERROR: No files specified. Add --help for usage details.",file=sys.stderr)
+        sys.exit(2)
+
+if __name__ == "__main__":
+    main()
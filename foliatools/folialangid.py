@@ -8,7 +8,6 @@ import argparse
 import glob
 import shutil
 import folia.main as folia
-from langid.langid import LanguageIdentifier, model
 from socket import getfqdn
 from foliatools import VERSION as TOOLVERSION
 from foliatools.foliavalidator import validate
@@ -36,10 +35,19 @@ def main():
     success = process(*args.files, **args.__dict__)
     sys.exit(0 if success else 1)
 
+_identifier = None
+
+def loadidentifier(languages=None):
+    """Returns the language identifier, constrained to the languages (comma separated) if specified. The model is loaded only once per process"""
+    global _identifier
+    if _identifier is None:
+        from langid.langid import LanguageIdentifier, model #heavy (loads numpy and the model), so only imported once actually needed
+        _identifier = LanguageIdentifier.from_modelstring(model, norm_probs=True)
+    _identifier.set_languages(languages.split(',') if languages else None)
+    return _identifier
+
 def processdoc(doc, **kwargs):
-    identifier = LanguageIdentifier.from_modelstring(model, norm_probs=True)
-    if 'languages' in kwargs and kwargs['languages']:
-        identifier.set_languages(kwargs['languages'].split(','))
+    identifier = loadidentifier(kwargs.get('languages'))
     if 'confidence' in kwargs:
         confidencethreshold = kwargs['confidence']
     else:
@@ -8,9 +8,20 @@ from __future__ import print_function, unicode_literals, division, absolute_impo
 import getopt
 import sys
 import os
-import glob
+import collections
+import lxml.etree
 from folia import fql
 import folia.main as folia
+from foliatools.common import findfiles, processcorpus
+from foliatools.folia2txt import textcontainer
+
+NSPREFIX = '{' + folia.NSFOLIA + '}'
+NSLEN = len(NSPREFIX)
+XMLID = '{http://www.w3.org/XML/1998/namespace}id'
+XMLSPACE = '{http://www.w3.org/XML/1998/namespace}space'
+
+#query actions that modify the document, queries with these are never run in parallel
+EDITACTIONS = ('EDIT','DELETE','SUBSTITUTE','PREPEND','APPEND')
 
 def usage():
     print("foliaquery",file=sys.stderr)
@@ -29,21 +40,35 @@ def usage():
     print("  -r                           Process recursively",file=sys.stderr)
     print("  -E [extension]               Set extension (default: xml)",file=sys.stderr)
     print("  -i                           Ignore errors",file=sys.stderr)
+    print("  -j [n], --jobs [n]           Number of parallel processes to use (default: 1). Only for read-only queries: the documents",file=sys.stderr)
+    print("                               are queried in parallel and the results are output in the order of the documents.",file=sys.stderr)
+    print("                               Queries that modify documents (EDIT, DELETE, SUBSTITUTE, PREPEND, APPEND) always",file=sys.stderr)
+    print("                               run on one document at a time",file=sys.stderr)
+    print("  --progress                   Report progress and the processing time per file",file=sys.stderr)
+    print("Parameters for using an index:",file=sys.stderr)
+    print("  --index [file]               Build or update a persistent inverted index (SQLite) of the documents: the text of the",file=sys.stderr)
+    print("                               words and the classes of all annotations, mapped to documents and element IDs. Only new or",file=sys.stderr)
+    print("                               modified documents are (re)indexed. SELECT queries that constrain on word text or classes",file=sys.stderr)
+    print("                               (e.g. SELECT w WHERE text = \"de\" AND :pos = \"LID\") are then only run on the documents",file=sys.stderr)
+    print("                               that can match, others are not even parsed (the output for them is the same empty result",file=sys.stderr)
+    print("                               as without the index). Without -q, only the index is built",file=sys.stderr)
     print("",file=sys.stderr)
 
 
 
 def process(filename, queries):
+    """Runs the queries (FQL strings, these are parsed again for each document as parsed queries can not be passed to worker processes) on a document"""
     try:
         print("Processing " + filename, file=sys.stderr)
         doc = folia.Document(file=filename)
         dosave = False
         for query in queries:
+            query = fql.Query(query)
             if query.format == "python":
                 query.format = "xml"
             output = query(doc)
             print(output)
-            if query.action and query.action.action in ('EDIT','DELETE','SUBSTITUTE','PREPEND','APPEND'):
+            if query.action and query.action.action in EDITACTIONS:
                 dosave = True
         #save document if changes are made
         if dosave:
@@ -55,14 +80,196 @@ def process(filename, queries):
         else:
             raise
 
+def emptyoutput(queries):
+    """Returns what process() prints for the queries (FQL strings) on a document without any matches, obtained by running them on an empty document"""
+    doc = folia.Document(id="empty")
+    outputs = []
+    for query in queries:
+        query = fql.Query(query)
+        if query.format == "python":
+            query.format = "xml"
+        outputs.append(query(doc))
+    return outputs
+
+def processcandidate(filename, queries, candidates, emptyoutputs):
+    """Like process(), but documents the index has ruled out (not in candidates) are not parsed at all, the output of the queries for a document without matches is printed for them instead. This way the output is the same with or without an index"""
+    if filename in candidates:
+        process(filename, queries)
+    else:
+        for output in emptyoutputs:
+            print(output)
+
+
+def readonly(queries):
+    """Returns True if none of the queries (FQL strings) modify the documents"""
+    for query in queries:
+        query = fql.Query(query)
+        if query.action and query.action.action in EDITACTIONS:
+            return False
+    return True
+
+
+def indexdocument(filename):
+    """Extracts the postings for the query index from a document, in a single streaming pass: the text of every word (feature 't') and the class of every annotation (or other element with a class, the feature is its tag), mapped to the IDs of the elements they pertain to (the spanned words for span annotations). Returns a dictionary mapping (feature, value) tuples to lists of IDs"""
+    postings = collections.defaultdict(list)
+    stack = [] #[tag, id, wrefs] for all open elements
+    intext = 0 #depth within a text content element, whose subtree is needed as a whole
+    inword = 0
+    for event, node in lxml.etree.iterparse(filename, events=('start','end'), huge_tree=True):
+        tag = node.tag[NSLEN:] if isinstance(node.tag, str) and node.tag.startswith(NSPREFIX) else None
+        if event == 'start':
+            if intext or tag == 't':
+                intext += 1
+            elif tag == 'w':
+                inword += 1
+            stack.append([tag, node.get(XMLID), []])
+            continue
+        tag, id, wrefs = stack.pop()
+        if intext:
+            intext -= 1
+            if intext:
+                continue
+            if inword:
+                text = textcontainer(node, node.get(XMLSPACE) == 'preserve')
+                ids = [ frame[1] for frame in reversed(stack) if frame[0] == 'w' ][:1] #the enclosing word, also for text inside a correction
+                postings[('t', text)] += [ id for id in ids if id ]
+        elif tag == 'wref':
+            if stack and node.get('id'):
+                stack[-1][2].append(node.get('id'))
+        elif tag is not None:
+            if tag == 'w':
+                inword -= 1
+            cls = node.get('class')
+            if cls is not None and tag != 'ph':
+                if wrefs:
+                    ids = wrefs
+                else:
+                    ids = [ frame[1] for frame in reversed(stack) if frame[1] ][:1] if not id else [id]
+                postings[(tag, cls)] += ids
+            if wrefs and stack and tag in folia.XML2CLASS and issubclass(folia.XML2CLASS[tag], folia.AbstractSpanRole):
+                stack[-1][2] += wrefs #the words spanned by a role (e.g. the head of a dependency) are spanned by the annotation too
+        if node.getparent() is not None:
+            node.clear()
+            while node.getprevious() is not None:
+                del node.getparent()[0]
+    return postings
+
+
+def queryterms(query):
+    """Analyses an FQL query (a string) and returns the (feature, value) terms that any document with a match must contain according to the index, or None if the query can not be resolved through the index (it is not a SELECT query or it does not constrain on indexed features in a way that can be used)"""
+    q = fql.UnparsedQuery(query)
+    if not q.kw(0, 'SELECT') or q[1] not in folia.XML2CLASS:
+        return None
+    i = 2
+    while q.kw(i, ('OF','ID')):
+        i += 2
+    if not q.kw(i, 'WHERE'):
+        return None
+    return filterterms(q, i + 1, q[1]) or None
+
+def filterterms(q, i, tag):
+    """Returns the terms implied by the conditions (WHERE clause) in the unparsed query q, from position i on, on elements with the specified tag. Only conjunctions of equality conditions on the text (of words) or the class, and of HAS conditions on children, are used; anything else contributes no terms"""
+    terms = []
+    while i < len(q):
+        if isinstance(q[i], fql.UnparsedQuery):
+            terms += filterterms(q[i], 0, tag)
+            i += 1
+        elif q.kw(i, 'NOT') or q.kw(i, ("PREVIOUS","NEXT","LEFTCONTEXT","RIGHTCONTEXT","CONTEXT","PARENT","ANCESTOR","CHILD")) or q[i].startswith(("PREVIOUS","NEXT")):
+            return []
+        elif q[i+1] in fql.OPERATORS:
+            if q[i+1] in ('=','=='):
+                if q[i] == 'class' and tag not in ('t','ph'): #the classes of text and phonetic content are not indexed
+                    terms.append( (tag, q[i+2]) )
+                elif q[i] == 'text' and tag == 'w':
+                    terms.append( ('t', q[i+2]) )
+            i += 3
+        elif any(q.kw(j, 'HAS') for j in range(i, len(q))) and q[i] in folia.XML2CLASS:
+            #HAS statement on a child, spans the rest of the (sub)query
+            childtag = q[i]
+            while not q.kw(i, 'HAS') and i < len(q):
+                i += 1
+            return terms + filterterms(q, i + 1, childtag)
+        else:
+            return []
+        if q.kw(i, 'OR'):
+            return []
+        elif q.kw(i, 'AND'):
+            i += 1
+        else:
+            break #end of the conditions
+    return terms
+
+
+class QueryIndex:
+    """Persistent inverted index of a corpus (SQLite), maps the text of words and the classes of annotations to the documents and the IDs of the elements they occur on. Documents are remembered by path, modification time and size, so only new or modified documents need to be indexed again."""
+
+    def __init__(self, filename):
+        import sqlite3 #only needed with an index
+        self.filename = filename
+        self.db = sqlite3.connect(filename, timeout=60)
+        self.db.execute("CREATE TABLE IF NOT EXISTS documents (path TEXT NOT NULL PRIMARY KEY, mtime INTEGER NOT NULL, size INTEGER NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS postings (feature TEXT NOT NULL, value TEXT NOT NULL, path TEXT NOT NULL, ids TEXT NOT NULL, PRIMARY KEY (feature, value, path))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS postings_path ON postings (path)")
+        self.db.commit()
+
+    def pending(self, filenames):
+        """Returns those of the files that are not in the index yet or were modified since they were indexed"""
+        pending = []
+        for filename in filenames:
+            st = os.stat(filename)
+            row = self.db.execute("SELECT mtime, size FROM documents WHERE path = ?", (os.path.abspath(filename),)).fetchone()
+            if not row or row[0] != st.st_mtime_ns or row[1] != st.st_size:
+                pending.append(filename)
+        return pending
 
-def processdir(d, queries):
-    print("Searching in  " + d,file=sys.stderr)
-    for f in glob.glob(os.path.join(d ,'*')):
-        if f[-len(settings.extension) - 1:] == '.' + settings.extension:
-            process(f, queries)
-        elif settings.recurse and os.path.isdir(f):
-            processdir(f, queries)
+    def store(self, filename, postings):
+        """Stores the postings for a document (as returned by indexdocument()), replacing any earlier ones. If postings is None (the document could not be indexed), the document is removed from the index"""
+        path = os.path.abspath(filename)
+        self.db.execute("DELETE FROM postings WHERE path = ?", (path,))
+        if postings is None:
+            self.db.execute("DELETE FROM documents WHERE path = ?", (path,))
+            return
+        st = os.stat(filename)
+        self.db.execute("INSERT OR REPLACE INTO documents (path, mtime, size) VALUES (?, ?, ?)", (path, st.st_mtime_ns, st.st_size))
+        self.db.executemany("INSERT INTO postings (feature, value, path, ids) VALUES (?, ?, ?, ?)", [ (feature, value, path, " ".join(ids)) for (feature, value), ids in postings.items() ])
+
+    def candidates(self, filenames, queries):
+        """Returns those of the files on which any of the queries might match, in the same order. Documents that are not (or no longer) in the index are always included"""
+        termsets = [ queryterms(query) for query in queries ]
+        if any(terms is None for terms in termsets):
+            return filenames
+        paths = set()
+        for terms in termsets:
+            sql = " INTERSECT ".join("SELECT path FROM postings WHERE feature = ? AND value = ?" for _ in terms)
+            paths.update(row[0] for row in self.db.execute(sql, [ x for term in terms for x in term ]))
+        indexed = set(row[0] for row in self.db.execute("SELECT path FROM documents"))
+        return [ filename for filename in filenames if os.path.abspath(filename) in paths or os.path.abspath(filename) not in indexed ]
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def indexworker(filename):
+    """Indexes a single document, returns None if it can not be indexed (it is then simply queried as if there were no index, which reports the error)"""
+    try:
+        return indexdocument(filename)
+    except Exception as e:
+        print("WARNING: Unable to index " + filename + ": " + str(e),file=sys.stderr)
+        return None
+
+def updateindex(index, files):
+    """Indexes the documents that are new or modified since they were last indexed"""
+    pending = index.pending(files)
+    print("Indexing " + str(len(pending)) + " of " + str(len(files)) + " document(s)",file=sys.stderr)
+    for i, (filename, postings) in enumerate(processcorpus(indexworker, pending, settings)):
+        index.store(filename, postings)
+        if i % 100 == 99:
+            index.commit()
+    index.commit()
 
 
 class settings:
@@ -76,10 +283,14 @@ class settings:
     ignoreerrors = False
     casesensitive = True
 
+    jobs = 1
+    progress = False
+    index = None
+
 
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "o:OE:hq:nr", ["help","text=","pos=","lemma=","sense=","phon="])
+        opts, args = getopt.getopt(sys.argv[1:], "o:OE:hq:nrj:", ["help","jobs=","progress","index=","text=","pos=","lemma=","sense=","phon="])
     except getopt.GetoptError as err:
         print(str(err), file=sys.stderr)
         usage()
@@ -101,22 +312,45 @@ def main():
             settings.ignoreerrors = True
         elif o == '-q':
             try:
-                queries.append(fql.Query(a))
+                fql.Query(a)
+                queries.append(a)
             except Exception as e:
                 print("FQL SYNTAX ERROR: " + str(e), file=sys.stderr)
+        elif o == '-j' or o == '--jobs':
+            settings.jobs = int(a)
+        elif o == '--progress':
+            settings.progress = True
+        elif o == '--index':
+            settings.index = a
         else:
             raise Exception("No such option: " + o)
 
+    if settings.jobs > 1 and not readonly(queries):
+        print("WARNING: Queries that modify documents are run on one document at a time, ignoring -j",file=sys.stderr)
+        settings.jobs = 1
 
-    if queries and args:
-        for x in args:
-            if os.path.isdir(x):
-                processdir(x, queries)
-            elif os.path.isfile(x):
-                process(x, queries)
-            elif x[0:2] != '--':
-                print("ERROR: File or directory not found: " + x,file=sys.stderr)
-                sys.exit(3)
+    if settings.index and args:
+        try:
+            files = findfiles(args, settings.extension, settings.recurse)
+        except FileNotFoundError as e:
+            print("ERROR: " + str(e),file=sys.stderr)
+            sys.exit(3)
+        index = QueryIndex(settings.index)
+        updateindex(index, files)
+        if queries:
+            candidates = index.candidates(files, queries)
+            print("Querying " + str(len(candidates)) + " of " + str(len(files)) + " document(s), selected using the index",file=sys.stderr)
+            for _ in processcorpus(processcandidate, files, settings, (queries, set(candidates), emptyoutput(queries)), spool=True):
+                pass
+        index.close()
+    elif queries and args:
+        try:
+            files = findfiles(args, settings.extension, settings.recurse)
+        except FileNotFoundError as e:
+            print("ERROR: " + str(e),file=sys.stderr)
+            sys.exit(3)
+        for _ in processcorpus(process, files, settings, (queries,), spool=True):
+            pass
     elif not queries:
         docs = []
         if len(args) > 50:
@@ -152,7 +386,7 @@ def main():
             for doc in docs:
                 output = query(doc)
                 print(output)
-                if query.action and query.action.action in ('EDIT','DELETE','SUBSTITUTE','PREPEND','APPEND'):
+                if query.action and query.action.action in EDITACTIONS:
                     if not doc in savedocs:
                         savedocs.append(doc)
 
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+"""
+Runs the FoLiA tools as a long-lived service, for pipelines that make many small calls. A pool of worker processes keeps everything that is expensive to set up warm: the Python interpreter, the FoLiA library, the compiled RelaxNG schema, compiled XSL stylesheets, the language identification model and fetched set definitions. Documents are validated, converted (txt, columns, html, stam), counted, queried or language-identified over HTTP, either on a local TCP port or on a Unix socket. When all workers are busy and the queue is full, requests are refused right away with 503 Service Unavailable, so clients can back off instead of piling up.
+"""
+
+import sys
+import os
+import io
+import json
+import time
+import argparse
+import tempfile
+import threading
+import contextlib
+import socketserver
+import http.server
+import urllib.parse
+import lxml.etree
+from foliatools import VERSION as TOOLVERSION
+from foliatools import folia2txt, folia2columns, foliacount, xslt
+from foliatools.foliavalidator import capturedvalidate
+import folia.main as folia
+import folia.fql as fql
+
+
+class RequestError(Exception):
+    """Raised for invalid request parameters, reported to the client as 400 Bad Request"""
+    pass
+
+
+def flag(params, key, default=False):
+    """Returns whether a boolean request parameter is set (?key, ?key=1, ?key=yes; ?key=0, ?key=no to unset)"""
+    if key not in params:
+        return default
+    return params[key][-1].lower() not in ('0','no','false','off')
+
+def param(params, key, default=None):
+    """Returns the (last) value of a request parameter"""
+    return params[key][-1] if key in params else default
+
+
+#state of a worker process
+_worker = {}
+
+def initworker():
+    """Warms up a worker process: compiles the schema and the stylesheet and loads the language identification model once, for all requests this worker will serve"""
+    _worker['schema'] = lxml.etree.RelaxNG(folia.relaxng())
+    _worker['setdefinitions'] = {} #set definitions fetched for deep validation, shared by all requests
+    #the tools are configured through their settings classes, these are reset to their defaults for every request
+    _worker['defaults'] = { module: dict(vars(module.settings)) for module in (folia2txt, folia2columns, foliacount) }
+    xslt.loadstylesheet('folia2html.xsl')
+    try:
+        from foliatools.folialangid import loadidentifier
+        loadidentifier()
+    except ImportError:
+        pass
+
+def configure(module, **values):
+    """Resets the settings of a tool to their defaults and applies the values"""
+    settings = module.settings
+    for key, value in _worker['defaults'][module].items():
+        if not key.startswith('_'):
+            setattr(settings, key, list(value) if isinstance(value, list) else value)
+    for key, value in values.items():
+        setattr(settings, key, value)
+
+
+def servevalidate(filename, params):
+    stats = {}
+    kwargs = { 'deep': flag(params,'deep'), 'quick': flag(params,'quick'), 'schemaonly': flag(params,'schemaonly'), 'stricttextvalidation': flag(params,'stricttextvalidation'), 'setdefinitions': _worker['setdefinitions'] }
+    valid, out, err = capturedvalidate(filename, _worker['schema'], stats, **kwargs)
+    stats.update(valid=valid, messages=err)
+    print(json.dumps(stats))
+
+def servetxt(filename, params):
+    unit = param(params, 'unit')
+    if unit not in (None, 'word', 'sentence', 'paragraph'):
+        raise RequestError("Unknown unit: choose from word, sentence, paragraph")
+    configure(folia2txt, wordperline=unit == 'word', sentenceperline=unit == 'sentence', paragraphperline=unit == 'paragraph', retaintokenisation=flag(params,'retaintokenisation'), textclass=param(params,'textclass','current'), correctionhandling=folia.CorrectionHandling.ORIGINAL if flag(params,'original') else folia.CorrectionHandling.CURRENT, stream=flag(params,'stream'))
+    folia2txt.process(filename)
+
+def servecolumns(filename, params):
+    columns = param(params, 'columns')
+    if not columns:
+        raise RequestError("No column configuration specified (set columns, e.g. columns=id,text,pos)")
+    unit = param(params, 'unit', 'word')
+    if unit not in ('word', 'sentence', 'paragraph'):
+        raise RequestError("Unknown unit: choose from word, sentence, paragraph")
+    unsupported = folia2columns.unsupportedcolumn(columns.split(','), unit)
+    if unsupported is not None:
+        raise RequestError("Unsupported column for unit " + unit + ": " + unsupported)
+    configure(folia2columns, columnconf=columns.split(','), unit=unit, csv=flag(params,'csv'), output_header=flag(params,'header',True), sentencespacing=flag(params,'sentencespacing',True), tok=flag(params,'tok'), nicespacing=int(param(params,'nicespacing',0)))
+    folia2columns.process(filename)
+
+def servehtml(filename, params):
+    xslt.transform('folia2html.xsl', filename, None, 'utf-8', css=param(params,'css',''), textclass=param(params,'textclass','current'))
+
+def servestam(filename, params):
+    import stam #optional, only needed for this conversion
+    from foliatools.folia2stam import convert
+    annotationstore = stam.AnnotationStore(id=param(params, 'id', 'foliaserve'))
+    modes = {}
+    for key in ('inline_annotations_mode', 'span_annotations_mode'):
+        modes[key] = param(params, key, 'textselector').lower()
+        if modes[key] not in ('annotationselector', 'textselector'):
+            raise RequestError(key + " must be annotationselector or textselector")
+    convert(filename, annotationstore, external_resources=False, **modes)
+    print(annotationstore.to_json_string())
+
+def servecount(filename, params):
+    configure(foliacount, types=param(params,'types').split(',') if param(params,'types') else None)
+    print(json.dumps(foliacount.select(filename, foliacount.countelementsfast(filename))))
+
+def servequery(filename, params):
+    queries = [ fql.Query(q) for q in params.get('q',[]) ]
+    if not queries:
+        raise RequestError("No query specified (set q)")
+    for query in queries:
+        if query.action and query.action.action in ('EDIT','DELETE','SUBSTITUTE','PREPEND','APPEND'):
+            raise RequestError("Only queries that do not modify the document are supported")
+    doc = folia.Document(file=filename)
+    for query in queries:
+        if query.format == "python":
+            query.format = "xml"
+        print(query(doc))
+
+def servelangid(filename, params):
+    from foliatools.folialangid import processdoc
+    kwargs = { 'languages': param(params,'languages'), 'types': param(params,'types'), 'textclass': param(params,'textclass','current'), 'confidence': float(param(params,'confidence',0.0)) }
+    if 'fallback' in params:
+        kwargs['fallback'] = param(params,'fallback')
+    doc = folia.Document(file=filename, autodeclare=True)
+    processdoc(doc, **kwargs)
+    print(doc.xmlstring())
+
+
+#path => (function, content type)
+OPERATIONS = {
+    '/validate': (servevalidate, 'application/json'),
+    '/convert/txt': (servetxt, 'text/plain'),
+    '/convert/columns': (servecolumns, 'text/plain'),
+    '/convert/html': (servehtml, 'text/html'),
+    '/convert/stam': (servestam, 'application/json'),
+    '/count': (servecount, 'application/json'),
+    '/query': (servequery, 'text/plain'),
+    '/langid': (servelangid, 'application/xml'),
+}
+
+def serveworker(path, params, filename, data):
+    """Handles a request in a worker process, on the posted document (data) or on a file local to the server. Returns a (status, output, log) tuple: everything the operation prints to stdout is the output, what it prints to stderr is the log"""
+    if data is not None:
+        with tempfile.NamedTemporaryFile(prefix='foliaserve', suffix='.folia.xml', delete=False) as f:
+            f.write(data)
+            filename = f.name
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            OPERATIONS[path][0](filename, params)
+        return 200, stdout.getvalue(), stderr.getvalue()
+    except RequestError as e:
+        return 400, str(e) + "\n", stderr.getvalue()
+    except Exception as e:
+        return 500, e.__class__.__name__ + ": " + str(e) + "\n", stderr.getvalue()
+    except SystemExit as e:
+        #the tools call sys.exit() on errors, that must not take the worker down with it
+        return 500, "Operation exited with status " + str(e.code) + "\n", stderr.getvalue()
+    finally:
+        if data is not None:
+            os.unlink(filename)
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" #keep connections alive, clients may send many requests over one connection
+    server_version = "foliaserve/" + TOOLVERSION
+
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def reply(self, status, body, contenttype='text/plain', headers=None):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', contenttype + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.dispatch(None)
+
+    def do_POST(self):
+        self.dispatch(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+    def dispatch(self, data):
+        url = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+        server = self.server
+        if url.path == '/status':
+            self.reply(200, json.dumps(server.status()), 'application/json')
+            return
+        elif url.path not in OPERATIONS:
+            self.reply(404, "No such operation, choose from: " + ", ".join(sorted(OPERATIONS)) + "\n")
+            return
+        filename = None
+        if not data:
+            data = None
+            if 'file' not in params:
+                self.reply(400, "No document: post a document or pass a file (with --allowfiles)\n")
+                return
+            elif not server.allowfiles:
+                self.reply(403, "Processing files on the server is not enabled (start the server with --allowfiles)\n")
+                return
+            filename = os.path.abspath(param(params, 'file'))
+            if not os.path.isfile(filename):
+                self.reply(404, "File not found: " + filename + "\n")
+                return
+        #backpressure: refuse the request outright rather than letting work pile up
+        if not server.slots.acquire(blocking=False):
+            with server.lock:
+                server.refused += 1
+            self.reply(503, "Server busy, try again later\n", headers={'Retry-After': '1'})
+            return
+        #the slot is only released once the worker is done with the request, also if we stop waiting for it
+        release = lambda _: server.slots.release()
+        try:
+            result = server.pool.apply_async(serveworker, (url.path, params, filename, data), callback=release, error_callback=release)
+        except Exception:
+            server.slots.release()
+            raise
+        from multiprocessing import TimeoutError as WorkerTimeout #already loaded by the pool
+        try:
+            status, output, log = result.get(server.timeout)
+        except WorkerTimeout:
+            status, output, log = 504, "Request timed out\n", ""
+        with server.lock:
+            server.served += 1
+            if status != 200: server.failed += 1
+        if status == 200:
+            self.reply(status, output, OPERATIONS[url.path][1])
+        else:
+            self.reply(status, output + log)
+
+
+class ServerMixIn(socketserver.ThreadingMixIn):
+    """The state shared by the request handlers: the worker pool and the queue of requests in progress"""
+    daemon_threads = True
+
+    def setupserver(self, pool, jobs, queue, timeout, allowfiles, verbose):
+        self.pool = pool
+        self.jobs = jobs
+        self.queue = queue
+        self.slots = threading.BoundedSemaphore(queue)
+        self.timeout = timeout
+        self.allowfiles = allowfiles
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.begintime = time.time()
+        self.served = self.failed = self.refused = 0
+
+    def status(self):
+        with self.lock:
+            return { 'version': TOOLVERSION, 'jobs': self.jobs, 'queue': self.queue, 'uptime': round(time.time() - self.begintime, 3), 'served': self.served, 'failed': self.failed, 'refused': self.refused }
+
+class TCPServer(ServerMixIn, http.server.HTTPServer):
+    pass
+
+class UnixServer(ServerMixIn, socketserver.UnixStreamServer):
+    pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__ + "\n\nExample: curl --data-binary @doc.folia.xml 'http://localhost:8080/convert/txt?unit=sentence'. Operations: " + ", ".join(sorted(OPERATIONS)) + ", and /status for statistics.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-v','-V','--version',help="Show version information", action='version', version="FoLiA-tools v" + TOOLVERSION + ", using FoLiA v" + folia.FOLIAVERSION + " with library FoLiApy v" + folia.LIBVERSION, default=False)
+    parser.add_argument('-s','--socket', type=str,help="Listen on this Unix socket instead of a TCP port", action='store',default=None)
+    parser.add_argument('-H','--host', type=str,help="Host/interface to listen on", action='store',default="127.0.0.1")
+    parser.add_argument('-p','--port', type=int,help="Port to listen on", action='store',default=8080)
+    parser.add_argument('-j','--jobs', type=int,help="Number of worker processes", action='store',default=os.cpu_count())
+    parser.add_argument('--queue', type=int,help="Maximum number of requests in progress (being processed or waiting for a worker), further requests are refused with 503 Service Unavailable. Defaults to four per worker", action='store',default=None)
+    parser.add_argument('--timeout', type=float,help="Maximum time (in seconds) to wait for the result of a request", action='store',default=300)
+    parser.add_argument('--maxtasks', type=int,help="Replace a worker process after it has served this many requests (to release memory); by default workers live as long as the server", action='store',default=None)
+    parser.add_argument('--allowfiles',help="Allow clients to process files on the server (?file=path) instead of posting the document", action='store_true',default=False)
+    parser.add_argument('--verbose',help="Log every request to stderr", action='store_true',default=False)
+    args = parser.parse_args()
+
+    import multiprocessing #only needed once the server starts, not for --help
+    queue = args.queue or 4 * args.jobs
+    print("Starting " + str(args.jobs) + " worker process(es)",file=sys.stderr)
+    with multiprocessing.Pool(args.jobs, initworker, maxtasksperchild=args.maxtasks) as pool:
+        if args.socket:
+            if os.path.exists(args.socket):
+                os.unlink(args.socket)
+            server = UnixServer(args.socket, RequestHandler)
+            address = args.socket
+        else:
+            server = TCPServer((args.host, args.port), RequestHandler)
+            address = "http://" + args.host + ":" + str(args.port)
+        server.setupserver(pool, args.jobs, queue, args.timeout, args.allowfiles, args.verbose)
+        print("Listening on " + address,file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if args.socket and os.path.exists(args.socket):
+                os.unlink(args.socket)
+
+if __name__ == "__main__":
+    main()
@@ -15,10 +15,9 @@ from __future__ import print_function, unicode_literals, division, absolute_impo
 
 import getopt
 import sys
-import os
-import glob
 import folia.main as folia
 from foliatools import VERSION as TOOLVERSION
+from foliatools.common import findfiles, processcorpus
 
 def usage():
     print("foliatextcontent",file=sys.stderr)
@@ -48,6 +47,9 @@ def usage():
     print("Parameters for processing directories:",file=sys.stderr)
     print("  -r                           Process recursively",file=sys.stderr)
     print("  -E [extension]               Set extension (default: xml)",file=sys.stderr)
+    print("  -q                           Ignore errors",file=sys.stderr)
+    print("  -j [n]                       Number of parallel processes to use (default: 1)",file=sys.stderr)
+    print("  --progress                   Report progress and the processing time per file",file=sys.stderr)
 
 
 def linkstrings(element, cls='current',debug=False):
@@ -338,15 +340,6 @@ def process(filename):
     else:
         print(doc.xmlstring())
 
-def processdir(d):
-    print("Searching in  " + d, file=sys.stderr)
-    for f in glob.glob(os.path.join(d ,'*')):
-        if f[-len(settings.extension) - 1:] == '.' + settings.extension:
-            process(f)
-        elif settings.recurse and os.path.isdir(f):
-            processdir(f)
-
-
 class settings:
     Classes = [] #class to add text for
     inplaceedit = False
@@ -365,10 +358,14 @@ class settings:
 
     textclasses =[]
 
+    ignoreerrors = False
+    jobs = 1
+    progress = False
+
 
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "E:hsSpPdDtT:O:XMe:wT:Fc", ["help"])
+        opts, args = getopt.getopt(sys.argv[1:], "E:hsSpPdDtT:O:XMe:wT:Fcqj:", ["help","progress"])
     except getopt.GetoptError as err:
         print(str(err),file=sys.stderr)
         usage()
@@ -409,6 +406,12 @@ def main():
             settings.inplaceedit = True
         elif o == '-r':
             settings.recurse = True
+        elif o == '-q':
+            settings.ignoreerrors = True
+        elif o == '-j':
+            settings.jobs = int(a)
+        elif o == '--progress':
+            settings.progress = True
         elif o == '-D':
             print("Debug enabled",file=sys.stderr)
             settings.debug = True
@@ -421,14 +424,13 @@ def main():
         settings.forceoffsetref = False
 
     if args:
-        for x in args:
-            if os.path.isdir(x):
-                processdir(x)
-            elif os.path.isfile(x):
-                process(x)
-            else:
-                print("ERROR: File or directory not found: " + x,file=sys.stderr)
-                sys.exit(3)
+        try:
+            files = findfiles(args, settings.extension, settings.recurse)
+        except FileNotFoundError as e:
+            print("ERROR: " + str(e),file=sys.stderr)
+            sys.exit(3)
+        for _ in processcorpus(process, files, settings, ordered=not settings.inplaceedit):
+            pass
     else:
         print("ERROR: Nothing to do, specify one or more files or directories",file=sys.stderr)
 
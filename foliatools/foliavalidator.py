@@ -7,29 +7,48 @@ Checks whether a FoLiA document is a valid FoLiA document, i.e. whether it prope
 
 import sys
 import os
-import glob
+import io
 import traceback
+import time
+import contextlib
+import json
 import lxml.etree
 import argparse
 from foliatools import VERSION as TOOLVERSION
+from foliatools.common import cachedir, hashfile, peakmemory, resetpeakmemory, manifestfiles, findfiles, processcorpus
 import folia.main as folia
 
 
-def validate(filename, schema = None,**kwargs):
+def validate(filename, schema = None, stats = None, **kwargs):
+    """Validates a FoLiA document, reports on stderr and returns whether the document is valid (or the document itself
+    in case of autodeclare). If a dictionary is passed as stats, it will be filled with the outcome and timings of the
+    separate validation stages. A dictionary passed as setdefinitions is used as a store of loaded set definitions for deep
+    validation, shared between calls."""
+    if stats is None:
+        stats = {}
+    stats.update(stage=None, exception=None, schematime=None, parsetime=None, serialisationtime=None)
+    if kwargs.get('schemaonly'):
+        return streamvalidate(filename, stats, **kwargs)
     if not kwargs.get('quick'):
+        begintime = time.perf_counter()
         try:
             folia.validate(filename, schema)
         except Exception as e:
+            stats.update(stage=1, exception=e.__class__.__name__, schematime=time.perf_counter() - begintime)
             print("VALIDATION ERROR against RelaxNG schema (stage 1/3), in " + filename,file=sys.stderr)
             print(str(e), file=sys.stderr)
             return False
+        stats['schematime'] = time.perf_counter() - begintime
+    begintime = time.perf_counter()
     try:
-        document = folia.Document(file=filename, deepvalidation=kwargs.get('deep',False),textvalidation=kwargs.get('stricttextvalidation',False),verbose=True, autodeclare=kwargs.get('autodeclare',False), processor=kwargs.get('processor'), keepversion=kwargs.get('keepversion'), fixunassignedprocessor=kwargs.get('fixunassignedprocessor'), fixinvalidreferences=kwargs.get('fixinvalidreferences',False), checkreferences=not kwargs.get('fixinvalidreferences',False), debug=kwargs.get('debug',0))
+        document = folia.Document(file=filename, deepvalidation=kwargs.get('deep',False),textvalidation=kwargs.get('stricttextvalidation',False),verbose=True, autodeclare=kwargs.get('autodeclare',False), processor=kwargs.get('processor'), keepversion=kwargs.get('keepversion'), fixunassignedprocessor=kwargs.get('fixunassignedprocessor'), fixinvalidreferences=kwargs.get('fixinvalidreferences',False), checkreferences=not kwargs.get('fixinvalidreferences',False), debug=kwargs.get('debug',0), **({'setdefinitions': kwargs['setdefinitions']} if kwargs.get('setdefinitions') is not None else {}))
     except folia.DeepValidationError as e:
+        stats.update(stage=2, exception=e.__class__.__name__, parsetime=time.perf_counter() - begintime)
         print("DEEP VALIDATION ERROR on full parse by library (stage 2/3), in " + filename,file=sys.stderr)
         print(e.__class__.__name__ + ": " + str(e),file=sys.stderr)
         return False
     except Exception as e:
+        stats.update(stage=2, exception=e.__class__.__name__, parsetime=time.perf_counter() - begintime)
         print("VALIDATION ERROR on full parse by library (stage 2/3), in " + filename,file=sys.stderr)
         print(e.__class__.__name__ + ": " + str(e),file=sys.stderr)
         if kwargs.get('traceback') or kwargs.get('debug'):
@@ -37,7 +56,9 @@ def validate(filename, schema = None,**kwargs):
             ex_type, ex, tb = sys.exc_info()
             traceback.print_exception(ex_type, ex, tb)
         return False
+    stats['parsetime'] = time.perf_counter() - begintime
     if not document.version:
+        stats['stage'] = 2
         print("VALIDATION ERROR: Document does not advertise FoLiA version (" + filename + ")",file=sys.stderr)
         return False
     elif folia.checkversion(document.version) == -1 and not kwargs.get('nowarn'):
@@ -47,23 +68,28 @@ def validate(filename, schema = None,**kwargs):
             print("WARNING: Document (" + filename + ") uses an older FoLiA version ("+document.version+") but is validated according to the newer specification (" + folia.FOLIAVERSION+"). You might want to increase the version attribute if this is a document you created and intend to publish.",file=sys.stderr)
     if document.textvalidationerrors:
         if kwargs.get('stricttextvalidation'):
+            stats['stage'] = 2
             print("VALIDATION ERROR because of text validation errors (stage 2/3), in " + filename,file=sys.stderr)
             return False
         elif not kwargs.get('nowarn'):
             print("WARNING: there were " + str(document.textvalidationerrors) + " text validation errors but these are currently not counted toward the full validation result (use -t for strict text validation)", file=sys.stderr)
     if not kwargs.get('quick'):
+        begintime = time.perf_counter()
         try:
             if kwargs.get('output'):
                 if not (folia.checkversion(document.version, "2.0.0") < 0 and kwargs.get('keepversion')):
                     document.provenance.append( folia.Processor.create(name="foliavalidator", version=TOOLVERSION, src="https://github.com/proycon/foliatools", metadata={"valid": "yes"}) )
             xml = document.xmlstring(form=folia.Form.EXPLICIT if kwargs.get('explicit') else folia.Form.NORMAL)
+            stats['serialisationtime'] = time.perf_counter() - begintime
             if kwargs.get('output'):
                 if folia.checkversion(document.version, "2.0.0") < 0 and not kwargs.get('keepversion') and not kwargs.get('autodeclare'):
+                    stats['stage'] = 3
                     print("WARNING: Document is valid but can't output older FoLiA (< v2) document unless you specify either --keepversion or --autodeclare to attempt to upgrade. However, if you really want to upgrade the document, use the 'foliaupgrade' tool instead." , file=sys.stderr)
                     return False
                 else:
                     print(xml)
         except Exception as e:
+            stats.update(stage=3, exception=e.__class__.__name__, serialisationtime=time.perf_counter() - begintime)
             print("SERIALISATION ERROR (stage 3/3): Document validated succesfully but failed to serialise! (" + filename + "). This may be indicative of a problem in the underlying library, please submit an issue on https://github.com/proycon/foliapy with the output of this error.",file=sys.stderr)
             print(e.__class__.__name__ + ": " + str(e),file=sys.stderr)
             print("-- Full traceback follows -->",file=sys.stderr)
@@ -80,18 +106,220 @@ def validate(filename, schema = None,**kwargs):
 
 
 
-def processdir(d, schema = None, **kwargs):
-    success = False
-    print("Searching in  " + d,file=sys.stderr)
-    extension = kwargs.get('extension','xml').strip('.')
-    for f in glob.glob(os.path.join(d ,'*')):
-        r = True
-        if f[-len(extension) - 1:] == '.' + extension:
-            r = validate(f, schema,**kwargs)
-        elif kwargs.get('recurse') and os.path.isdir(f):
-            r = processdir(f,schema,**kwargs)
-        if not r: success = False
-    return success
+def streamvalidate(filename, stats = None, **kwargs):
+    """Screens a document in a streaming fashion without ever building the full document in memory. The XML is read
+    using lxml's iterparse and elements are discarded as soon as they have been checked, so memory usage remains constant
+    regardless of the size of the document. This checks whether the document is well-formed, whether it has a FoLiA root
+    element with a version, whether all elements in the body are known FoLiA elements, and (for FoLiA v2 documents) whether
+    all annotations are properly declared. This is a screening only, it is no substitute for full validation."""
+    nsprefix = '{' + folia.NSFOLIA + '}'
+    nslen = len(nsprefix)
+    declarations = {} #annotation type => set of declared sets (and aliases)
+    version = None
+    depth = 0
+    inbody = False
+    if stats is None:
+        stats = {}
+    begintime = time.perf_counter()
+    try:
+        for event, node in lxml.etree.iterparse(filename, events=('start','end'), huge_tree=True, remove_comments=True, remove_pis=True):
+            if event == 'start':
+                depth += 1
+                if depth == 1:
+                    if node.tag != nsprefix + 'FoLiA':
+                        raise folia.ParseError("Expected FoLiA root element, got " + str(node.tag))
+                    version = node.attrib.get('version')
+                    if not version:
+                        stats.update(stage=1, schematime=time.perf_counter() - begintime)
+                        print("VALIDATION ERROR: Document does not advertise FoLiA version (" + filename + ")",file=sys.stderr)
+                        return False
+                elif inbody and node.tag[:nslen] == nsprefix:
+                    foliatag = node.tag[nslen:]
+                    if foliatag in folia.OLDTAGS:
+                        foliatag = folia.OLDTAGS[foliatag]
+                    if foliatag not in folia.XML2CLASS:
+                        raise folia.ParseError("Unknown FoLiA XML tag: " + foliatag + " @ line " + str(node.sourceline))
+                    Class = folia.XML2CLASS[foliatag]
+                    if folia.checkversion(version, "2.0.0") >= 0 and Class.ANNOTATIONTYPE is not None and not issubclass(Class, (folia.AbstractCorrectionChild, folia.AbstractAnnotationLayer)):
+                        foliaset = node.attrib.get('set')
+                        if Class.ANNOTATIONTYPE not in declarations:
+                            raise folia.DeclarationError("Encountered an instance without proper declaration: " + Class.__name__ + " <" + foliatag + "> @ line " + str(node.sourceline))
+                        elif foliaset and foliaset not in declarations[Class.ANNOTATIONTYPE]:
+                            raise folia.DeclarationError("Set '" + foliaset + "' is used for " + Class.__name__ + " <" + foliatag + ">, but has no declaration! @ line " + str(node.sourceline))
+                elif depth == 2 and node.tag in (nsprefix + 'text', nsprefix + 'speech'):
+                    inbody = True
+            else:
+                depth -= 1
+                if node.tag == nsprefix + 'annotations':
+                    for declaration in node:
+                        if isinstance(declaration.tag, str) and declaration.tag[:nslen] == nsprefix and declaration.tag[-11:] == '-annotation':
+                            prefix = declaration.tag[nslen:-11]
+                            if prefix in folia.OLDTAGS:
+                                prefix = folia.OLDTAGS[prefix]
+                            if prefix.upper() not in vars(folia.AnnotationType):
+                                raise folia.ParseError("Unknown declaration: " + declaration.tag)
+                            sets = declarations.setdefault(vars(folia.AnnotationType)[prefix.upper()], set())
+                            for attrib in ('set','alias'):
+                                if declaration.attrib.get(attrib):
+                                    sets.add(declaration.attrib[attrib])
+                    if folia.AnnotationType.TEXT in declarations:
+                        declarations[folia.AnnotationType.TEXT].add(folia.DEFAULT_TEXT_SET)
+                    if folia.AnnotationType.PHON in declarations:
+                        declarations[folia.AnnotationType.PHON].add(folia.DEFAULT_PHON_SET)
+                if inbody:
+                    #free everything we have seen so far
+                    node.clear()
+                    while node.getprevious() is not None:
+                        del node.getparent()[0]
+                    if depth == 1:
+                        inbody = False
+    except Exception as e:
+        stats.update(stage=1, exception=e.__class__.__name__, schematime=time.perf_counter() - begintime)
+        print("VALIDATION ERROR on streaming schema-only screening, in " + filename,file=sys.stderr)
+        print(e.__class__.__name__ + ": " + str(e),file=sys.stderr)
+        return False
+    stats['schematime'] = time.perf_counter() - begintime
+    if folia.checkversion(version, "2.0.0") < 0 and not kwargs.get('nowarn'):
+        print("WARNING: Document (" + filename + ") uses an older FoLiA version ("+version+"), annotation declarations are not checked by the schema-only screening for FoLiA v1 documents",file=sys.stderr)
+    print("Passed schema-only screening (this is no substitute for full validation): " +  filename,file=sys.stderr)
+    return True
+
+
+class ValidationCache:
+    """Persistent on-disk cache of validation results (SQLite). Results are keyed by the hash of the file contents, the version of the FoLiA library and all flags that influence validation, so a file only needs to be validated again if any of these change. The messages produced during validation, the failing stage and the exception are stored as well so they can be reported again."""
+
+    #parameters that influence the outcome of validation
+    FLAGS = ('deep','stricttextvalidation','quick','schemaonly','keepversion','nowarn','explicit','fixunassignedprocessor','fixinvalidreferences')
+
+    #stands in for the filename in stored messages
+    PLACEHOLDER = "\x00FILENAME\x00"
+
+    def __init__(self, filename=None):
+        if not filename:
+            filename = os.path.join(cachedir(), 'validation.sqlite')
+        self.filename = filename
+        import sqlite3 #only needed with the cache enabled
+        self.db = sqlite3.connect(filename, timeout=60)
+        self.db.execute("CREATE TABLE IF NOT EXISTS results (hash TEXT NOT NULL, libversion TEXT NOT NULL, flags TEXT NOT NULL, valid INTEGER NOT NULL, messages TEXT NOT NULL, stage INTEGER, exception TEXT, PRIMARY KEY (hash, libversion, flags))")
+        if 'stage' not in [ row[1] for row in self.db.execute("PRAGMA table_info(results)") ]:
+            #caches made by earlier versions lack the failing stage and the exception
+            self.db.execute("ALTER TABLE results ADD COLUMN stage INTEGER")
+            self.db.execute("ALTER TABLE results ADD COLUMN exception TEXT")
+        self.db.commit()
+        self.libversion = folia.LIBVERSION + "/" + folia.FOLIAVERSION
+
+    @staticmethod
+    def applicable(**kwargs):
+        """Returns whether results can be cached at all given the parameters, this is not the case if validation has side-effects like producing output"""
+        return not kwargs.get('nocache') and not kwargs.get('output') and not kwargs.get('autodeclare')
+
+    def flags(self, **kwargs):
+        return json.dumps({ flag: kwargs.get(flag) for flag in self.FLAGS }, sort_keys=True)
+
+    def get(self, filename, filehash, **kwargs):
+        """Returns a (valid, messages, stats) tuple if there is a cached result, None otherwise. Stats holds the failing stage and the exception"""
+        row = self.db.execute("SELECT valid, messages, stage, exception FROM results WHERE hash = ? AND libversion = ? AND flags = ?", (filehash, self.libversion, self.flags(**kwargs))).fetchone()
+        if row:
+            #the result may originate from another file with the same contents
+            return bool(row[0]), row[1].replace(self.PLACEHOLDER, filename), { 'stage': row[2], 'exception': row[3] }
+        return None
+
+    def set(self, filename, filehash, valid, messages, stats, **kwargs):
+        self.db.execute("INSERT OR REPLACE INTO results (hash, libversion, flags, valid, messages, stage, exception) VALUES (?, ?, ?, ?, ?, ?, ?)", (filehash, self.libversion, self.flags(**kwargs), int(bool(valid)), messages.replace(filename, self.PLACEHOLDER), stats.get('stage'), stats.get('exception')))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def capturedvalidate(filename, schema = None, stats = None, **kwargs):
+    """Validates a single file like validate(), but captures all output. Returns a (valid, stdout, stderr) tuple, valid is None if validation was aborted by an unexpected exception"""
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        try:
+            r = bool(validate(filename, schema, stats, **kwargs))
+        except Exception as e:
+            if stats is not None:
+                stats['exception'] = e.__class__.__name__
+            print("VALIDATION ERROR: Unexpected " + e.__class__.__name__ + " in " + filename + ": " + str(e), file=sys.stderr)
+            r = None
+    return r, stdout.getvalue(), stderr.getvalue()
+
+REPORTSTATS = ('stage', 'exception', 'schematime', 'parsetime', 'serialisationtime', 'peakrss', 'peakrssdelta')
+
+def makereport(filename, valid, stats, cached=False):
+    """Makes a report record for the validation of a single file, with the stats gathered during validation (or taken from the cache). Every record has the same keys, stats that are not available are null"""
+    if valid:
+        status = "valid"
+    elif valid is None:
+        status = "error"
+    else:
+        status = "invalid"
+    record = { "file": filename, "status": status, "cached": cached, "size": os.path.getsize(filename) }
+    for key in REPORTSTATS:
+        record[key] = stats.get(key)
+    return record
+
+def writereport(reportfile, record):
+    """Writes a report record in JSON Lines format"""
+    reportfile.write(json.dumps(record) + "\n")
+    reportfile.flush()
+
+#state of a worker process, the schema is compiled only once per worker
+_worker = {}
+
+def initworker(kwargs):
+    _worker['schema'] = lxml.etree.RelaxNG(folia.relaxng())
+    _worker['kwargs'] = kwargs
+    if ValidationCache.applicable(**kwargs):
+        _worker['cache'] = ValidationCache(kwargs.get('cachefile'))
+    else:
+        _worker['cache'] = None
+
+def validateworker(filename):
+    """Validates a single file in a worker process. All output is captured and returned to the parent process so it can be printed in a deterministic order. Results found in the cache are returned without validating again, writing new results to the cache is left to the parent process."""
+    kwargs = _worker['kwargs']
+    filehash = None
+    if _worker['cache'] is not None:
+        filehash = hashfile(filename)
+        result = _worker['cache'].get(filename, filehash, **kwargs)
+        if result is not None:
+            return filename, result[0], "", result[1], None, makereport(filename, result[0], result[2], True)
+    stats = {}
+    #the peak memory usage of this file alone, rather than of the worker so far (only measurable on Linux), and how far it rose above the memory the worker already held
+    measured = resetpeakmemory()
+    startrss = peakmemory()
+    r, out, err = capturedvalidate(filename, _worker['schema'], stats, **kwargs)
+    stats['peakrss'] = peakmemory() if measured else None
+    stats['peakrssdelta'] = stats['peakrss'] - startrss if measured else None
+    return filename, r, out, err, filehash, makereport(filename, r, stats)
+
+def validatefiles(filenames, reportfile = None, **kwargs):
+    """Validates the given files through the corpus driver, using a pool of worker processes if multiple jobs are set. Output is reported in the order of the input files. Returns True if all files are valid"""
+    jobs = kwargs.get('jobs', 1)
+    cache = ValidationCache(kwargs.get('cachefile')) if ValidationCache.applicable(**kwargs) else None
+    valid = invalid = cached = 0
+    driversettings = argparse.Namespace(jobs=jobs, progress=kwargs.get('progress', False))
+    for filename, (_, r, out, err, filehash, record) in processcorpus(validateworker, filenames, driversettings, initializer=initworker, initargs=(kwargs,)):
+        if out: sys.stdout.write(out)
+        if err: sys.stderr.write(err)
+        if reportfile:
+            writereport(reportfile, record)
+        if cache is not None:
+            if filehash is None:
+                cached += 1
+            elif r is not None:
+                cache.set(filename, filehash, r, err, record, **kwargs)
+        if r:
+            valid += 1
+        else:
+            invalid += 1
+    if cache is not None:
+        cache.close()
+    if jobs > 1:
+        print("Validated " + str(valid+invalid) + " document(s) using " + str(jobs) + " processes: " + str(valid) + " valid, " + str(invalid) + " invalid, " + str(cached) + " result(s) taken from cache",file=sys.stderr)
+    return invalid == 0
 
 def commandparser(parser):
     parser.add_argument('-d','--deep',help="Enable deep validation; validated uses classes against provided set definitions", action='store_true', default=False)
@@ -102,11 +330,20 @@ def commandparser(parser):
     parser.add_argument('-W','--nowarn',help="Suppress warnings", action='store_true', default=False)
     parser.add_argument('-i','--ignore',help="Always report a successful exit code, even in case of validation errors", action='store_true', default=False)
     parser.add_argument('-t','--stricttextvalidation',help="Treat text validation errors strictly for FoLiA < v1.5,  it always enabled for for FoLiA v1.5+ regardless of this parameter", action='store_true', default=False)
+    parser.add_argument('--schemaonly','--schema-only',help="Perform only a quick streaming screening of the documents that runs in constant memory and never loads the full document. This checks whether documents are well-formed, use only known FoLiA elements and declare all annotations they use, but is NOT a full validation; use it to screen huge documents before a full validation", action='store_true', default=False)
     parser.add_argument('-o','--output',help="Output document to stdout. This output contains added proof of validation to the provenance chain (not cryptographically secure though!)", action='store_true', default=False)
     parser.add_argument('-k','--keepversion',help="Attempt to keep an older FoLiA version (not always guaranteed to work)", action='store_true', default=False)
     parser.add_argument('-D','--debug',type=int,help="Debug level", action='store',default=0)
     parser.add_argument('-b','--traceback',help="Provide a full traceback on validation errors", action='store_true', default=False)
     parser.add_argument('-x','--explicit',help="Serialise to explicit form, this generates more verbose XML and simplifies the job for parsers as implicit information is made explicit", action='store_true', default=False)
+    parser.add_argument('-j','--jobs', type=int,help="Number of parallel processes to use for validation. Each process loads the schema once, output is reported in the order of the input files", action='store',default=1)
+    parser.add_argument('--progress',help="Report progress and the validation time per file", action='store_true', default=False)
+    parser.add_argument('--report', type=str,help="Output a machine-readable report with one record per file, containing the outcome, the failing stage, the exception, the file size, the time spent in each stage (in seconds) the peak memory usage while validating the file and how far that rose above the memory usage at the start of the file (RSS in MB, Linux only, null elsewhere). Results taken from the cache report the failing stage and the exception, their times and memory usage are null. Supported formats: jsonl (JSON Lines)", action='store', choices=('jsonl',), dest='reportformat', default=None)
+    parser.add_argument('--reportfile', type=str,help="File to write the report to (use with --report), - for stdout (not possible with -o, which outputs the document to stdout)", action='store',default="-")
+    parser.add_argument('--nocache','--no-cache',help="Do not use the validation cache. By default, validation results are cached on disk (keyed by file contents, library version and validation parameters) so unchanged files do not need to be validated again", action='store_true', default=False)
+    parser.add_argument('--cachefile', type=str,help="Path to the validation cache (SQLite database), defaults to validation.sqlite in ~/.cache/foliatools/", action='store',default=None)
+    parser.add_argument('--manifest', type=str,help="Validate the documents in this corpus manifest (built by foliaindex), in addition to any specified files", action='store',default=None)
+    parser.add_argument('--where', type=str,help="Only validate the documents in the manifest that match these constraints, e.g. annotation:entity,w>10000 (see foliaindex --help)", action='store',default=None)
     parser.add_argument('--fixunassignedprocessor',help="Fixes invalid FoLiA that does not explicitly assign a processor to an annotation when multiple processors are possible (and there is therefore no default). The first processor will be used in this case.", action='store_true', default=False)
     parser.add_argument('--fixinvalidreferences',help="Fixes invalid FoLiA that contains invalid references. Fixing here simply means all invalid references will be removed (and replaced by an XML comment)", action='store_true', default=False)
     return parser
@@ -118,23 +355,35 @@ def main():
     parser.add_argument('files', nargs='*', help='Files (and/or directories) to validate')
     args = parser.parse_args()
 
-    schema  = lxml.etree.RelaxNG(folia.relaxng())
-
     if args.explicit:
         args.output = True
 
+    if args.manifest:
+        try:
+            args.files += manifestfiles(args.manifest, args.where)
+        except (FileNotFoundError, ValueError) as e:
+            print("ERROR: " + str(e),file=sys.stderr)
+            sys.exit(2)
+
+    if args.reportformat and args.reportfile == '-' and args.output:
+        print("ERROR: The report and the output document can not both be written to stdout, use --reportfile to write the report to a file",file=sys.stderr)
+        sys.exit(2)
+
+    kwargs = args.__dict__.copy()
+    if not args.reportformat:
+        kwargs['reportfile'] = None
+    elif args.reportfile == '-':
+        kwargs['reportfile'] = sys.stdout
+    else:
+        kwargs['reportfile'] = open(args.reportfile,'w',encoding='utf-8')
+
     if args.files:
-        success = True
-        for file in args.files:
-            r = False
-            if os.path.isdir(file):
-                r = processdir(file,schema, **args.__dict__)
-            elif os.path.isfile(file):
-                r = validate(file, schema, **args.__dict__)
-            else:
-                print("ERROR: File or directory not found: " + file,file=sys.stderr)
-                sys.exit(3)
-            if not r: success= False
+        try:
+            filenames = findfiles(args.files, args.extension.strip('.'), args.recurse)
+        except FileNotFoundError as e:
+            print("ERROR: " + str(e),file=sys.stderr)
+            sys.exit(3)
+        success = validatefiles(filenames, **kwargs)
         if not success and not args.ignore:
             sys.exit(1)
     else:
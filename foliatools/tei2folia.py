@@ -26,6 +26,7 @@ from urllib.request import urlretrieve
 import folia.main as folia
 from foliatools import VERSION as TOOLVERSION
 from foliatools.foliaid import assignids
+from foliatools.xslt import loadstylesheet
 
 class CustomResolver(lxml.etree.Resolver):
     #adapted from http://www.hoboes.com/Mimsy/hacks/caching-dtds-using-lxml-and-etree/
@@ -239,14 +240,7 @@ def postprocess_warnings(doc):
             print(comment.value, file=sys.stderr)
 
 def loadxslt():
-    xsltfilename = "tei2folia.xsl"
-    xsldir = os.path.dirname(__file__)
-    if xsltfilename[0] != '/': xsltfilename = os.path.join(xsldir, xsltfilename)
-    if not os.path.exists(xsltfilename):
-        raise Exception("XSL Stylesheet not found: " + xsltfilename)
-    xslt = lxml.etree.parse(xsltfilename)
-    transformer = lxml.etree.XSLT(xslt)
-    return transformer
+    return loadstylesheet("tei2folia.xsl")
 
 
 def main():
@@ -2,20 +2,42 @@
 
 import lxml.etree
 import sys
-import glob
 import getopt
 import os.path
 import io
+from foliatools.common import findfiles, processcorpus
 
-def transform(xsltfilename, sourcefilename, targetfilename = None, encoding = 'utf-8', **kwargs):
+#Compiled stylesheets, per process: (path) => (mtime, size, transformer)
+_stylesheets = {}
+
+def loadstylesheet(xsltfilename, cache=True):
+    """Parses and compiles an XSL stylesheet (relative paths are relative to the foliatools directory) and returns the transformer.
+
+    Compiled stylesheets are kept in a cache for the lifetime of the process, so every stylesheet is compiled only once per process, no matter how many documents are transformed.
+    A stylesheet is recompiled if it has been modified since, so long-lived processes pick up changes. Set cache to False to bypass the cache."""
     xsldir = os.path.dirname(__file__)
     if xsltfilename[0] != '/': xsltfilename = os.path.join(xsldir, xsltfilename)
-    if not os.path.exists(xsltfilename):
+    try:
+        st = os.stat(xsltfilename)
+    except FileNotFoundError:
         raise Exception("XSL Stylesheet not found: " + xsltfilename)
-    elif not os.path.exists(sourcefilename):
+    if cache and xsltfilename in _stylesheets:
+        mtime, size, transformer = _stylesheets[xsltfilename]
+        if mtime == st.st_mtime_ns and size == st.st_size:
+            return transformer
+    transformer = lxml.etree.XSLT(lxml.etree.parse(xsltfilename))
+    if cache:
+        _stylesheets[xsltfilename] = (st.st_mtime_ns, st.st_size, transformer)
+    return transformer
+
+def clearstylesheets():
+    """Clears the cache of compiled stylesheets"""
+    _stylesheets.clear()
+
+def transform(xsltfilename, sourcefilename, targetfilename = None, encoding = 'utf-8', **kwargs):
+    transformer = loadstylesheet(xsltfilename)
+    if not os.path.exists(sourcefilename):
         raise Exception("File not found: " + sourcefilename)
-    xslt = lxml.etree.parse(xsltfilename)
-    transformer = lxml.etree.XSLT(xslt)
     parsedsource = lxml.etree.parse(sourcefilename)
     kwargs = { k: lxml.etree.XSLT.strparam(v)  for k,v in kwargs.items() }
     transformed = transformer(parsedsource, **kwargs)
@@ -37,6 +59,9 @@ def usage():
     print("  -r                           Process recursively",file=sys.stderr)
     print("  -E [extension]               Set extension (default: xml)",file=sys.stderr)
     print("  -q                           Ignore errors",file=sys.stderr)
+    print("  -j [n], --jobs [n]           Number of parallel processes to use (default: 1), every process compiles the",file=sys.stderr)
+    print("                               stylesheet once. The output is reassembled in input order",file=sys.stderr)
+    print("  --progress                   Report progress and the processing time per file",file=sys.stderr)
     print("  -s [url]                     Associate a CSS Stylesheet (URL, may be relative)",file=sys.stderr)
     print("  -T                           Retain tokenisation",file=sys.stderr)
     print("  -t [textclass]               Text class to output",file=sys.stderr)
@@ -54,33 +79,21 @@ class settings:
     usage = "UNDEFINED"
     css = ""
     textclass = "current"
-
-def processdir(d):
-    print("Searching in  " + d, file=sys.stderr)
-    for f in glob.glob(os.path.join(d,'*')):
-        if f[-len(settings.extension) - 1:] == '.' + settings.extension and f[-len(settings.outputextension) - 1:] != '.' + settings.outputextension:
-            process(f)
-        elif settings.recurse and os.path.isdir(f):
-            processdir(f)
+    jobs = 1
+    progress = False
 
 def process(inputfilename):
-    try:
-        kwargs = {}
-        if settings.css:
-            kwargs['css'] = settings.css
-        if settings.textclass:
-            kwargs['textclass'] = settings.textclass
-        transform(settings.xsltfilename, inputfilename, None, settings.encoding, **kwargs)
-    except Exception as e:
-        if settings.ignoreerrors:
-            print("ERROR: An exception was raised whilst processing " + inputfilename + ":", e, file=sys.stderr)
-        else:
-            raise e
+    kwargs = {}
+    if settings.css:
+        kwargs['css'] = settings.css
+    if settings.textclass:
+        kwargs['textclass'] = settings.textclass
+    transform(settings.xsltfilename, inputfilename, None, settings.encoding, **kwargs)
 
 
 def main(xsltfilename, outputextension, usagetext):
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "o:E:hrqs:Tt:", ["help"])
+        opts, args = getopt.getopt(sys.argv[1:], "o:E:hrqs:Tt:j:", ["help","jobs=","progress"])
     except getopt.GetoptError as err:
         print(str(err), file=sys.stderr)
         usage()
@@ -109,17 +122,27 @@ def main(xsltfilename, outputextension, usagetext):
             settings.css = a
         elif o == '-t':
             settings.textclass = a
+        elif o == '-j' or o == '--jobs':
+            settings.jobs = int(a)
+        elif o == '--progress':
+            settings.progress = True
         else:
             raise Exception("No such option: " + o)
 
     if args:
+        files = []
         for x in args:
-            if os.path.isdir(x):
-                processdir(x)
-            elif os.path.isfile(x):
-                process(x)
-            else:
-                print("ERROR: File or directory not found: " + x, file=sys.stderr)
+            try:
+                found = findfiles([x], settings.extension, settings.recurse)
+            except FileNotFoundError as e:
+                print("ERROR: " + str(e), file=sys.stderr)
                 sys.exit(3)
+            if os.path.isdir(x):
+                #skip earlier output in directories
+                found = [ f for f in found if f[-len(settings.outputextension) - 1:] != '.' + settings.outputextension ]
+            files += found
+        #the stylesheet is compiled once, in every process
+        for _ in processcorpus(process, files, settings, initializer=loadstylesheet, initargs=(settings.xsltfilename,)):
+            pass
     else:
         print("ERROR: Nothing to do, specify one or more files or directories",file=sys.stderr)
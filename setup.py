@@ -59,6 +59,8 @@ setup(
             'folia2rst = foliatools.folia2rst:main',
             'foliacorrect = foliatools.foliacorrect:main',
             'foliacount = foliatools.foliacount:main',
+            'foliaindex = foliatools.foliaindex:main',
+            'foliaserve = foliatools.foliaserve:main',
             'foliaid = foliatools.foliaid:main',
             'foliaspec = foliatools.foliaspec:main',
             'foliaspec2json = foliatools.foliaspec2json:main',
@@ -76,5 +78,6 @@ setup(
     },
     #include_package_data=True,
     package_data = {'foliatools': ['*.xsl']},
-    install_requires=['folia >= 2.5.9', 'lxml >= 2.2','docutils', 'pyyaml', 'langid','conllu', 'requests','stam >= 0.4.0']
+    install_requires=['folia >= 2.5.9', 'lxml >= 2.2','docutils', 'pyyaml', 'langid','conllu', 'requests','stam >= 0.4.0'],
+    extras_require={'columnar': ['pyarrow']}
 )
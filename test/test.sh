@@ -55,6 +55,39 @@ else
     fi
 fi
 
+echo "Running folia2txt (streaming)" >&2
+folia2txt --stream test.xml > test.tmp
+if [ $? -ne 0 ]; then
+    echo "...${boldred}FAILED${normal}" >&2
+    FAILURE=1
+else
+    diff test.tmp test.txt > test.diff
+    if [ $? -ne 0 ]; then
+        echo "...${boldred}FAILED${normal}" >&2
+        FAILURE=1
+        cat test.diff
+    else
+        echo "...${boldgreen}OK${normal}" >&2
+    fi
+fi
+
+echo "Running folia2txt (parallel, output should be identical to serial)" >&2
+cp test.xml test.copy.xml
+folia2txt -j 1 test.xml test.copy.xml > test.serial.tmp && folia2txt -j 2 test.xml test.copy.xml > test.tmp
+if [ $? -ne 0 ]; then
+    echo "...${boldred}FAILED${normal}" >&2
+    FAILURE=1
+else
+    diff test.tmp test.serial.tmp > test.diff
+    if [ $? -ne 0 ]; then
+        echo "...${boldred}FAILED${normal}" >&2
+        FAILURE=1
+        cat test.diff
+    else
+        echo "...${boldgreen}OK${normal}" >&2
+    fi
+fi
+
 echo "Running folia2columns" >&2
 folia2columns -c id,text,pos,lemma test.xml > test.tmp
 if [ $? -ne 0 ]; then
@@ -72,6 +105,54 @@ else
 fi
 
 
+echo "Running folia2columns (parallel, output should be identical to serial)" >&2
+folia2columns -j 1 -c id,text,pos,lemma test.xml test.copy.xml > test.serial.tmp && folia2columns -j 2 -c id,text,pos,lemma test.xml test.copy.xml > test.tmp
+if [ $? -ne 0 ]; then
+    echo "...${boldred}FAILED${normal}" >&2
+    FAILURE=1
+else
+    diff test.tmp test.serial.tmp > test.diff
+    if [ $? -ne 0 ]; then
+        echo "...${boldred}FAILED${normal}" >&2
+        FAILURE=1
+        cat test.diff
+    else
+        echo "...${boldgreen}OK${normal}" >&2
+    fi
+fi
+
+echo "Running foliacount (fast mode should match the full count)" >&2
+foliacount --nocache test.xml | LC_ALL=C sort > test.serial.tmp && foliacount --nocache --fast test.xml | LC_ALL=C sort > test.tmp
+if [ $? -ne 0 ]; then
+    echo "...${boldred}FAILED${normal}" >&2
+    FAILURE=1
+else
+    diff test.tmp test.serial.tmp > test.diff
+    if [ $? -ne 0 ]; then
+        echo "...${boldred}FAILED${normal}" >&2
+        FAILURE=1
+        cat test.diff
+    else
+        echo "...${boldgreen}OK${normal}" >&2
+    fi
+fi
+
+echo "Running foliafreqlist (binary output and --merge should round trip)" >&2
+foliafreqlist test.xml | LC_ALL=C sort > test.serial.tmp && foliafreqlist -b -o test.freqbin test.xml && foliafreqlist --merge test.freqbin | LC_ALL=C sort > test.tmp
+if [ $? -ne 0 ]; then
+    echo "...${boldred}FAILED${normal}" >&2
+    FAILURE=1
+else
+    diff test.tmp test.serial.tmp > test.diff
+    if [ $? -ne 0 ]; then
+        echo "...${boldred}FAILED${normal}" >&2
+        FAILURE=1
+        cat test.diff
+    else
+        echo "...${boldgreen}OK${normal}" >&2
+    fi
+fi
+
 echo "Running folia2annotatedtxt" >&2
 folia2annotatedtxt -c id,text,pos,lemma test.xml > test.tmp
 if [ $? -ne 0 ]; then